@@ -7,3 +7,13 @@ import DeepFried.optim as optim
 import DeepFried.pred as pred
 import DeepFried.util as util
 import DeepFried.augmentation as augmentation
+import DeepFried.parallel as parallel
+import DeepFried.checkpoint as checkpoint
+import DeepFried.timing as timing
+import DeepFried.profiling as profiling
+import DeepFried.summary as summary
+import DeepFried.serving as serving
+import DeepFried.cache as cache
+import DeepFried.fncache as fncache
+import DeepFried.export as export
+import DeepFried.finetune as finetune
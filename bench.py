@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of DeepFried on seeded synthetic data, runnable from the command
+line, for example:
+
+    python -m DeepFried.bench optim-state --epochs 10
+    python -m DeepFried.bench train --out new.json
+    python -m DeepFried.bench latency --batchsizes 1 16 256 --repeat 50
+    python -m DeepFried.bench fastpath --repeat 1000
+    python -m DeepFried.bench pred-scaling --nworkers 1 2 4 8
+    python -m DeepFried.bench branches --threads 1 2 4
+    python -m DeepFried.bench compare old.json new.json
+"""
+
+import DeepFried.augmentation as _aug
+import DeepFried.containers as _c
+import DeepFried.costs as _costs
+import DeepFried.layers as _l
+import DeepFried.optim as _o
+import DeepFried.parallel as _par
+import DeepFried.pred as _p
+import DeepFried.timing as _tm
+
+import argparse as _argparse
+import json as _json
+import platform as _platform
+import sys as _sys
+import time as _time
+import numpy as _np
+import theano as _th
+
+
+# The five optimizers with sensible arguments for the reference models, and
+# the keyword arguments to pass to `fit_epoch`.
+OPTIMIZERS = {
+    'sgd': (_o.StreaMiniSGD, {}, dict(lrate=0.1)),
+    'momentum': (_o.StreaMiniMomentum, dict(momentum=0.9), dict(lrate=0.01)),
+    'adagrad': (_o.StreaMiniAdaGrad, {}, dict(lrate=0.1)),
+    'rmsprop': (_o.StreaMiniRMSProp, {}, dict(lrate=0.001)),
+    'adadelta': (_o.StreaMiniAdaDelta, {}, {}),
+}
+
+
+def mk_data(n=2048, nin=64, nclass=10, seed=0):
+    """
+    Creates a seeded synthetic classification task: `n` samples of `nin`
+    features drawn from `nclass` gaussian blobs with random means.
+    """
+    rng = _np.random.RandomState(seed)
+    means = rng.randn(nclass, nin)
+    t = rng.randint(nclass, size=n).astype(_np.int32)
+    X = (means[t] + 2*rng.randn(n, nin)).astype(_th.config.floatX)
+    return X, t
+
+
+def mk_mlp(nin=64, nhid=256, nclass=10, seed=0):
+    """ The reference multi-layer perceptron. """
+    model = _c.Sequence(
+        _l.FullyConnected(nin, nhid),
+        _l.ReLU(),
+        _l.FullyConnected(nhid, nhid),
+        _l.ReLU(),
+        _l.FullyConnected(nhid, nclass),
+        _l.Softmax(),
+    )
+    model.reinit(seed)
+    return model
+
+
+def mk_images(n=2048, imshape=(16, 16), nclass=10, seed=0):
+    """ Just like `mk_data`, but single-channel images of `imshape`. """
+    X, t = mk_data(n, int(_np.prod(imshape)), nclass, seed)
+    return X.reshape((n,) + imshape), t
+
+
+def mk_convnet(imshape=(16, 16), nclass=10, seed=0):
+    """ The reference convolutional network for single-channel images. """
+    # Theano has no gradient for strided 'valid' convolutions.
+    h, w = imshape
+    model = _c.Sequence(
+        _l.Conv2D(16, 3, 1, bias=False),
+        _l.BatchNormalization(16),
+        _l.ReLU(),
+        _l.Conv2D(32, 3, 16),
+        _l.ReLU(),
+        _l.FullyConnected((32, h - 4, w - 4), nclass),
+        _l.Softmax(),
+    )
+    model.reinit(seed)
+    return model
+
+
+# The reference models, each with the function creating its data and the
+# augmenters to use for it. Full test-time augmentation of the convnet does
+# eight passes, the fast one only two.
+MODELS = {
+    'mlp': (mk_mlp, mk_data, lambda: [_aug.Flipper([0])]),
+    'convnet': (mk_convnet, mk_images, lambda: [_aug.Flipper([1]), _aug.Rotator(0, 270, npred=4, preds_fast=[0])]),
+}
+
+
+def meta():
+    """ Describes the environment the benchmarks run in. """
+    return dict(
+        python=_platform.python_version(),
+        numpy=_np.__version__,
+        theano=_th.__version__,
+        floatX=_th.config.floatX,
+        device=_th.config.device,
+        machine=_platform.machine(),
+    )
+
+
+def train(models=('mlp', 'convnet'), optimizers=None, epochs=3, batchsize=64, n=2048, seed=0):
+    """
+    Times `fit_epoch` of each of the reference `models` with each of the
+    `optimizers` (all by default), without and with augmentation. Each
+    configuration is trained for one warmup epoch followed by `epochs` timed
+    ones, of which the median samples/sec is reported.
+    """
+    results = []
+    for mname in models:
+        mk_model, mk_X, mk_augs = MODELS[mname]
+        X, t = mk_X(n=n, seed=seed)
+        for oname in optimizers or sorted(OPTIMIZERS):
+            cls, kw, fitkw = OPTIMIZERS[oname]
+            for augment in (False, True):
+                aug = _aug.AugmentationPipeline(X, t, *mk_augs()) if augment else None
+                opt = cls(batchsize, mk_model(seed=seed), _costs.CategoricalCrossEntropy(), **kw)
+
+                _np.random.seed(seed)
+                opt.fit_epoch(X, t, aug=aug, shuf=seed, **fitkw)
+
+                opt.timer = _tm.PhaseTimer()
+                for e in range(epochs):
+                    opt.fit_epoch(X, t, aug=aug, shuf=seed+e+1, **fitkw)
+
+                recs = opt.timer.epochs
+                phases = {k: v/epochs for k, v in opt.timer.totals.items()}
+                results.append(dict(
+                    bench='train', model=mname, optimizer=oname, augment=augment, batchsize=batchsize,
+                    samples_per_sec=float(_np.median([r['samples_per_sec'] for r in recs])),
+                    epoch_seconds=[r['seconds'] for r in recs],
+                    phase_seconds=phases,
+                ))
+    return results
+
+
+def _time_calls(call, warmup, repeat, n=1):
+    """
+    Calls `call` `warmup` times untimed and `repeat` times timed, and returns
+    the percentiles and mean of the latency, along with the throughput when
+    each call processes `n` samples.
+    """
+    for _ in range(warmup):
+        call()
+
+    times = []
+    for _ in range(repeat):
+        t0 = _time.perf_counter()
+        call()
+        times.append(_time.perf_counter() - t0)
+
+    p50, p95, p99 = _np.percentile(times, [50, 95, 99])
+    return dict(
+        warmup=warmup, repeat=repeat,
+        p50_ms=1e3*p50, p95_ms=1e3*p95, p99_ms=1e3*p99,
+        mean_ms=1e3*_np.mean(times),
+        samples_per_sec=n/_np.mean(times),
+    )
+
+
+# The test-time augmentation settings of the latency benchmark, as the
+# `fast` argument to pass to `pred_epoch`, or `None` for no augmentation.
+TTA = {'none': None, 'fast': True, 'full': False}
+
+
+def latency(models=('mlp', 'convnet'), batchsizes=tuple(2**i for i in range(11)), tta=('none', 'fast', 'full'), warmup=3, repeat=20, seed=0):
+    """
+    Measures the latency of `pred_epoch` on a single minibatch for each of
+    the reference `models`, `batchsizes` and test-time augmentation settings
+    `tta` (see `TTA`). Each is called `warmup` times untimed and `repeat`
+    times timed, of which the percentiles and the throughput are reported.
+    """
+    results = []
+    for mname in models:
+        mk_model, mk_X, mk_augs = MODELS[mname]
+        X, t = mk_X(n=max(batchsizes), seed=seed)
+        model = mk_model(seed=seed)
+        pred = _p.StreaMiniPredictor(max(batchsizes), model)
+
+        for tname in tta:
+            fast = TTA[tname]
+            aug = None if fast is None else _aug.AugmentationPipeline(X, t, *mk_augs())
+            for bs in batchsizes:
+                Xb = X[:bs]
+                timing = _time_calls(lambda: pred.pred_epoch(Xb, aug=aug, fast=fast), warmup, repeat, n=bs)
+                results.append(dict(bench='latency', model=mname, tta=tname, batchsize=bs, **timing))
+    return results
+
+
+def fastpath(models=('mlp', 'convnet'), warmup=10, repeat=200, seed=0):
+    """
+    Measures the latency of predicting a single sample through `pred_epoch`
+    against the `predict_one` fast path, with and without an output buffer,
+    for each of the reference `models`. The difference is the per-call
+    overhead which the fast path removes.
+    """
+    results = []
+    for mname in models:
+        mk_model, mk_X, _ = MODELS[mname]
+        X, _ = mk_X(n=1, seed=seed)
+        pred = _p.StreaMiniPredictor(1, mk_model(seed=seed))
+        pred.warmup(X)
+        buf = _np.empty_like(pred.predict_one(X[0]))
+
+        calls = {
+            'pred_epoch': lambda: pred.pred_epoch(X),
+            'predict_one': lambda: pred.predict_one(X[0]),
+            'predict_one_out': lambda: pred.predict_one(X[0], out=buf),
+        }
+        for how, call in calls.items():
+            results.append(dict(bench='fastpath', model=mname, call=how, **_time_calls(call, warmup, repeat)))
+    return results
+
+
+def pred_scaling(models=('mlp', 'convnet'), nworkers=(1, 2, 4), batchsize=64, n=2048, repeat=3, seed=0):
+    """
+    Measures the throughput of multi-process prediction of the reference
+    `models` with each count of `nworkers` worker processes, along with the
+    speedup over the first count and the number of cores.
+    """
+    results = []
+    for mname in models:
+        mk_model, mk_X, _ = MODELS[mname]
+        X, _ = mk_X(n=n, seed=seed)
+        pred = _p.StreaMiniPredictor(batchsize, mk_model(seed=seed))
+        for r in _par.prediction_speedup(lambda k: _par.ParallelPredictor(k, pred), X, nworkers, repeat):
+            results.append(dict(r, bench='pred-scaling', model=mname, batchsize=batchsize, n=n))
+    return results
+
+
+def mk_towers(nin=64, nhid=512, ntowers=4, nclass=10, fuse=False, seed=0):
+    """
+    A shared layer followed by `ntowers` independent MLP heads, whose first
+    layers are fused into one matrix-product if `fuse`.
+    """
+    model = _c.Sequence(
+        _l.FullyConnected(nin, nhid), _l.ReLU(),
+        _c.Parallel(*[
+            _c.Sequence(_l.FullyConnected(nhid, nhid), _l.ReLU(), _l.FullyConnected(nhid, nclass), _l.Softmax())
+            for _ in range(ntowers)
+        ], fuse=fuse),
+    )
+    model.reinit(seed)
+    return model
+
+
+def branches(threads=(1, 2, 4), batchsizes=(1, 64, 512), ntowers=4, warmup=3, repeat=20, seed=0):
+    """
+    Measures the prediction latency of a model with `ntowers` parallel heads
+    (see `mk_towers`) when evaluating all of its branches in one function,
+    with their first layers as separate matrix-products (`'unfused'`) and
+    fused into one (`'fused'`), and concurrently on each count of `threads`.
+    """
+    X, _ = mk_data(n=max(batchsizes), seed=seed)
+    model = mk_towers(ntowers=ntowers, seed=seed)
+    preds = [('unfused', _p.StreaMiniPredictor(max(batchsizes), model))]
+    preds += [('fused', _p.StreaMiniPredictor(max(batchsizes), mk_towers(ntowers=ntowers, fuse=True, seed=seed)))]
+    preds += [(n, _p.StreaMiniPredictor(max(batchsizes), model, branch_threads=n)) for n in threads]
+
+    results = []
+    for bs in batchsizes:
+        Xb = X[:bs]
+        for how, pred in preds:
+            timing = _time_calls(lambda: pred.pred_epoch(Xb), warmup, repeat, n=bs)
+            results.append(dict(bench='branches', ntowers=ntowers, threads=how, batchsize=bs, **timing))
+    return results
+
+
+# The metrics which `compare` looks at, with +1 if higher is better.
+METRICS = {
+    'samples_per_sec': +1,
+    'mean_ms': -1,
+    'p50_ms': -1,
+    'p95_ms': -1,
+    'p99_ms': -1,
+    'state_bytes': -1,
+}
+
+
+def _key(r):
+    """ Identifies a result by all of its fields which are not measured. """
+    return tuple(sorted((k, v) for k, v in r.items()
+                        if k not in METRICS and not isinstance(v, (list, dict, float))))
+
+
+def compare(old, new, threshold=0.1):
+    """
+    Compares the results of two runs, `old` and `new`, as returned by the
+    benchmarks. Returns a list of dicts, one per metric of each result
+    present in both, with the relative `change` and whether it's a
+    `regression` by more than `threshold`.
+    """
+    olds = {_key(r): r for r in old}
+    rows = []
+    for r in new:
+        o = olds.get(_key(r))
+        if o is None:
+            continue
+        for metric, sign in sorted(METRICS.items()):
+            if metric not in r or metric not in o:
+                continue
+            change = r[metric]/o[metric] - 1 if o[metric] else 0.0
+            rows.append(dict(
+                key=dict(_key(r)), metric=metric, old=o[metric], new=r[metric],
+                change=change, regression=sign*change < -threshold,
+            ))
+    return rows
+
+
+def optim_state(epochs=10, batchsize=64, seed=0):
+    """
+    Trains the reference MLP with each of the optimizers and each way of
+    storing their state, reporting the memory used by that state next to the
+    final training cost and accuracy.
+    """
+    X, t = mk_data(seed=seed)
+
+    results = []
+    for name, (cls, kw, fitkw) in sorted(OPTIMIZERS.items()):
+        for dtype in (None, 'float16', 'int8'):
+            model = mk_mlp(seed=seed)
+            opt = cls(batchsize, model, _costs.CategoricalCrossEntropy(), state_dtype=dtype, **kw)
+            for e in range(epochs):
+                cost = opt.fit_epoch(X, t, shuf=seed+e, **fitkw)
+
+            acc = _np.mean(_np.argmax(_p.StreaMiniPredictor(batchsize, model).pred_epoch(X), axis=1) == t)
+            results.append(dict(
+                bench='optim-state', optimizer=name, epochs=epochs, batchsize=batchsize,
+                state_dtype=dtype or _th.config.floatX,
+                state_bytes=int(opt.state_nbytes()),
+                param_bytes=int(sum(p.get_value(borrow=True).nbytes for p in model.params)),
+                cost=float(cost),
+                accuracy=float(acc),
+            ))
+    return results
+
+
+def main(argv=None):
+    parser = _argparse.ArgumentParser(prog='python -m DeepFried.bench', description="Benchmarks of DeepFried.")
+    sub = parser.add_subparsers(dest='bench')
+
+    p = sub.add_parser('optim-state', help="Memory of optimizer state against convergence.")
+    p.add_argument('--epochs', type=int, default=10)
+    p.add_argument('--batchsize', type=int, default=64)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--out', help="Write the results to this file instead of stdout.")
+
+    p = sub.add_parser('train', help="Training throughput of fit_epoch.")
+    p.add_argument('--models', nargs='+', default=['mlp', 'convnet'], choices=sorted(MODELS))
+    p.add_argument('--optimizers', nargs='+', default=None, choices=sorted(OPTIMIZERS))
+    p.add_argument('--epochs', type=int, default=3)
+    p.add_argument('--batchsize', type=int, default=64)
+    p.add_argument('-n', type=int, default=2048, help="Number of samples in the synthetic dataset.")
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--out', help="Write the results to this file instead of stdout.")
+
+    p = sub.add_parser('latency', help="Prediction latency percentiles of pred_epoch.")
+    p.add_argument('--models', nargs='+', default=['mlp', 'convnet'], choices=sorted(MODELS))
+    p.add_argument('--batchsizes', nargs='+', type=int, default=[2**i for i in range(11)])
+    p.add_argument('--tta', nargs='+', default=['none', 'fast', 'full'], choices=sorted(TTA))
+    p.add_argument('--warmup', type=int, default=3)
+    p.add_argument('--repeat', type=int, default=20)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--out', help="Write the results to this file instead of stdout.")
+
+    p = sub.add_parser('fastpath', help="Single-sample latency of predict_one against pred_epoch.")
+    p.add_argument('--models', nargs='+', default=['mlp', 'convnet'], choices=sorted(MODELS))
+    p.add_argument('--warmup', type=int, default=10)
+    p.add_argument('--repeat', type=int, default=200)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--out', help="Write the results to this file instead of stdout.")
+
+    p = sub.add_parser('pred-scaling', help="Multi-process prediction throughput against worker count.")
+    p.add_argument('--models', nargs='+', default=['mlp', 'convnet'], choices=sorted(MODELS))
+    p.add_argument('--nworkers', nargs='+', type=int, default=[1, 2, 4])
+    p.add_argument('--batchsize', type=int, default=64)
+    p.add_argument('-n', type=int, default=2048, help="Number of samples in the synthetic dataset.")
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--out', help="Write the results to this file instead of stdout.")
+
+    p = sub.add_parser('branches', help="Prediction latency of Parallel branches, unfused, fused and concurrent.")
+    p.add_argument('--threads', nargs='+', type=int, default=[1, 2, 4])
+    p.add_argument('--batchsizes', nargs='+', type=int, default=[1, 64, 512])
+    p.add_argument('--ntowers', type=int, default=4)
+    p.add_argument('--warmup', type=int, default=3)
+    p.add_argument('--repeat', type=int, default=20)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--out', help="Write the results to this file instead of stdout.")
+
+    p = sub.add_parser('compare', help="Flag regressions between two result files.")
+    p.add_argument('old')
+    p.add_argument('new')
+    p.add_argument('--threshold', type=float, default=0.1, help="Relative change which counts as regression.")
+
+    args = parser.parse_args(argv)
+
+    if args.bench == 'optim-state':
+        results = dict(meta=meta(), results=optim_state(args.epochs, args.batchsize, args.seed))
+    elif args.bench == 'train':
+        results = dict(meta=meta(), results=train(args.models, args.optimizers, args.epochs, args.batchsize, args.n, args.seed))
+    elif args.bench == 'latency':
+        results = dict(meta=meta(), results=latency(args.models, args.batchsizes, args.tta, args.warmup, args.repeat, args.seed))
+    elif args.bench == 'fastpath':
+        results = dict(meta=meta(), results=fastpath(args.models, args.warmup, args.repeat, args.seed))
+    elif args.bench == 'pred-scaling':
+        results = dict(meta=meta(), results=pred_scaling(args.models, args.nworkers, args.batchsize, args.n, args.repeat, args.seed))
+    elif args.bench == 'branches':
+        results = dict(meta=meta(), results=branches(args.threads, args.batchsizes, args.ntowers, args.warmup, args.repeat, args.seed))
+    elif args.bench == 'compare':
+        with open(args.old) as f:
+            old = _json.load(f)['results']
+        with open(args.new) as f:
+            new = _json.load(f)['results']
+        rows = compare(old, new, args.threshold)
+        for r in rows:
+            print("{:<16} {:>12.4g} {:>12.4g} {:>+8.1%}  {}  {}".format(
+                r['metric'], r['old'], r['new'], r['change'],
+                "REGRESSION" if r['regression'] else "          ",
+                " ".join("{}={}".format(k, v) for k, v in sorted(r['key'].items()))))
+        return 1 if any(r['regression'] for r in rows) else 0
+    else:
+        parser.print_help()
+        return 1
+
+    if getattr(args, 'out', None):
+        with open(args.out, 'w') as f:
+            _json.dump(results, f, indent=2)
+    else:
+        _json.dump(results, _sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    _sys.exit(main())
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+A cache of predictions in front of a `StreaMiniPredictor`, for when the same
+inputs come in over and over again:
+
+    pred = CachedPredictor(StreaMiniPredictor(64, model), maxbytes=256*2**20)
+    y = pred.pred_epoch(X)  # Only the rows of X not seen before are computed.
+    pred.version += 1       # After changing the model's parameters.
+
+Each sample is looked up by a hash of its bytes (of all inputs), the model
+`version`, the test-time augmentation used and any further arguments to the
+prediction function, so that neither a retrained model nor different
+augmentation can return stale predictions.
+"""
+
+import DeepFried.util as _u
+
+from collections import OrderedDict as _OrderedDict
+import hashlib as _hashlib
+import numpy as _np
+
+
+def _describe(obj):
+    """
+    Returns a string describing `obj`, such as an augmentation pipeline, by
+    its type and all of its attributes, recursively. Arrays are described by
+    a hash of their contents.
+    """
+    if isinstance(obj, _np.ndarray):
+        h = _hashlib.blake2b(_np.ascontiguousarray(obj).data, digest_size=16)
+        return 'ndarray({}, {}, {})'.format(obj.dtype.str, obj.shape, h.hexdigest())
+    if isinstance(obj, dict):
+        items = sorted((repr(k), _describe(v)) for k, v in obj.items())
+        return '{' + ', '.join('{}: {}'.format(k, v) for k, v in items) + '}'
+    if isinstance(obj, (list, tuple)):
+        return '{}({})'.format(type(obj).__name__, ', '.join(_describe(v) for v in obj))
+    if hasattr(obj, '__dict__'):
+        return '{}.{}{}'.format(type(obj).__module__, type(obj).__qualname__, _describe(vars(obj)))
+    return repr(obj)
+
+
+class CachedPredictor(object):
+    """
+    Wraps a `StreaMiniPredictor`, remembering the predictions of single
+    samples in a least-recently-used cache of at most `maxbytes` bytes. Of
+    each call to `pred_epoch`, only the samples which miss the cache are
+    passed on to the predictor, and the results are merged back in order.
+
+    This only works for models whose outputs have one entry per sample,
+    i.e. whose `batch_agg` concatenates, which is the default.
+    """
+
+
+    def __init__(self, predictor, maxbytes=64*2**20, version=0):
+        """
+        - `predictor`: The `StreaMiniPredictor` to cache.
+        - `maxbytes`: The largest total size of all cached predictions.
+        - `version`: The version of the model, part of every key. Change it
+            whenever the model's parameters change.
+        """
+        self.predictor = predictor
+        self.batchsize = predictor.batchsize
+        self.maxbytes = maxbytes
+        self.version = version
+
+        self._entries = _OrderedDict()
+        self.nbytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+
+    def clear(self):
+        """ Drops all cached predictions. Statistics are kept. """
+        self._entries.clear()
+        self.nbytes = 0
+
+
+    def stats(self):
+        """
+        Returns a dict with the number of `entries` and their `bytes`, the
+        number of `hits` and `misses` so far and the `hit_rate`, as well as
+        the number of `evictions` and the `evicted_bytes`.
+        """
+        n = self.hits + self.misses
+        return dict(
+            entries=len(self._entries),
+            bytes=self.nbytes,
+            maxbytes=self.maxbytes,
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=self.hits/n if n else 0.0,
+            evictions=self.evictions,
+            evicted_bytes=self.evicted_bytes,
+        )
+
+
+    def keys(self, Xs, aug=None, fast=False, **kwargs):
+        """
+        Returns the cache keys of all samples in the inputs `Xs`, when
+        predicted with augmentation `aug` and the prediction function's
+        keyword arguments `kwargs`.
+        """
+        # Equal augmentation settings share their predictions, even when
+        # coming from separate pipeline objects.
+        if aug is None:
+            tta = 'none'
+        else:
+            tta = '{}:{}'.format(_describe(aug), 'fast' if fast else 'full')
+
+        prefix = _hashlib.blake2b(digest_size=16)
+        prefix.update(repr(self.version).encode())
+        prefix.update(tta.encode())
+        prefix.update(repr(sorted((k, repr(v)) for k, v in kwargs.items())).encode())
+        for X in Xs:
+            prefix.update('{}{}'.format(X.dtype.str, X.shape[1:]).encode())
+
+        keys = []
+        for i in range(Xs[0].shape[0]):
+            h = prefix.copy()
+            for X in Xs:
+                h.update(_np.ascontiguousarray(X[i]).data)
+            keys.append(h.digest())
+        return keys
+
+
+    def pred_epoch(self, X, aug=None, fast=False, batchsize=None, **kwargs):
+        """
+        Like `StreaMiniPredictor.pred_epoch`, but taking the predictions of
+        samples seen before from the cache.
+        """
+        Xs = _u.tuplize(X)
+        n = Xs[0].shape[0]
+        if n == 0:
+            return self.predictor.pred_epoch(X, aug=aug, fast=fast, batchsize=batchsize, **kwargs)
+        keys = self.keys(Xs, aug, fast, **kwargs)
+
+        # Find the misses, each distinct one only once.
+        found, todo = {}, _OrderedDict()
+        for i, k in enumerate(keys):
+            if k in found or k in todo:
+                continue
+            e = self._entries.get(k)
+            if e is None:
+                todo[k] = i
+            else:
+                self._entries.move_to_end(k)
+                found[k] = e
+
+        self.misses += len(todo)
+        self.hits += n - len(todo)
+
+        if todo:
+            idx = _np.fromiter(todo.values(), dtype=_np.intp, count=len(todo))
+            outs = _u.tuplize(self.predictor.pred_epoch(tuple(X[idx] for X in Xs), aug=aug, fast=fast, batchsize=batchsize, **kwargs))
+            assert all(o.shape[0] == len(idx) for o in outs), "CachedPredictor only works for outputs with one entry per sample."
+            for j, k in enumerate(todo):
+                found[k] = e = tuple(o[j].copy() for o in outs)
+                self._put(k, e)
+
+        # And merge all of them back in order.
+        first = found[keys[0]]
+        res = [_np.empty((n,) + o.shape, o.dtype) for o in first]
+        for i, k in enumerate(keys):
+            for r, o in zip(res, found[k]):
+                r[i] = o
+        return _u.maybetuple(res)
+
+
+    def _put(self, key, entry):
+        nbytes = sum(o.nbytes for o in entry)
+        if nbytes > self.maxbytes:
+            return
+
+        while self.nbytes + nbytes > self.maxbytes:
+            _, old = self._entries.popitem(last=False)
+            n = sum(o.nbytes for o in old)
+            self.nbytes -= n
+            self.evictions += 1
+            self.evicted_bytes += n
+
+        self._entries[key] = entry
+        self.nbytes += nbytes
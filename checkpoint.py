@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+A compact binary format for checkpointing training state, and functions for
+snapshotting and restoring lists of Theano shared variables.
+
+A checkpoint file consists of an 8-byte magic, the length of a UTF-8 encoded
+JSON header as little-endian uint64, the header itself, and the raw data of
+all arrays, each one aligned to `ALIGN` bytes. The header contains arbitrary
+JSON-serializable metadata and, for each entry, its name, kind, dtype, shape
+and offset into the file.
+
+Besides numpy arrays, the state of `np.random.RandomState`s can be stored
+too, which is what the random streams of e.g. dropout use.
+"""
+
+import json as _json
+import os as _os
+import struct as _struct
+import threading as _thr
+import numpy as _np
+
+
+MAGIC = b'DFCKPT\x00\x01'
+ALIGN = 64
+
+
+def _aligned(n):
+    return -(-n // ALIGN) * ALIGN
+
+
+def write(path, entries, meta=None):
+    """
+    Writes the `entries`, a list of `(name, value)` pairs where each value is
+    either a numpy array or a `RandomState`, along with the JSON-serializable
+    `meta` into the checkpoint file at `path`.
+
+    The file is first written under a temporary name and then renamed, such
+    that `path` always contains a complete checkpoint.
+    """
+    header = dict(meta=meta, entries=[])
+    datas = []
+    offset = 0
+    for name, val in entries:
+        e = dict(name=name)
+        if isinstance(val, _np.random.RandomState):
+            algo, keys, pos, has_gauss, cached = val.get_state()
+            e.update(kind='rng', algo=algo, pos=int(pos), has_gauss=int(has_gauss), cached=float(cached))
+            val = keys
+        else:
+            e.update(kind='array')
+        val = _np.require(val, requirements='C')
+        e.update(dtype=val.dtype.str, shape=val.shape, offset=offset, nbytes=val.nbytes)
+        header['entries'].append(e)
+        datas.append(val)
+        offset = _aligned(offset + val.nbytes)
+
+    head = _json.dumps(header).encode('utf-8')
+    start = _aligned(len(MAGIC) + 8 + len(head))
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(_struct.pack('<Q', len(head)))
+        f.write(head)
+        for e, val in zip(header['entries'], datas):
+            f.seek(start + e['offset'])
+            f.write(val.data)
+        f.flush()
+        _os.fsync(f.fileno())
+    _os.replace(tmp, path)
+
+
+def read(path):
+    """
+    Reads the checkpoint file at `path` and returns its entries, as a list of
+    `(name, value)` pairs, and its metadata.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a DeepFried checkpoint.".format(path))
+        n = _struct.unpack('<Q', f.read(8))[0]
+        header = _json.loads(f.read(n).decode('utf-8'))
+        start = _aligned(len(MAGIC) + 8 + n)
+
+        entries = []
+        for e in header['entries']:
+            val = _np.empty(e['shape'], dtype=_np.dtype(e['dtype']))
+            f.seek(start + e['offset'])
+            f.readinto(memoryview(val).cast('B'))
+            if e['kind'] == 'rng':
+                rng = _np.random.RandomState()
+                rng.set_state((e['algo'], val, e['pos'], e['has_gauss'], e['cached']))
+                val = rng
+            entries.append((e['name'], val))
+
+    return entries, header['meta']
+
+
+def copy_value(val):
+    """
+    Returns a copy of `val`, which is a numpy array or a `RandomState`.
+    """
+    if isinstance(val, _np.random.RandomState):
+        rng = _np.random.RandomState()
+        rng.set_state(val.get_state())
+        return rng
+    return _np.array(val, copy=True)
+
+
+def snapshot(variables):
+    """
+    Returns a list of `(name, value)` pairs with copies of the current values
+    of all shared `variables`, which can be written in the background while
+    training goes on.
+    """
+    return [(v.name, copy_value(v.get_value(borrow=True))) for v in variables]
+
+
+def restore(variables, entries):
+    """
+    Sets the values of the shared `variables` to those of the `entries` read
+    from a checkpoint, making sure they actually correspond to each other.
+    """
+    if len(variables) != len(entries):
+        raise ValueError("The checkpoint contains {} tensors but {} are needed; is it from a different model?".format(len(entries), len(variables)))
+
+    for v, (name, val) in zip(variables, entries):
+        cur = v.get_value(borrow=True)
+        if isinstance(cur, _np.random.RandomState) != isinstance(val, _np.random.RandomState) or \
+           (not isinstance(val, _np.random.RandomState) and cur.shape != val.shape):
+            raise ValueError("Checkpointed tensor '{}' doesn't match '{}'; is it from a different model?".format(name, v.name))
+
+    for v, (name, val) in zip(variables, entries):
+        v.set_value(copy_value(val) if isinstance(val, _np.random.RandomState) else val.astype(v.dtype, copy=False))
+
+
+def write_async(path, entries, meta=None, previous=None):
+    """
+    Starts writing the `entries` (which should be a `snapshot`) and `meta`
+    to `path` on a background thread and returns that thread.
+
+    If a `previous` such thread is given, it is waited for first so that
+    writes to the same file happen in order.
+    """
+    def work():
+        if previous is not None:
+            previous.join()
+        write(path, entries, meta)
+
+    th = _thr.Thread(target=work, name="DeepFried checkpoint " + path)
+    th.start()
+    return th
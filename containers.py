@@ -2,9 +2,11 @@
 
 import logging as _log
 
-from DeepFried.layers import Layer as _Layer
+from DeepFried.layers import Layer as _Layer, FullyConnected as _FullyConnected, dot as _dot
 import DeepFried.util as _u
 
+import theano.tensor as _T
+
 
 def _info(msg, *a, **kw):
     log = _log.getLogger(__name__)
@@ -115,6 +117,11 @@ class Sequence(_Layer):
         return self.layers[0].make_inputs(*names)
 
 
+    def prepare(self, *Xs):
+        """ The first layer is the one taking the inputs. """
+        return self.layers[0].prepare(*Xs)
+
+
     def train_expr(self, *Xs, **kw):
         """
         Concatenates the training expression of all layers one to another
@@ -134,6 +141,75 @@ class Sequence(_Layer):
         return Xs
 
 
+    def tap_path(self, tap):
+        """
+        Returns the path of indices to the layer identified by `tap`, which
+        is either an index into `layers`, a string of dot-separated indices
+        into nested `Sequence`s such as `'2.1'`, or the layer itself. The
+        strings may be followed by the layer's type, as in the names used by
+        `DeepFried.profiling` and `DeepFried.summary`, e.g. `'2.1 Conv2D'`,
+        which is then checked.
+        """
+        if isinstance(tap, _Layer):
+            for i, l in enumerate(self.layers):
+                if l is tap:
+                    return (i,)
+                if isinstance(l, Sequence):
+                    try:
+                        return (i,) + l.tap_path(tap)
+                    except ValueError:
+                        pass
+            raise ValueError("The layer {} is not part of this Sequence.".format(tap))
+
+        if isinstance(tap, str) and ' ' in tap:
+            tap, typename = tap.split(' ', 1)
+            path = self.tap_path(tap)
+            found = type(self.layer_at(tap)).__name__
+            if found != typename:
+                raise ValueError("The layer at {} is a {}, not a {}.".format(tap, found, typename))
+            return path
+
+        path = tuple(int(i) for i in tap.split('.')) if isinstance(tap, str) else (int(tap),)
+        head = path[0] % len(self.layers)
+        if len(path) == 1:
+            return (head,)
+        assert isinstance(self.layers[head], Sequence), "Can only tap into nested Sequences, not into {}.".format(type(self.layers[head]).__name__)
+        return (head,) + self.layers[head].tap_path('.'.join(map(str, path[1:])))
+
+
+    def layer_at(self, tap):
+        """ Returns the layer identified by `tap`, see `tap_path`. """
+        l = self
+        for i in self.tap_path(tap):
+            l = l.layers[i]
+        return l
+
+
+    def pred_taps(self, taps, *Xs):
+        """
+        Same as `pred_expr`, but additionally returns the prediction
+        expression(s) of each of the layers identified by `taps` (see
+        `tap_path`), computed along the way, as a list.
+        """
+        paths = [self.tap_path(t) for t in taps]
+        tapped = [None]*len(paths)
+
+        for i, l in enumerate(self.layers):
+            inner = [(j, p[1:]) for j, p in enumerate(paths) if p[0] == i and len(p) > 1]
+            if inner:
+                Xs, outs = l.pred_taps(['.'.join(map(str, p)) for _, p in inner], *_u.tuplize(Xs))
+                for (j, _), o in zip(inner, outs):
+                    tapped[j] = o
+            else:
+                Xs = l.pred_expr(*_u.tuplize(Xs))
+
+            for j, p in enumerate(paths):
+                if p == (i,):
+                    tapped[j] = Xs
+
+        return Xs, tapped
+
+
     def ensembler(self):
         """
         Uses the ensembler of the last (i.e. output) layer of the stack.
@@ -148,6 +224,24 @@ class Sequence(_Layer):
         return self.layers[-1].batch_agg()
 
 
+    def trainable_params(self):
+        """
+        Collects the trainable parameters of all contained layers, unless this
+        whole container is frozen, with their learning-rate factors
+        additionally multiplied by this container's `lr_mult`.
+        """
+        if not self.trainable:
+            return []
+        return [(p, self.lr_mult * m) for l in self.layers for p, m in l.trainable_params()]
+
+
+    def states(self):
+        """
+        Collects the states of all contained layers.
+        """
+        return list(_u.collect(l.states() for l in self.layers))
+
+
     def reinit(self, rng):
         """
         If `rng` is a seed number, we need to convert it into an rng here since
@@ -159,9 +253,46 @@ class Sequence(_Layer):
             l.reinit(rng)
 
 
+def _fc_head(layer):
+    """
+    Splits `layer` into its leading `FullyConnected` layer, if any, and the
+    layers following it, which is the case of a `FullyConnected` layer or a
+    `Sequence` starting with one.
+    """
+    if type(layer) is _FullyConnected:
+        return layer, []
+    if isinstance(layer, Sequence) and layer.layers and type(layer.layers[0]) is _FullyConnected:
+        return layer.layers[0], layer.layers[1:]
+    return None, [layer]
+
+
+def _fused_fc(fcs, X):
+    """
+    Computes the outputs of all `FullyConnected` layers `fcs`, which take
+    the same input `X`, with a single dot-product of `X` and their weights
+    concatenated along the columns, then split back up.
+    """
+    if len(fcs[0].inshape) > 1:
+        X = X.flatten(2)
+
+    out = _dot(X, _T.concatenate([fc.W for fc in fcs], axis=1))
+
+    outs, start = [], 0
+    for fc in fcs:
+        end = start + int(fc.W_shape[1])
+        o = out[:, start:end]
+        if hasattr(fc, "b"):
+            o += fc.b
+        if len(fc.outshape) > 1:
+            o = o.reshape((X.shape[0],) + fc.outshape)
+        outs.append(o)
+        start = end
+    return outs
+
+
 class Parallel(_Layer):
 
-    def __init__(self, *layers):
+    def __init__(self, *layers, fuse=False):
         """
         Constructs a layer composed of all passed `layers` using this layer's
         input (i.e. all the same input) but each having their own output.
@@ -169,10 +300,21 @@ class Parallel(_Layer):
         This is what you could use, for a multi-output at the top of a network,
         for instance.
 
+        If `fuse` is true, all contained `FullyConnected` layers (or ones
+        leading a contained `Sequence`) of the same `inshape` are computed as
+        a single wide matrix-product instead of many narrow ones. Their
+        parameters stay separate and are only concatenated within the
+        expressions, so optimizers and initializers don't notice, but that
+        copies all their weights on every call, so whether it's faster
+        depends on the model and batchsize; `python -m DeepFried.bench
+        branches` measures it.
+
         **NOTE** that this doesn't do any initialization wiring!
         """
         super(Parallel, self).__init__()
 
+        self.fuse = fuse
+
         self.layers = []
 
         # These collect all contained layers' params
@@ -226,12 +368,20 @@ class Parallel(_Layer):
         return ins
 
 
+    def prepare(self, *Xs):
+        """
+        Like `make_inputs`, this uses the first contained layer, since all
+        of them take the same inputs.
+        """
+        return self.layers[0].prepare(*Xs)
+
+
     def train_expr(self, X, **kw):
         """
         Returns the training expressions of all contained layers, since each
         contained layer contributes to an output.
         """
-        return _u.collect(l.train_expr(X, **kw) for l in self.layers)
+        return self._exprs('train_expr', X, **kw)
 
 
     def pred_expr(self, X):
@@ -239,7 +389,38 @@ class Parallel(_Layer):
         Returns the prediction expressions of all contained layers, since each
         contained layer contributes to an output.
         """
-        return _u.collect(l.pred_expr(X) for l in self.layers)
+        return self._exprs('pred_expr', X)
+
+
+    def _exprs(self, method, X, **kw):
+        outs = [None]*len(self.layers)
+
+        if self.fuse:
+            groups = {}
+            for i, l in enumerate(self.layers):
+                fc, _ = _fc_head(l)
+                if fc is not None:
+                    groups.setdefault(fc.inshape, []).append(i)
+
+            for idx in groups.values():
+                if len(idx) < 2:
+                    continue
+                heads = [_fc_head(self.layers[i]) for i in idx]
+                for i, (_, rest), H in zip(idx, heads, _fused_fc([fc for fc, _ in heads], X)):
+                    for l in rest:
+                        H = getattr(l, method)(*_u.tuplize(H), **kw)
+                    outs[i] = H
+
+        for i, l in enumerate(self.layers):
+            if outs[i] is None:
+                outs[i] = getattr(l, method)(X, **kw)
+
+        return _u.collect(outs)
+
+
+    def config(self):
+        """ See the documentation of `Layer`. """
+        return dict(fuse=self.fuse)
 
 
     def ensembler(self):
@@ -258,6 +439,24 @@ class Parallel(_Layer):
         return _u.collect(l.batch_agg() for l in self.layers)
 
 
+    def trainable_params(self):
+        """
+        Collects the trainable parameters of all contained layers, unless this
+        whole container is frozen, with their learning-rate factors
+        additionally multiplied by this container's `lr_mult`.
+        """
+        if not self.trainable:
+            return []
+        return [(p, self.lr_mult * m) for l in self.layers for p, m in l.trainable_params()]
+
+
+    def states(self):
+        """
+        Collects the states of all contained layers.
+        """
+        return list(_u.collect(l.states() for l in self.layers))
+
+
     def reinit(self, rng):
         """
         If `rng` is a seed number, we need to convert it into an rng here since
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+A serving format for trained models, which many predictor processes can load
+at once without each of them holding its own copy of the weights:
+
+    export(model, 'model/')       # After training.
+
+    model = load('model/')        # In each serving process.
+    pred = StreaMiniPredictor(64, model)
+
+The directory contains one raw file per array of the model's state (its
+parameters and e.g. batch-normalization statistics) and a `manifest.json`
+describing the structure of the model: the type and `config` of each layer,
+nested as in the containers, along with the dtype, shape and file of each of
+its states. Loading memory-maps the files read-only and binds them to the
+layers without copying, such that all processes share the same pages of the
+operating system's page cache, and loading is nearly instant.
+
+Random number generators' states aren't exported, as prediction doesn't
+need them.
+"""
+
+import importlib as _importlib
+import json as _json
+import os as _os
+import numpy as _np
+
+import DeepFried.layers as _l
+
+
+MANIFEST = 'manifest.json'
+VERSION = 1
+
+
+def _qualname(layer):
+    return type(layer).__module__ + ':' + type(layer).__qualname__
+
+
+def _lookup(qualname):
+    module, name = qualname.split(':')
+    return getattr(_importlib.import_module(module), name)
+
+
+def _jsonable(o):
+    if isinstance(o, _np.integer):
+        return int(o)
+    if isinstance(o, _np.floating):
+        return float(o)
+    raise TypeError("Can't export {!r} of type {}.".format(o, type(o).__name__))
+
+
+def _arrays(layer):
+    """ The states of `layer` which are arrays, i.e. not random generators. """
+    return [s for s in layer.states() if isinstance(s.get_value(borrow=True), _np.ndarray)]
+
+
+def _describe(layer, directory, path):
+    """
+    Writes the states of `layer` into `directory` and returns its entry of
+    the manifest.
+    """
+    entry = dict(type=_qualname(layer))
+
+    entry['config'] = layer.config()
+    if hasattr(layer, 'layers'):
+        entry['layers'] = [_describe(l, directory, path + (str(i),)) for i, l in enumerate(layer.layers)]
+        return entry
+
+    entry['states'] = []
+    for i, s in enumerate(_arrays(layer)):
+        val = s.get_value(borrow=True)
+        fname = '.'.join(path + (str(i), s.name or 'state')) + '.bin'
+        tmp = _os.path.join(directory, fname + '.tmp')
+        _np.ascontiguousarray(val).tofile(tmp)
+        _os.replace(tmp, _os.path.join(directory, fname))
+        entry['states'].append(dict(file=fname, dtype=val.dtype.str, shape=val.shape))
+    return entry
+
+
+def export(model, directory):
+    """
+    Exports `model` into `directory`, creating it if needed.
+    """
+    _os.makedirs(directory, exist_ok=True)
+    manifest = dict(version=VERSION, model=_describe(model, directory, ()))
+
+    # The manifest comes last and atomically, such that a directory with a
+    # manifest always contains a complete model.
+    tmp = _os.path.join(directory, MANIFEST + '.tmp')
+    with open(tmp, 'w') as f:
+        _json.dump(manifest, f, indent=2, default=_jsonable)
+    _os.replace(tmp, _os.path.join(directory, MANIFEST))
+
+
+def _build(entry, directory, mode):
+    cls = _lookup(entry['type'])
+
+    # JSON has no tuples, but the layers' constructors expect them.
+    config = {k: tuple(v) if isinstance(v, list) else v for k, v in entry['config'].items()}
+
+    if 'layers' in entry:
+        return cls(*(_build(e, directory, mode) for e in entry['layers']), **config)
+
+    # The states are bound to the files right after, so don't allocate and
+    # initialize them first, as that's the whole model in every process.
+    with _l.uninitialized():
+        layer = cls(**config)
+
+    states = _arrays(layer)
+    assert len(states) == len(entry['states']), "The {} layer has {} states, but {} were exported.".format(cls.__name__, len(states), len(entry['states']))
+    for s, e in zip(states, entry['states']):
+        val = _np.memmap(_os.path.join(directory, e['file']), dtype=e['dtype'], mode=mode, shape=tuple(e['shape']))
+        s.set_value(val, borrow=True)
+    return layer
+
+
+def load(directory, mode='r'):
+    """
+    Loads the model exported into `directory`, with all of its states
+    memory-mapped from their files. With the default `mode` of `'r'`, they
+    are read-only, which is all prediction needs; any other mode of
+    `np.memmap` may be passed, e.g. `'c'` for copy-on-write.
+    """
+    with open(_os.path.join(directory, MANIFEST)) as f:
+        manifest = _json.load(f)
+    assert manifest['version'] == VERSION, "Unknown export version {} in {}.".format(manifest['version'], directory)
+    return _build(manifest['model'], directory, mode)
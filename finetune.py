@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Fine-tuning the top of a model whose bottom stays frozen, without running the
+frozen layers over the training data again in every epoch:
+
+    ft = FrozenPrefix(model, 4)                  # Freeze model.layers[:4].
+    feats = ft.cache(X, 'feats.npy', passes=5)   # Once, into a memmap.
+    opt = ft.optimizer(StreaMiniMomentum, 128, cost, momentum=0.9)
+    for e in range(nepochs):
+        opt.fit_epoch(feats[e], t, lrate=0.01, shuf=rng)
+
+    pred = StreaMiniPredictor(128, model)        # Still the whole model.
+
+The prefix's outputs are computed once per pass over the data and stored,
+typically in a memory-mapped `.npy` file when they don't fit into memory. The
+optimizer is built over the suffix of the model only, which shares its layers
+(and thus parameters) with the full model.
+
+Layers of the prefix which are stochastic during training, such as `Dropout`,
+would be deterministic in the prefix's prediction expression. For keeping
+their regularizing effect, cache multiple `passes`, each computed with the
+prefix's training expression and thus different noise, and use a different
+one in each epoch.
+"""
+
+import DeepFried.containers as _c
+import DeepFried.util as _u
+
+import numpy as _np
+import theano as _th
+import theano.tensor as _T
+
+
+class FeatureStore(object):
+    """
+    The cached outputs of a frozen prefix, as returned by
+    `FrozenPrefix.cache`. `store[e]` are the features to train epoch `e` on,
+    cycling through the `passes`, `store.features` all of them, stacked as
+    `(passes, N, ...)`.
+    """
+
+
+    def __init__(self, features):
+        self.features = features
+
+
+    @property
+    def passes(self):
+        return self.features.shape[0]
+
+
+    def __len__(self):
+        return self.features.shape[1]
+
+
+    def __getitem__(self, epoch):
+        return self.features[epoch % self.passes]
+
+
+class _Suffix(_c.Sequence):
+    """
+    The trainable part of a `FrozenPrefix`, whose inputs are the prefix's
+    outputs rather than what its first layer would usually take.
+    """
+
+
+    def __init__(self, frozen):
+        super(_Suffix, self).__init__()
+        self.frozen = frozen
+
+
+    def make_inputs(self, *names):
+        return self.frozen.make_inputs(*names)
+
+
+class FrozenPrefix(object):
+    """
+    Splits the `Sequence` `model` into a frozen prefix, the first `split`
+    layers, and a trainable `suffix`, the remaining ones, each a `Sequence`
+    of the very same layer objects.
+    """
+
+
+    def __init__(self, model, split):
+        assert isinstance(model, _c.Sequence), "Only a Sequence can be split into a frozen prefix and the rest."
+        assert 0 < split < len(model.layers), "Need at least one layer on each side of the split, not {} of {}.".format(split, len(model.layers))
+
+        self.model = model
+        self.split = split
+
+        # Without wiring initializers anew, which already happened in `model`.
+        self.prefix = _c.Sequence()
+        self.suffix = _Suffix(self)
+        for l in model.layers[:split]:
+            self.prefix.append(l, init_previous=0)
+        for l in model.layers[split:]:
+            self.suffix.append(l, init_previous=0)
+
+        self._fns = {}
+
+
+    def _fn(self, stochastic):
+        if stochastic not in self._fns:
+            Xs = _u.tuplize(self.prefix.make_inputs())
+            if stochastic:
+                # Layers' statistics updates (e.g. batch-normalization's)
+                # are not collected, the prefix stays frozen.
+                out = self.prefix.train_expr(*Xs, fwd_updates=[], fin_updates=[])
+            else:
+                out = self.prefix.pred_expr(*Xs)
+            assert not isinstance(out, tuple), "Only prefixes with a single output can be cached."
+            self._fns[stochastic] = _th.function(Xs, out, name="FrozenPrefix " + ("train" if stochastic else "pred"))
+        return self._fns[stochastic]
+
+
+    def cache(self, X, path=None, passes=1, stochastic=None, aug=None, batchsize=128):
+        """
+        Computes the prefix's outputs for all samples in `X` and returns them
+        as a `FeatureStore`.
+
+        - `path`: If given, the features are written into a memory-mapped
+            `.npy` file there, which can be opened again using
+            `np.load(path, mmap_mode='r')`. Otherwise, they're kept in memory.
+        - `passes`: How many times to go through `X`.
+        - `stochastic`: Whether to use the prefix's training expression, with
+            e.g. dropout noise, instead of the prediction expression. Defaults
+            to doing so when caching more than one pass.
+        - `aug`: An optional augmentation pipeline applied to each pass's
+            minibatches with `augbatch_train`. It must not change the order
+            of samples.
+        - `batchsize`: The size of the minibatches to compute them in.
+        """
+        if stochastic is None:
+            stochastic = passes > 1
+
+        Xs = _u.tuplize(X)
+        N = Xs[0].shape[0]
+        fn = self._fn(stochastic)
+
+        feats = None
+        for k in range(passes):
+            start = 0
+            for bxs in _u.batched(batchsize, *Xs):
+                bxs = _u.tuplize(bxs)
+                if aug is not None:
+                    assert len(bxs) == 1, "Augmentation with multiple inputs not implemented yet. Please open an issue describing the use-case!"
+                    bxs = (aug.augbatch_train(bxs[0])[0],)
+
+                out = fn(*_u.tuplize(self.prefix.prepare(*bxs)))
+
+                # Only now is the shape of the features known.
+                if feats is None:
+                    shape = (passes, N) + out.shape[1:]
+                    if path is None:
+                        feats = _np.empty(shape, out.dtype)
+                    else:
+                        feats = _np.lib.format.open_memmap(path, mode='w+', dtype=out.dtype, shape=shape)
+
+                feats[k, start:start+len(out)] = out
+                start += len(out)
+
+        if isinstance(feats, _np.memmap):
+            feats.flush()
+        return FeatureStore(feats)
+
+
+    def make_inputs(self, name="Xin"):
+        """
+        The inputs of the suffix, which are of the dimensionality of the
+        prefix's output rather than what the suffix's first layer would
+        usually take.
+        """
+        out = self.prefix.pred_expr(*_u.tuplize(self.prefix.make_inputs()))
+        return _T.TensorType(out.dtype, (False,)*out.ndim)(name)
+
+
+    def optimizer(self, cls, batchsize, cost, *args, **kwargs):
+        """
+        Returns the optimizer `cls(batchsize, suffix, cost, *args, **kwargs)`
+        for training the suffix on the cached features.
+        """
+        return cls(batchsize, self.suffix, cost, *args, **kwargs)
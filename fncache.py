@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+An on-disk cache of compiled Theano functions, which saves the time spent in
+graph optimization and compilation when building the same model again, for
+example when restarting a server or running many jobs of a sweep:
+
+    cache = FunctionCache('~/.cache/deepfried')
+    opt = StreaMiniMomentum(128, model, cost, momentum=0.9, fncache=cache)
+    pred = StreaMiniPredictor(128, model, fncache=cache)
+    print(cache.report())
+
+Functions are keyed by the structure of what they compute, not the values of
+the parameters: the model's layer types and parameter shapes, the function's
+symbolic graph (which contains the optimizer's update rule and all
+hyperparameters which are baked into it), the defaults of its inputs, the
+types and shapes of all shared variables, floatX and the Theano version. A
+cached function is loaded with its optimized graph as-is and then rebound to
+the shared variables (model parameters, optimizer state, random streams) of
+the new model.
+"""
+
+import DeepFried.util as _u
+
+import hashlib as _hashlib
+import os as _os
+import pickle as _pickle
+import tempfile as _tempfile
+import time as _time
+import numpy as _np
+import theano as _th
+from theano.compile.sharedvalue import SharedVariable as _SharedVariable
+
+
+def describe(model):
+    """
+    Returns a string describing the structure of `model`: the type of each
+    layer, nested within the containers, and the shapes and dtypes of its
+    parameters.
+    """
+    if hasattr(model, 'layers'):
+        return '{}[{}]'.format(type(model).__name__, ', '.join(describe(l) for l in model.layers))
+    params = ', '.join('{}{}'.format(p.dtype, p.get_value(borrow=True).shape) for p in model.params)
+    return '{}({})'.format(type(model).__name__, params)
+
+
+def _shared_vars(outputs, updates):
+    """
+    Returns all shared variables which a function computing `outputs` and
+    `updates` uses, including the ones updated by default, in an order which
+    only depends on the structure of the graph.
+    """
+    found = []
+    todo = list(outputs) + [u for _, u in updates] + [v for v, _ in updates]
+    while todo:
+        new = [v for v in _th.gof.graph.inputs(todo) if isinstance(v, _SharedVariable) and v not in found]
+        found.extend(new)
+        todo = [v.default_update for v in new if getattr(v, 'default_update', None) is not None]
+    return found
+
+
+def _blank(v):
+    """ An empty value of the same type as the shared variable `v`'s one. """
+    val = v.get_value(borrow=True)
+    if not isinstance(val, _np.ndarray):
+        return val
+    return _np.zeros(tuple(1 if b else 0 for b in v.broadcastable), dtype=val.dtype)
+
+
+class FunctionCache(object):
+    """
+    Compiles functions just like `theano.function`, storing them in
+    `directory` and loading them from there the next time the same function
+    is asked for.
+
+    `records` holds one dict per function asked for, containing its `name`,
+    its `key`, whether it was `loaded`, the seconds it takes to compile it
+    (`compile_seconds`, as measured when it was stored) and, if loaded, the
+    seconds loading it took (`load_seconds`).
+    """
+
+
+    def __init__(self, directory):
+        self.directory = _os.path.expanduser(directory)
+        _os.makedirs(self.directory, exist_ok=True)
+        self.records = []
+
+
+    def key(self, inputs, outputs=(), updates=(), name=None, model=None, **kw):
+        """
+        Returns the key under which the function compiled from these
+        arguments is cached, see the module documentation.
+        """
+        outs = [getattr(o, 'variable', o) for o in outputs]
+        h = _hashlib.sha256()
+        for part in (
+            _th.__version__, _th.config.floatX, name, sorted(kw.items()),
+            describe(model) if model is not None else None,
+            [(type(i).__name__, str(getattr(i, 'variable', i).type)) for i in inputs],
+            # The defaults of `theano.Param`/`In` inputs are baked into the
+            # compiled function, e.g. an optimizer's momentum.
+            [(repr(getattr(i, 'value', getattr(i, 'default', None))), getattr(i, 'mutable', None), getattr(i, 'borrow', None)) for i in inputs],
+            [getattr(o, 'borrow', None) for o in outputs],
+            _th.printing.debugprint(outs + [u for _, u in updates], file='str', print_type=True),
+            [(str(v.type), getattr(v.get_value(borrow=True), 'shape', None)) for v in _shared_vars(outs, updates)],
+        ):
+            h.update(repr(part).encode())
+        return h.hexdigest()
+
+
+    def function(self, inputs, outputs=None, updates=None, name=None, model=None, **kw):
+        """
+        Returns the function `theano.function(inputs, outputs, updates, name,
+        **kw)` would, loading it from the cache if possible and storing it
+        there otherwise. Pass the `model` for its structure to be part of
+        the key.
+        """
+        inputs = list(inputs)
+        outputs = list(_u.tuplize(outputs, tuplize_none=True))
+        updates = list(updates or [])
+
+        key = self.key(inputs, outputs, updates, name, model, **kw)
+        path = _os.path.join(self.directory, key + '.pkl')
+        shared = _shared_vars([getattr(o, 'variable', o) for o in outputs], updates)
+
+        if _os.path.exists(path):
+            t0 = _time.perf_counter()
+            fn, compile_seconds = self._load(path, shared, name)
+            self.records.append(dict(name=name, key=key, loaded=True, compile_seconds=compile_seconds, load_seconds=_time.perf_counter() - t0))
+            return fn
+
+        t0 = _time.perf_counter()
+        fn = _th.function(inputs, outputs if outputs else None, updates=updates, name=name, **kw)
+        compile_seconds = _time.perf_counter() - t0
+        self._store(path, fn, shared, compile_seconds)
+        self.records.append(dict(name=name, key=key, loaded=False, compile_seconds=compile_seconds, load_seconds=None))
+        return fn
+
+
+    def _store(self, path, fn, shared, compile_seconds):
+        # Where each shared variable of the function is in the canonical
+        # order, for rebinding them when loading.
+        fnshared = [i.variable for i in fn.maker.inputs if isinstance(i.variable, _SharedVariable)]
+        positions = [shared.index(v) for v in fnshared]
+
+        # The values of shared variables are pickled along, but not needed,
+        # so don't waste disk space on copies of the model's parameters.
+        olds = [v.container.storage[0] for v in fnshared]
+        try:
+            for v in fnshared:
+                v.container.storage[0] = _blank(v)
+            data = _pickle.dumps((positions, compile_seconds, fn), protocol=_pickle.HIGHEST_PROTOCOL)
+        finally:
+            for v, old in zip(fnshared, olds):
+                v.container.storage[0] = old
+
+        # Write atomically, in case of concurrent jobs using the same cache.
+        fd, tmp = _tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with _os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        _os.replace(tmp, path)
+
+
+    def _load(self, path, shared, name):
+        with open(path, 'rb') as f, _th.configparser.change_flags(unpickle_function=True, reoptimize_unpickled_function=False):
+            positions, compile_seconds, fn = _pickle.load(f)
+
+        fnshared = [i.variable for i in fn.maker.inputs if isinstance(i.variable, _SharedVariable)]
+        assert len(fnshared) == len(positions), "Corrupt function cache entry " + path
+
+        # Some types, like the random streams' one, are singletons which
+        # only compare equal to themselves, but unpickle as new instances.
+        types = {v.type: shared[i].type for v, i in zip(fnshared, positions)
+                 if v.type != shared[i].type and type(v.type) is type(shared[i].type)}
+        for v in list(fn.maker.fgraph.variables) + fnshared:
+            v.type = types.get(v.type, v.type)
+
+        fn = fn.copy(swap={v: shared[i] for v, i in zip(fnshared, positions)}, name=name)
+        return fn, compile_seconds
+
+
+    def report(self):
+        """
+        Returns the compile and load times of all functions as a
+        human-readable table.
+        """
+        lines = ["{:<36} {:>8} {:>12} {:>12}".format("function", "cached", "compile [s]", "load [s]")]
+        for r in self.records:
+            lines.append("{:<36} {:>8} {:>12.3f} {:>12}".format(
+                str(r['name'])[:36], "yes" if r['loaded'] else "no", r['compile_seconds'],
+                "{:.3f}".format(r['load_seconds']) if r['loaded'] else "-"))
+        return "\n".join(lines)
@@ -3,10 +3,14 @@
 import numpy as _np
 import theano as _th
 import theano.tensor as _T
+import theano.sparse as _S
 import numbers as _num
 import logging as _log
+import threading as _thr
+import contextlib as _contextlib
 
 import DeepFried.util as _u
+import DeepFried.checkpoint as _ckpt
 
 
 def _info(msg, *a, **kw):
@@ -14,6 +18,79 @@ def _info(msg, *a, **kw):
     log.info(msg.format(*a, **kw))
 
 
+# Whether layers being constructed in this thread skip initializing their
+# parameters, see `uninitialized`.
+_noinit = _thr.local()
+
+
+@_contextlib.contextmanager
+def uninitialized():
+    """
+    Within this context, layers constructed in the current thread get empty
+    placeholders as the values of their parameters instead of computing
+    their initial values, for when the values are bound right after anyway,
+    as `DeepFried.export.load` does with its memory-mapped files. The
+    initializers are registered as usual, so `reinit` still works.
+    """
+    old = getattr(_noinit, 'active', False)
+    _noinit.active = True
+    try:
+        yield
+    finally:
+        _noinit.active = old
+
+
+def dot(X, W):
+    """
+    The product of the minibatch `X` and the weights `W`, where `X` may also
+    be a `theano.sparse` matrix. The product with a sparse `X` only touches
+    its non-zeros, and so does the gradient wrt. `W`, which is the product
+    of `X`'s transpose and the output's gradient.
+    """
+    if isinstance(X.type, _S.SparseType):
+        return _S.structured_dot(X, W)
+    return _T.dot(X, W)
+
+
+def _fmix64(h):
+    """ The finalizer of MurmurHash3, which mixes all bits of `h`. """
+    h = h ^ (h >> _np.uint64(33))
+    h = h * _np.uint64(0xff51afd7ed558ccd)
+    h = h ^ (h >> _np.uint64(33))
+    h = h * _np.uint64(0xc4ceb9fe1a85ec53)
+    return h ^ (h >> _np.uint64(33))
+
+
+def hash64(X, seed=0):
+    """
+    Returns a well-mixed 64-bit hash of each entry of the array `X` as an
+    array of `uint64` of the same shape, which doesn't change across runs
+    (unlike Python's `hash` of strings). `X` may contain integers or strings,
+    including Python objects which are hashed as their string.
+
+    This is vectorized over all entries; strings are hashed one character
+    position at a time, ignoring the padding of numpy's fixed-width strings.
+    """
+    X = _np.asarray(X)
+    if X.dtype.kind == 'O':
+        X = X.astype('U')
+
+    h = _np.full(X.shape, _fmix64(_np.uint64(seed) + _np.uint64(0x9e3779b97f4a7c15)), dtype=_np.uint64)
+
+    if X.dtype.kind in 'US':
+        width = X.dtype.itemsize // (4 if X.dtype.kind == 'U' else 1)
+        codes = _np.ascontiguousarray(X).view(_np.uint32 if X.dtype.kind == 'U' else _np.uint8).reshape(X.shape + (width,))
+        for i in range(width):
+            c = codes[..., i].astype(_np.uint64)
+            h = _np.where(c != 0, (h ^ c) * _np.uint64(0x100000001b3), h)
+    elif X.dtype.kind in 'iub':
+        h = h ^ X.astype(_np.int64).view(_np.uint64)
+    else:
+        raise TypeError("Can only hash integer or string IDs, not {}.".format(X.dtype))
+
+    return _fmix64(h)
+
+
 class Layer(object):
     """
     Abstract superclass of all layers with a dual purpose:
@@ -59,6 +136,14 @@ class Layer(object):
         # This contains the initializers to be used for each parameter.
         self.inits = {}
 
+        # Whether optimizers should learn this layer's parameters at all, and
+        # a factor to scale their learning-rate with, see `trainable_params`.
+        self.trainable = True
+        self.lr_mult = 1
+
+        # The thread currently writing a checkpoint in the background, if any.
+        self.ckpt_thread = None
+
 
     def train_expr(self, *Xs, **kw):
         """
@@ -100,6 +185,44 @@ class Layer(object):
         return _T.matrix(name)
 
 
+    def prepare(self, *Xs):
+        """
+        Returns the numpy minibatch(es) `Xs` turned into what the inputs
+        created by `make_inputs` take. This is called by the optimizers and
+        predictors on every minibatch, after augmentation, right before
+        passing it to the compiled functions.
+
+        Defaults to returning them as-is, which is what most layers need.
+        """
+        return _u.maybetuple(Xs)
+
+
+    def analyze(self, inshape):
+        """
+        Returns the shape of this layer's output for an input of shape
+        `inshape`, both excluding the minibatch dimension, along with the
+        rough number of floating-point operations per sample needed for the
+        training and the prediction expressions, respectively.
+
+        This is what `DeepFried.summary` is built on. The default fits any
+        element-wise layer.
+        """
+        n = int(_np.prod(inshape))
+        return inshape, n, n
+
+
+    def config(self):
+        """
+        Returns a JSON-serializable dict of the keyword arguments which
+        construct a layer of the same structure as this one, i.e. the same
+        hyperparameters and parameter shapes, but not values.
+
+        This is what `DeepFried.export` is built on. The default fits any
+        layer whose constructor doesn't take arguments.
+        """
+        return {}
+
+
     def newweight(self, *args, **kwargs):
         """
         Creates a new shared weight parameter variable called `name` and of
@@ -139,6 +262,8 @@ class Layer(object):
 
         if val is None and init is None:
             init = lambda shape, *a, **kw: _np.full(shape, _np.nan, dtype=_th.config.floatX)
+        elif val is None:
+            pass  # Use the given initializer.
         elif isinstance(val, _np.ndarray):
             init = lambda *a, **kw: val
         elif isinstance(val, _num.Real):
@@ -150,7 +275,12 @@ class Layer(object):
         else:
             raise ValueError("Couldn't understand parameters for parameter creation.")
 
-        p = _th.shared(init(shape).astype(_th.config.floatX), name=name)
+        if getattr(_noinit, 'active', False):
+            val = _np.empty((0,)*len(shape), dtype=_th.config.floatX)
+        else:
+            val = init(shape).astype(_th.config.floatX)
+
+        p = _th.shared(val, name=name)
         self.params.append(p)
         self.inits[p] = init
         return p
@@ -176,6 +306,77 @@ class Layer(object):
             p.set_value(self.inits[p](p.get_value().shape, rng, **kw).astype(p.dtype))
 
 
+    def freeze(self, *params):
+        """
+        Stops optimizers from learning the given `params` of this layer, or
+        all of its parameters if none are given. This needs to be done before
+        creating the optimizer.
+        """
+        if not params:
+            self.trainable = False
+        for p in params:
+            p._df_trainable = False
+
+
+    def unfreeze(self, *params):
+        """ Undoes `freeze` for the same arguments. """
+        if not params:
+            self.trainable = True
+        for p in params:
+            p._df_trainable = True
+
+
+    def trainable_params(self):
+        """
+        Returns a list of `(param, lr_mult)` pairs of all parameters which
+        optimizers should learn, along with the factor to multiply the
+        learning-rate for that parameter with.
+
+        A parameter is trainable if its layer is (see `freeze`) and it doesn't
+        have a false `_df_trainable` attribute. The factor is the layer's
+        `lr_mult` times the parameter's `_df_lr_mult` attribute, if any.
+        """
+        if not self.trainable:
+            return []
+        return [(p, self.lr_mult * getattr(p, '_df_lr_mult', 1))
+                for p in self.params if getattr(p, '_df_trainable', True)]
+
+
+    def states(self):
+        """
+        Returns a list of all shared variables making up the state of this
+        layer, that is its parameters followed by any additional state which
+        isn't learned by the optimizers, such as running statistics.
+
+        This is what gets written by `checkpoint`.
+        """
+        return list(self.params)
+
+
+    def checkpoint(self, path, background=False):
+        """
+        Writes all of this layer's `states` to the checkpoint file at `path`.
+
+        If `background` is true, a copy of the state is taken and written on
+        a background thread, which is returned and stored in `ckpt_thread`.
+        """
+        snap = _ckpt.snapshot(self.states())
+        if background:
+            self.ckpt_thread = _ckpt.write_async(path, snap, previous=self.ckpt_thread)
+            return self.ckpt_thread
+        else:
+            _ckpt.write(path, snap)
+
+
+    def resume(self, path):
+        """
+        Restores all of this layer's `states` from the checkpoint file at
+        `path`, as written by `checkpoint`.
+        """
+        entries, _ = _ckpt.read(path)
+        _ckpt.restore(self.states(), entries)
+
+
     def batch_agg(self):
         """
         Returns a function which can be used for aggregating the outputs of
@@ -252,7 +453,7 @@ class FullyConnected(Layer):
     """
 
 
-    def __init__(self, inshape, outshape, bias=True, W=None, b=None):
+    def __init__(self, inshape, outshape, bias=True, W=None, b=None, sparse=False):
         """
         Creates a fully-connected (i.e. linear, hidden) layer taking as input
         a minibatch of `inshape`-shaped elements and giving as output a
@@ -269,11 +470,18 @@ class FullyConnected(Layer):
                   term is useless.
         - `W`: Optional initial value for the weights.
         - `b`: Optional initial value for the bias.
+        - `sparse`: Whether the input is a sparse matrix, i.e. minibatches
+                    are given as `scipy.sparse` CSR matrices. This is much
+                    faster for inputs which are mostly zeros, for both
+                    the forward and the backward pass.
         """
         super(FullyConnected, self).__init__()
 
         self.inshape = _u.tuplize(inshape)
         self.outshape = _u.tuplize(outshape)
+        self.sparse = sparse
+
+        assert not sparse or len(self.inshape) == 1, "Sparse inputs can only be vectors, not of shape {}.".format(self.inshape)
 
         fan_in = _np.prod(self.inshape)
         fan_out = _np.prod(self.outshape)
@@ -287,7 +495,14 @@ class FullyConnected(Layer):
             self.b = self.newbias("b_fc", self.b_shape, b)
 
 
+    def config(self):
+        """ See the documentation of `Layer`. """
+        return dict(inshape=self.inshape, outshape=self.outshape, bias=hasattr(self, "b"), sparse=self.sparse)
+
+
     def make_inputs(self, name="Xin"):
+        if self.sparse:
+            return _S.csr_matrix(name, dtype=_th.config.floatX)
         return _T.TensorType(_th.config.floatX, (False,)*(1+len(self.inshape)))(name)
 
 
@@ -299,7 +514,7 @@ class FullyConnected(Layer):
             # (Don't forget the first dimension is the minibatch!)
             X = X.flatten(2)
 
-        out = _T.dot(X, self.W)
+        out = dot(X, self.W)
 
         if hasattr(self, "b"):
             out += self.b
@@ -312,6 +527,135 @@ class FullyConnected(Layer):
         return out
 
 
+    def analyze(self, inshape):
+        """ See the documentation of `Layer`. """
+        fan_in, fan_out = self.W_shape
+        flops = 2*fan_in*fan_out + (fan_out if hasattr(self, "b") else 0)
+        return self.outshape, flops, flops
+
+
+class Embedding(Layer):
+    """
+    A lookup table of learned vectors, one per categorical ID, such as words.
+    This computes the same as a `FullyConnected` layer without bias on
+    one-hot inputs, but much more cheaply: the input is the integer IDs.
+
+    The optimizers recognize the table and only update the rows of it which
+    were looked up in a minibatch, see `StreaMiniOptimizer`.
+    """
+
+
+    def __init__(self, nvocab, ndim, inshape=(), W=None, std=None):
+        """
+        - `nvocab`: The number of distinct IDs, which are `0..nvocab-1`.
+        - `ndim`: The dimensionality of the vectors.
+        - `inshape`: The shape of the IDs per sample, excluding the leading
+                     minibatch dimension. The default is a single ID per
+                     sample; the output has the shape `inshape + (ndim,)`.
+        - `W`: Optional initial value for the table.
+        - `std`: The standard deviation of the normally distributed initial
+                 vectors, defaulting to `1/sqrt(ndim)`. The table isn't
+                 initialized by other layers, and not part of `Ws`, so
+                 weight-decay doesn't apply to it either.
+        """
+        super(Embedding, self).__init__()
+
+        self.nvocab = nvocab
+        self.ndim = ndim
+        self.inshape = _u.tuplize(inshape)
+        self.std = std
+
+        def init(shape, rng=None, *a, **kw):
+            return _u.check_random_state(rng).normal(0, std or 1/_np.sqrt(ndim), size=shape)
+
+        self.W_shape = (nvocab, ndim)
+        self.W = self._newparam("W_emb", self.W_shape, W, init)
+        self.W._df_sparse_rows = True
+
+
+    def config(self):
+        """ See the documentation of `Layer`. """
+        return dict(nvocab=self.nvocab, ndim=self.ndim, inshape=self.inshape, std=self.std)
+
+
+    def make_inputs(self, name="Xin"):
+        return _T.TensorType('int32', (False,)*(1+len(self.inshape)))(name)
+
+
+    def train_expr(self, X, **kw):
+        # Looking up a vector of IDs is what optimizers recognize.
+        out = self.W[X.flatten()]
+        return out.reshape(_T.concatenate([X.shape, [self.ndim]]), ndim=X.ndim+1)
+
+
+    def analyze(self, inshape):
+        """ See the documentation of `Layer`. """
+        n = int(_np.prod(inshape))*self.ndim
+        return tuple(inshape) + (self.ndim,), n, n
+
+
+class HashedEmbedding(Embedding):
+    """
+    An `Embedding` of open-ended categorical IDs, such as arbitrary integers
+    or strings, using the "hashing trick": each ID is hashed into one of a
+    fixed number of buckets, each of which has a learned vector, which IDs
+    colliding in a bucket share.
+
+    With `signed` hashing, another bit of the hash decides whether the ID
+    uses its bucket's vector or its negation, which makes collisions cancel
+    out in expectation, see "Feature Hashing for Large Scale Multitask
+    Learning" by Weinberger et al.
+
+    The raw IDs are what is passed to the optimizers and predictors, which
+    hash each minibatch in `prepare` before passing the buckets on to the
+    compiled functions. Just like for `Embedding`, only the rows of buckets
+    in a minibatch are updated by the optimizers.
+    """
+
+
+    def __init__(self, nbuckets, ndim, inshape=(), signed=False, seed=0, W=None, std=None):
+        """
+        - `nbuckets`: The number of buckets to hash IDs into.
+        - `signed`: Whether to use signed hashing.
+        - `seed`: The seed of the hash function. Different ones give
+                  different collisions.
+
+        See `Embedding` for all others.
+        """
+        super(HashedEmbedding, self).__init__(nbuckets, ndim, inshape, W, std)
+
+        assert nbuckets < 2**31-1, "Can't use more than 2^31-2 buckets, not {}.".format(nbuckets)
+
+        self.nbuckets = nbuckets
+        self.signed = signed
+        self.seed = seed
+
+
+    def config(self):
+        """ See the documentation of `Layer`. """
+        return dict(nbuckets=self.nbuckets, ndim=self.ndim, inshape=self.inshape, signed=self.signed, seed=self.seed, std=self.std)
+
+
+    def prepare(self, X):
+        """
+        Hashes the IDs in `X` into buckets. For signed hashing, each bucket
+        `b` is passed on as `b+1` or `-(b+1)`, carrying the sign.
+        """
+        h = hash64(X, self.seed)
+        b = (h % _np.uint64(self.nbuckets)).astype(_np.int32)
+        if not self.signed:
+            return b
+        return _np.where(h >> _np.uint64(63), -(b+1), b+1).astype(_np.int32)
+
+
+    def train_expr(self, X, **kw):
+        if not self.signed:
+            return super(HashedEmbedding, self).train_expr(X)
+
+        out = super(HashedEmbedding, self).train_expr(abs(X) - 1)
+        return out * _T.cast(_T.sgn(X), out.dtype).dimshuffle(tuple(range(X.ndim)) + ('x',))
+
+
 class Softmax(Layer):
     """
     A softmax layer is commonly used as output layer in multi-class logistic
@@ -335,6 +679,13 @@ class Softmax(Layer):
         return _T.nnet.softmax(X)
 
 
+    def analyze(self, inshape):
+        """ See the documentation of `Layer`. """
+        # Max, subtraction, exponentiation, sum and division.
+        n = 5*int(_np.prod(inshape))
+        return inshape, n, n
+
+
     def weightinitializer(self):
         """ See the documentation of `Layer`. """
         def init(shape, rng, *a, **kw):
@@ -387,6 +738,11 @@ class ReLU(Layer):
         self.init = init
 
 
+    def config(self):
+        """ See the documentation of `Layer`. """
+        return dict(leak=self.leak, cap=self.cap, init=self.init)
+
+
     def train_expr(self, X, **kw):
         if self.cap is None:
             return _T.maximum(self.leak*X, X)
@@ -459,6 +815,11 @@ class Tanh(Layer):
         self.init = init
 
 
+    def config(self):
+        """ See the documentation of `Layer`. """
+        return dict(init=self.init)
+
+
     def train_expr(self, X, **kw):
         return _T.tanh(X)
 
@@ -522,6 +883,7 @@ class Sigmoid(Layer):
         """
         super(Sigmoid, self).__init__()
         self.init = init
+        self.alt = alt
         if alt is None:
             self.fn = _T.nnet.sigmoid
         elif alt == "ultrafast":
@@ -532,6 +894,11 @@ class Sigmoid(Layer):
             raise ValueError("Unknown alternative sigmoid formulation: " + repr(alt))
 
 
+    def config(self):
+        """ See the documentation of `Layer`. """
+        return dict(init=self.init, alt=self.alt)
+
+
     def train_expr(self, X, **kw):
         return self.fn(X)
 
@@ -574,10 +941,16 @@ class Dropout(Layer):
         # We need 1-p here since p is the probability of dropping out,
         # i.e. being multiplied by zero,
         # while binomial expects the probability of 1, i.e. keeping.
+        self.p = p
         self.p_keep = 1-p
         self.seed = self.srng = None
 
 
+    def config(self):
+        """ See the documentation of `Layer`. """
+        return dict(p=self.p)
+
+
     def reinit(self, rng):
         rng = _u.check_random_state(rng)
         self.seed = rng.randint(2**31)
@@ -598,6 +971,23 @@ class Dropout(Layer):
         return _u.maybetuple(x * self.p_keep for x in _u.tuplize(Xs))
 
 
+    def analyze(self, inshape):
+        """ See the documentation of `Layer`. """
+        # Drawing the mask and applying it vs. scaling.
+        n = int(_np.prod(inshape))
+        return inshape, 2*n, n
+
+
+    def states(self):
+        """
+        The states of the random number generators used in the training
+        expressions, which are needed for resuming training exactly.
+        """
+        if self.srng is None:
+            return []
+        return [rng for rng, _ in self.srng.state_updates]
+
+
 class BatchNormalization(Layer):
     """
     See Batch Normalization: Accelerating Deep Network Training by Reducing Internal Covariate Shift
@@ -652,6 +1042,11 @@ class BatchNormalization(Layer):
         self.pbeta = _th.shared(_nan, name="bn_pbeta")
 
 
+    def config(self):
+        """ See the documentation of `Layer`. """
+        return dict(nfeat=self._zero.shape, post=self.post, momentum=self.momentum, eps=self.eps)
+
+
     def train_expr(self, X, **kw):
 
         # The main difference for convolutional BN: also average over
@@ -749,6 +1144,22 @@ class BatchNormalization(Layer):
             return X * self.pgamma + self.pbeta
 
 
+    def analyze(self, inshape):
+        """ See the documentation of `Layer`. """
+        # Mean, variance, normalization and re-parametrization during
+        # training, vs. the single fused scale and shift for prediction.
+        n = int(_np.prod(inshape))
+        return inshape, 8*n, 2*n
+
+
+    def states(self):
+        """
+        Besides the parameters, the collected statistics and the parameters
+        used for prediction are part of the state.
+        """
+        return list(self.params) + [self.sum_means, self.sum_vars, self.pgamma, self.pbeta]
+
+
     def reinit(self, rng):
         """
         We need a custom reinit because we also need to reinit our running
@@ -827,6 +1238,13 @@ class Conv2D(Layer):
             self.b = self.newbias("b_conv", self.b_shape, b)
 
 
+    def config(self):
+        """ See the documentation of `Layer`. """
+        return dict(nconv=self.W_shape[0], convshape=self.W_shape[2:], imdepth=self.imdepth,
+                    imshape=self.imshape, stride=self.stride, border_mode=self.border_mode,
+                    bias=hasattr(self, "b"))
+
+
     def make_inputs(self, name="Xin"):
         if self.imshape is None:
             if self.imdepth > 1:
@@ -856,6 +1274,29 @@ class Conv2D(Layer):
         return out
 
 
+    def analyze(self, inshape):
+        """ See the documentation of `Layer`. """
+        if self.imshape is not None:
+            inshape = (self.imdepth,) + tuple(self.imshape)
+        elif self.imdepth == 1 and len(inshape) == 2:
+            inshape = (1,) + tuple(inshape)
+        _, h, w = inshape
+
+        nconv, depth, fh, fw = self.W_shape
+        if self.border_mode == 'full':
+            h, w = h + fh - 1, w + fw - 1
+        else:
+            h, w = h - fh + 1, w - fw + 1
+
+        # The full convolution is computed before subsampling it.
+        sh, sw = self.stride
+        outshape = (nconv, (h - 1)//sh + 1, (w - 1)//sw + 1)
+        flops = 2*nconv*depth*fh*fw*h*w
+        if hasattr(self, "b"):
+            flops += int(_np.prod(outshape))
+        return outshape, flops, flops
+
+
 class SpatialMaxPool(Layer):
     """
     Your local neighborhood's pool. Quite full during summer.
@@ -883,6 +1324,11 @@ class SpatialMaxPool(Layer):
         self.ignore_border = ignore_border
 
 
+    def config(self):
+        """ See the documentation of `Layer`. """
+        return dict(size=self.size, stride=self.stride, ignore_border=self.ignore_border)
+
+
     def make_inputs(self, name="Xin"):
         # Actually, this could be anything > 2D.
         return _T.tensor4(name)
@@ -890,3 +1336,17 @@ class SpatialMaxPool(Layer):
 
     def train_expr(self, X, **kw):
         return _T.signal.downsample.max_pool_2d(X, ds=self.size, ignore_border=self.ignore_border)
+
+
+    def analyze(self, inshape):
+        """ See the documentation of `Layer`. """
+        h, w = inshape[-2:]
+        ph, pw = self.size
+        if self.ignore_border:
+            h, w = h//ph, w//pw
+        else:
+            h, w = -(-h//ph), -(-w//pw)
+
+        # One comparison per input value.
+        n = int(_np.prod(inshape))
+        return tuple(inshape[:-2]) + (h, w), n, n
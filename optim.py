@@ -1,10 +1,204 @@
 #!/usr/bin/env python3
 
 import DeepFried.util as _u
+import DeepFried.checkpoint as _ckpt
+import DeepFried.profiling as _prof
 
+import itertools as _it
+from collections import OrderedDict as _OrderedDict
+from functools import partial as _partial
+import warnings as _warnings
 import numpy as _np
+import scipy.sparse as _sp
 import theano as _th
+import theano.sparse as _S
 import theano.tensor as _T
+from theano.tensor.extra_ops import Unique as _Unique
+
+
+class _QuantizedState(object):
+    """
+    Stores a tensor of optimizer state in blockwise-quantized 8-bit form:
+    the flattened tensor is cut into blocks of `blocksize` values, each of
+    which is stored as 8-bit integers along with one floatX scale, namely
+    the block's absolute maximum.
+
+    Non-negative state, such as the running squared gradients, is stored as
+    the quantized square-root, which spends the precision on the small values
+    where it matters most for dividing by.
+
+    It mimics the part of the interface of shared variables which is used
+    for (re)setting state: `get_value` and `set_value` with floatX values.
+    """
+
+
+    def __init__(self, val, name, nonneg=False, floor=None, blocksize=256, broadcastable=None):
+        self.name = name
+        self.shape = val.shape
+        self.size = val.size
+        self.nonneg = nonneg
+        self.floor = floor
+        self.blocksize = blocksize
+        self.broadcastable = broadcastable or (False,)*len(self.shape)
+
+        self.nblocks = -(-self.size // blocksize)
+        self.qmax = 255 if nonneg else 127
+
+        self.codes = _th.shared(_np.zeros((self.nblocks, blocksize), dtype='uint8' if nonneg else 'int8'), name=name+'_q')
+        self.scales = _th.shared(_np.zeros(self.nblocks, dtype=_th.config.floatX), name=name+'_s')
+        self.set_value(val)
+
+
+    def get_value(self, borrow=False):
+        blocks = self.codes.get_value(borrow=True) * self.scales.get_value(borrow=True)[:,None]
+        if self.nonneg:
+            blocks = blocks**2
+        val = blocks.ravel()[:self.size].reshape(self.shape).astype(_th.config.floatX)
+        return val if self.floor is None else _np.maximum(val, self.floor)
+
+
+    def set_value(self, val, borrow=False):
+        flat = _np.zeros(self.nblocks*self.blocksize, dtype=_th.config.floatX)
+        flat[:self.size] = _np.ravel(val)
+        blocks = flat.reshape(self.nblocks, self.blocksize)
+
+        if self.nonneg:
+            blocks = _np.sqrt(_np.maximum(blocks, 0))
+
+        scales = _np.max(_np.abs(blocks), axis=1) / self.qmax
+        codes = _np.round(blocks / _np.where(scales > 0, scales, 1)[:,None])
+
+        self.codes.set_value(codes.astype(self.codes.dtype))
+        self.scales.set_value(scales.astype(_th.config.floatX))
+
+
+    @property
+    def nbytes(self):
+        return self.codes.get_value(borrow=True).nbytes + self.scales.get_value(borrow=True).nbytes
+
+
+    def read(self):
+        """ Returns a floatX expression of the stored value. """
+        blocks = _T.cast(self.codes, _th.config.floatX) * self.scales.dimshuffle(0, 'x')
+        if self.nonneg:
+            blocks = blocks**2
+        val = blocks.flatten()[:self.size].reshape(self.shape)
+        if self.floor is not None:
+            val = _T.maximum(val, self.floor)
+        return _T.patternbroadcast(val, self.broadcastable)
+
+
+    def updates(self, expr):
+        """ Returns the updates which store the value of the floatX `expr`. """
+        flat = _T.zeros((self.nblocks*self.blocksize,), dtype=_th.config.floatX)
+        flat = _T.set_subtensor(flat[:self.size], expr.flatten())
+        blocks = flat.reshape((self.nblocks, self.blocksize))
+
+        if self.nonneg:
+            blocks = _T.sqrt(_T.maximum(blocks, 0))
+
+        scales = _T.max(abs(blocks), axis=1) / self.qmax
+        codes = _T.round(blocks / _T.switch(scales > 0, scales, 1).dimshuffle(0, 'x'))
+
+        # A single block would otherwise become broadcastable.
+        codes = _T.patternbroadcast(_T.cast(codes, self.codes.dtype), self.codes.broadcastable)
+        scales = _T.patternbroadcast(scales, self.scales.broadcastable)
+        return [(self.codes, codes), (self.scales, scales)]
+
+
+def _read_state(state):
+    """
+    Returns a floatX expression of the `state`, which is either a shared
+    variable of possibly reduced precision or a `_QuantizedState`.
+    """
+    if isinstance(state, _QuantizedState):
+        return state.read()
+    elif state.dtype != _th.config.floatX:
+        return _T.cast(state, _th.config.floatX)
+    return state
+
+
+def _scaled(x, mult):
+    """ Returns `x * mult`, or `x` itself for the common `mult` of one. """
+    return x if mult == 1 else x * _np.asarray(mult, dtype=_th.config.floatX)
+
+
+def _write_state(state, expr):
+    """
+    Returns the list of updates which store the floatX `expr` into `state`.
+    """
+    if isinstance(state, _QuantizedState):
+        return state.updates(expr)
+    elif state.dtype != _th.config.floatX:
+        return [(state, _T.cast(expr, state.dtype))]
+    return [(state, expr)]
+
+
+def _read_rows(state, rows):
+    """
+    Like `_read_state`, but only the given `rows` of it, or all of it for
+    `rows` of `None`.
+    """
+    if rows is None:
+        return _read_state(state)
+    elif isinstance(state, _QuantizedState):
+        return state.read()[rows]
+    return _read_state(state[rows])
+
+
+def _write_rows(state, rows, expr):
+    """
+    Like `_write_state`, but only writing the given `rows` of it, or all of
+    it for `rows` of `None`. Quantized state is still written as a whole.
+    """
+    if rows is None:
+        return _write_state(state, expr)
+    elif isinstance(state, _QuantizedState):
+        return state.updates(_T.set_subtensor(state.read()[rows], expr))
+    return [(state, _T.set_subtensor(state[rows], _T.cast(expr, state.dtype)))]
+
+
+def _python_loop_mode():
+    """
+    A mode in which the outer graph of a function runs in Python, which makes
+    a scan loop in Python around its inner function, itself still compiled
+    as usual.
+    """
+    return _th.Mode(linker=_th.gof.vm.VM_Linker(c_thunks=False), optimizer=_th.compile.mode.get_default_mode().optimizer)
+
+
+def _scan_mode():
+    """
+    Returns the mode to compile functions containing a scan with, `None` for
+    the default one. Theano only falls back to scan's Python loop when there
+    is no compiler at all, but building scan's Cython implementation fails on
+    some platforms, such as newer Pythons.
+    """
+    global _scan_c_error
+    if _scan_c_error is None:
+        try:
+            from theano.scan_module import scan_perform_ext
+            _scan_c_error = False
+        except ImportError:
+            _scan_c_error = False
+        except Exception as e:
+            _scan_c_error = e
+            _warnings.warn("Scan's C implementation can't be built, multi-step training loops in Python: {}".format(e))
+    return _python_loop_mode() if _scan_c_error else None
+
+
+_scan_c_error = None
+
+
+def _lookups(cost, p):
+    """
+    Returns the nodes looking up rows of `p` in the graph of `cost`, if
+    that's all `p` is used for, otherwise `None`.
+    """
+    nodes = [n for n in _th.gof.graph.io_toposort(_th.gof.graph.inputs([cost]), [cost]) if p in n.inputs]
+    if all(isinstance(n.op, _T.subtensor.AdvancedSubtensor1) and n.inputs == [p, n.inputs[1]] for n in nodes):
+        return nodes
+    return None
 
 
 class StreaMiniOptimizer(object):
@@ -17,8 +211,11 @@ class StreaMiniOptimizer(object):
     well as "infinite" data augmentation.
     """
 
+    # How many tensors of state mirroring the parameters the update rule uses.
+    nstates = 0
+
 
-    def __init__(self, batchsize, model, cost, extra_outs=None, Xnames=[], tnames=[]):
+    def __init__(self, batchsize, model, cost, extra_outs=None, Xnames=[], tnames=[], accumulate=1, state_dtype=None, state_blocksize=256, nsteps=1, profile=False, fncache=None):
         """
         Initializes the things that are common amongst all streaming minibatch
         optimizers.
@@ -32,6 +229,18 @@ class StreaMiniOptimizer(object):
                 output(s) of the model, during training, given symbolic model
                 input(s) `X`.
             - `params`: an iterable containing all trainable parameters.
+            - `trainable_params()`: a function which returns the parameters
+                to actually learn, each along with a factor for its
+                learning-rate, see `Layer.trainable_params`. Frozen
+                parameters get neither gradients nor optimizer state.
+            Parameters with a true `_df_sparse_rows` attribute, such as the
+            table of an `Embedding`, are updated row-sparsely: if the cost
+            only uses them by looking up rows, only those rows of them and
+            of their optimizer state are updated in each step. This is
+            exact for SGD and AdaGrad, while the decay of the momentum and
+            running averages of the other optimizers becomes lazy, i.e. only
+            happens for rows when they are looked up. It doesn't happen when
+            accumulating gradients or profiling.
         - `cost`: The cost. This should be an object with at least:
             - `make_target(name='')`: a function which returns a symbolic
                 variable of the correct dimensions for serving as target.
@@ -46,10 +255,64 @@ class StreaMiniOptimizer(object):
             that this must be exactly as many names as the model has inputs,
             then these names may be used as keyword arguments to `fit_epoch`.
         - `tnames`: The same as `Xnames`, but for target variables.
+        - `accumulate`: The number of minibatches whose gradients are summed
+            up before the optimizer's update rule is applied once using their
+            average. This allows for large effective batch sizes when memory
+            only allows for small minibatches. The default of 1 updates after
+            every minibatch.
+        - `state_dtype`: How to store the optimizer's state (such as momentum
+            or the running squared gradients) which mirrors the parameters.
+            It is always upcast to floatX for computing the updates.
+            - `None`: As floatX, i.e. just like the parameters (the default).
+            - `'float16'`: As half-precision floats.
+            - `'int8'`: Blockwise-quantized to 8 bits, with one floatX scale
+                per block of `state_blocksize` values.
+        - `nsteps`: If more than one, additionally compile a function which
+            does `nsteps` consecutive training steps on as many full
+            minibatches in a single call, by scanning over them. This saves
+            all per-minibatch Python overhead, which matters for small models.
+            Not used for sparse inputs.
+        - `profile`: If true, profile the compiled functions per layer of the
+            model into `self.profiler`, a `DeepFried.profiling.LayerProfile`.
+            This slows training down noticeably.
+        - `fncache`: An optional `DeepFried.fncache.FunctionCache` to load
+            the compiled functions from instead of compiling them, if this
+            model and optimizer were compiled before. Not used when profiling.
         """
         self.model = model
         self.cost = cost
         self.batchsize = batchsize
+        self.accumulate = accumulate
+        self.state_dtype = state_dtype
+        self.state_blocksize = state_blocksize
+
+        assert self.accumulate >= 1, "Can't accumulate gradients over {} minibatches.".format(self.accumulate)
+        assert self.state_dtype in (None, 'float16', 'int8'), "Unknown optimizer state dtype: " + repr(self.state_dtype)
+
+        self.nsteps = nsteps
+
+        # Set this to a `DeepFried.timing.PhaseTimer` to time epochs.
+        self.timer = None
+        assert self.nsteps == 1 or self.accumulate == 1, "Multi-step training can't be combined with gradient accumulation (yet)."
+
+        self.profiler = _prof.LayerProfile() if profile else None
+        self.fncache = fncache
+        assert self.nsteps == 1 or self.profiler is None, "Multi-step training can't be profiled per layer (yet)."
+
+        # All of the state tensors created by the specializations.
+        self.states = []
+
+        # Which parameters to learn, with their learning-rate factors.
+        trainable = list(self.model.trainable_params())
+        assert len(trainable), "The model doesn't have any trainable parameters."
+        self.params = [p for p, _ in trainable]
+        self.lr_mults = [m for _, m in trainable]
+
+        # Where we are in the current epoch, for checkpointing, and where to
+        # continue from after resuming from a checkpoint.
+        self._progress = dict(seed=None, batch=None, rng=None, costs=[], xtras=[])
+        self._resume = None
+        self.ckpt_thread = None
 
         self.Xs = _u.tuplize(self.model.make_inputs(*Xnames))
         self.targets = _u.tuplize(self.cost.make_target(*tnames))
@@ -60,26 +323,243 @@ class StreaMiniOptimizer(object):
         self.fwd_updates = []
         self.fin_updates = []
 
-        train_expr = _u.tuplize(self.model.train_expr(*self.Xs, fwd_updates=self.fwd_updates, fin_updates=self.fin_updates))
+        if self.profiler is None:
+            train_expr = self.model.train_expr(*self.Xs, fwd_updates=self.fwd_updates, fin_updates=self.fin_updates)
+        else:
+            train_expr = self.profiler.trace(self.model, self.model.train_expr, *self.Xs, fwd_updates=self.fwd_updates, fin_updates=self.fin_updates)
+        self.train_exprs = train_expr = _u.tuplize(train_expr)
         self.cost_expr = self.cost.out_expr(self.model, train_expr, self.targets)
         self.outs = (self.cost_expr,) + tuple(
             x.out_expr(self.model, train_expr, self.targets) for x in self.xtras
         )
 
 
+    def _mk_grads(self):
+        """
+        To be used by specializations only.
+
+        Returns the gradient expressions of the cost wrt. all of the model's
+        trainable parameters (`self.params`) which the update rule should be
+        written in terms of. Only the part of the backward pass which leads
+        to them is built.
+
+        For row-sparse parameters, the gradient is only that of the rows
+        looked up in the minibatch, and `self.rows` contains the expression
+        of the (unique) indices of these rows at the parameter's position,
+        `None` for all other parameters. Specializations should use
+        `_read_rows` and `_write_rows` with these for reading and writing
+        parameters and their state.
+
+        When accumulating, these are not the gradients themselves, but the
+        average of the gradients collected in the accumulators since the last
+        update, and the updates filling the accumulators are prepared.
+        """
+        self.rows = [None]*len(self.params)
+
+        if self.profiler is not None:
+            g = self.profiler.grads(self.cost_expr, self.params, self.train_exprs)
+        elif self.accumulate > 1:
+            g = _T.grad(cost=self.cost_expr, wrt=self.params)
+        else:
+            return self._mk_sparse_grads()
+
+        if self.accumulate == 1:
+            return g
+
+        # One accumulator per parameter, plus a counter of how many minibatches
+        # have been accumulated so far, which is not always `accumulate` for
+        # the last update of an epoch.
+        self.sh_gacc = [
+            _th.shared(_np.zeros_like(p.get_value()), broadcastable=p.broadcastable, name='gacc_'+p.name)
+            for p in self.params
+        ]
+        self.sh_nacc = _th.shared(_np.asarray(0, dtype=_th.config.floatX), name='nacc')
+
+        self._acc_updates = [(sh_a, sh_a + gp) for sh_a, gp in zip(self.sh_gacc, g)]
+        self._acc_updates.append((self.sh_nacc, self.sh_nacc + 1))
+
+        return [sh_a / self.sh_nacc for sh_a in self.sh_gacc]
+
+
+    def _mk_sparse_grads(self):
+        """
+        The part of `_mk_grads` for when not accumulating, which also does
+        the row-sparse gradients.
+        """
+        lookups = [_lookups(self.cost_expr, p) if getattr(p, '_df_sparse_rows', False) else None for p in self.params]
+
+        # All gradients at once, wrt. the looked-up rows instead of the
+        # whole parameter for the row-sparse ones.
+        wrt = [p if nodes is None else n.outputs[0] for p, nodes in zip(self.params, lookups) for n in (nodes or [None])]
+        allg = _T.grad(cost=self.cost_expr, wrt=wrt)
+
+        g = []
+        for i, (p, nodes) in enumerate(zip(self.params, lookups)):
+            if nodes is None:
+                g.append(allg.pop(0))
+                continue
+
+            gs = [allg.pop(0) for _ in nodes]
+            ids = _T.concatenate([n.inputs[1] for n in nodes]) if len(nodes) > 1 else nodes[0].inputs[1]
+            grows = _T.concatenate(gs) if len(gs) > 1 else gs[0]
+
+            # The same row may be looked up many times, whose gradients need
+            # to be summed up for updating each row only once.
+            self.rows[i], inv = _Unique(return_inverse=True)(ids)
+            zeros = _T.zeros((self.rows[i].shape[0],) + tuple(p.shape[k] for k in range(1, p.ndim)), dtype=p.dtype)
+            g.append(_T.inc_subtensor(zeros[inv], grows))
+
+        return g
+
+
+    def _mk_train_multi_fn(self, name, updates, extra_in=None, extra_out=None):
+        """
+        Compiles `fn_train_multi`, which takes all inputs and targets stacked
+        with an additional leading dimension of length `nsteps` and does one
+        training step on each of them in turn, returning the stacked outputs.
+        """
+        ins = self.Xs + self.targets
+        extra_in = _u.tuplize(extra_in, tuplize_none=True)
+        extra_vars = [getattr(x, 'variable', x) for x in extra_in]
+        outs = self.outs + _u.tuplize(extra_out, tuplize_none=True)
+        updates = updates + self.fwd_updates
+
+        # Random streams (e.g. of dropout) have default updates which depend
+        # on the input's shape, so they need to be cloned along, too.
+        updated = set(v for v, _ in updates)
+        for v in _th.gof.graph.inputs(list(outs) + [u for _, u in updates]):
+            if getattr(v, 'default_update', None) is not None and v not in updated:
+                updates = updates + [(v, v.default_update)]
+                updated.add(v)
+
+        stacked = [_T.TensorType(x.dtype, (False,) + x.broadcastable)(x.name + 's') for x in ins]
+
+        # The step rebuilds the full training graph for a single minibatch
+        # on the inner variables of the scan, and returns its updates for
+        # scan to carry them from one step to the next.
+        def step(*inner):
+            replace = dict(zip(ins + tuple(extra_vars), inner))
+            new = _th.clone(list(outs) + [u for _, u in updates], replace=replace)
+            return new[:len(outs)], _OrderedDict((v, u) for (v, _), u in zip(updates, new[len(outs):]))
+
+        steps_outs, steps_updates = _th.scan(step, sequences=stacked, non_sequences=extra_vars, n_steps=self.nsteps)
+
+        # Modes can't be part of the function cache's keys.
+        mode = _scan_mode()
+        function = self._function() if mode is None else _partial(_th.function, mode=mode)
+        self.fn_train_multi = function(
+            inputs=stacked + list(extra_in),
+            outputs=_u.tuplize(steps_outs),
+            updates=steps_updates,
+            name=name + " multi"
+        )
+
+
+    def _mk_state(self, p, val, name, nonneg=False, floor=None):
+        """
+        To be used by specializations only.
+
+        Creates the storage for a tensor of optimizer state mirroring the
+        parameter `p`, with initial floatX value `val`, in the format chosen
+        by `state_dtype`. Use `_read_state` and `_write_state` for using it
+        in update expressions.
+
+        - `nonneg`: Whether the state is never negative, which allows for a
+            more precise quantization.
+        - `floor`: An optional lower bound which reading the state will
+            enforce, for state which mustn't be quantized to zero.
+        """
+        if self.state_dtype is None:
+            state = _th.shared(val, broadcastable=p.broadcastable, name=name)
+        elif self.state_dtype == 'float16':
+            state = _th.shared(val.astype('float16'), broadcastable=p.broadcastable, name=name)
+        else:
+            state = _QuantizedState(val, name, nonneg=nonneg, floor=floor,
+                                    blocksize=self.state_blocksize, broadcastable=p.broadcastable)
+
+        self.states.append(state)
+        return state
+
+
+    def state_nbytes(self):
+        """
+        Returns the number of bytes used for storing the optimizer's state.
+        """
+        return sum(s.nbytes if isinstance(s, _QuantizedState) else s.get_value(borrow=True).nbytes for s in self.states)
+
+
+    @classmethod
+    def state_nbytes_for(cls, shapes, state_dtype=None, state_blocksize=256):
+        """
+        Returns the number of bytes this optimizer would use for storing its
+        state for parameters of the given `shapes`, without creating it.
+        """
+        itemsize = _np.dtype(_th.config.floatX).itemsize
+        nbytes = 0
+        for shape in shapes:
+            size = int(_np.prod(shape))
+            if state_dtype is None:
+                nbytes += size*itemsize
+            elif state_dtype == 'float16':
+                nbytes += size*2
+            else:
+                nblocks = -(-size // state_blocksize)
+                nbytes += nblocks*(state_blocksize + itemsize)
+        return cls.nstates*nbytes
+
+
+    def _function(self):
+        """ Returns what to compile functions with, `theano.function`-alike. """
+        if self.profiler is not None:
+            return self.profiler.function
+        if self.fncache is not None:
+            return _partial(self.fncache.function, model=self.model)
+        return _th.function
+
+
     def _mk_train_fn(self, name, updates, extra_in=None, extra_out=None):
         """ To be used by specializations only. """
-        self.fn_train = _th.function(
-            inputs=self.Xs + self.targets + _u.tuplize(extra_in, tuplize_none=True),
-            outputs=self.outs + _u.tuplize(extra_out, tuplize_none=True),
-            updates=updates + self.fwd_updates,
-            name=name
-        )
+        function = self._function()
+
+        if self.accumulate == 1:
+            self.fn_train = function(
+                inputs=self.Xs + self.targets + _u.tuplize(extra_in, tuplize_none=True),
+                outputs=self.outs + _u.tuplize(extra_out, tuplize_none=True),
+                updates=updates + self.fwd_updates,
+                name=name
+            )
+        else:
+            # The forward and backward passes only fill the accumulators, but
+            # layers' additional updates still need to happen for every
+            # minibatch, since they depend on the data.
+            self.fn_accum = function(
+                inputs=self.Xs + self.targets,
+                outputs=self.outs + _u.tuplize(extra_out, tuplize_none=True),
+                updates=self._acc_updates + self.fwd_updates,
+                name=name + " accumulate"
+            )
+
+            # While the actual update rule is applied from the accumulators
+            # only, which are then emptied for the next round.
+            resets = [(sh_a, _T.zeros_like(sh_a)) for sh_a in self.sh_gacc]
+            resets.append((self.sh_nacc, _T.zeros_like(self.sh_nacc)))
+            self.fn_apply = function(
+                inputs=_u.tuplize(extra_in, tuplize_none=True),
+                updates=updates + resets,
+                name=name + " apply"
+            )
+
+        # Sparse minibatches can't be stacked into blocks.
+        if any(isinstance(x.type, _S.SparseType) for x in self.Xs):
+            self.nsteps = 1
+
+        if self.nsteps > 1:
+            self._mk_train_multi_fn(name, updates, extra_in, extra_out)
 
         if len(self.fin_updates):
             # Because targets might or might not be used by the layers in the
             # extra update rules, we'll just allow for unused inputs.
-            self.fn_finalize = _th.function(
+            self.fn_finalize = function(
                 inputs=self.Xs + self.targets,
                 updates=self.fin_updates,
                 name=name + " finalize",
@@ -92,10 +572,89 @@ class StreaMiniOptimizer(object):
         This will reinitialize any state (such as momentum) that may be kept by
         this optimizer.
         """
-        pass
+        if self.accumulate > 1:
+            for sh_a in self.sh_gacc:
+                sh_a.set_value(_np.zeros_like(sh_a.get_value()))
+            self.sh_nacc.set_value(_np.asarray(0, dtype=_th.config.floatX))
+
+
+    def _state_vars(self):
+        """
+        All shared variables holding this optimizer's own state.
+        """
+        variables = []
+        for s in self.states:
+            variables += [s.codes, s.scales] if isinstance(s, _QuantizedState) else [s]
+        if self.accumulate > 1:
+            variables += self.sh_gacc + [self.sh_nacc]
+        return variables
+
+
+    def checkpoint(self, path, background=True):
+        """
+        Writes everything needed to resume training to the checkpoint file at
+        `path`: the model's states (parameters and e.g. BN statistics), this
+        optimizer's state, the state of the random number generators used for
+        shuffling and augmentation and, when called during an epoch, the
+        position within that epoch.
+
+        By default, a copy of the state is taken and written on a background
+        thread, which is returned and stored in `ckpt_thread`, such that
+        training doesn't need to wait for the disk.
+        """
+        progress = self._progress
+        variables = self.model.states() + self._state_vars()
+
+        entries = _ckpt.snapshot(variables)
+        entries.append(('np.random', _ckpt.copy_value(_np.random.mtrand._rand)))
+        if progress['rng'] is not None:
+            entries.append(('shuf', _ckpt.copy_value(progress['rng'])))
+        if progress['batch'] is not None:
+            entries.append(('costs', _np.array(progress['costs'])))
+            entries += [('xtras', _np.array(x)) for x in zip(*progress['xtras'])]
+
+        meta = dict(
+            nstates=len(variables),
+            seed=progress['seed'],
+            batch=progress['batch'],
+            shuf=progress['rng'] is not None,
+        )
+
+        if background:
+            self.ckpt_thread = _ckpt.write_async(path, entries, meta, previous=self.ckpt_thread)
+            return self.ckpt_thread
+        else:
+            _ckpt.write(path, entries, meta)
 
 
-    def fit_epoch(self, X, t, aug=None, batchsize=None, shuf=False, **kwargs):
+    def resume(self, path):
+        """
+        Restores everything from the checkpoint file at `path`, as written by
+        `checkpoint` of an optimizer for the same model.
+
+        If the checkpoint was taken in the middle of an epoch, the next call
+        to `fit_epoch` continues that epoch exactly where it was left off; it
+        needs to be called with the same data and arguments as the original.
+        """
+        if self.ckpt_thread is not None:
+            self.ckpt_thread.join()
+
+        entries, meta = _ckpt.read(path)
+        n = meta['nstates']
+
+        _ckpt.restore(self.model.states() + self._state_vars(), entries[:n])
+        _np.random.set_state(entries[n][1].get_state())
+
+        rest = entries[n+1:]
+        rng = rest.pop(0)[1] if meta['shuf'] else None
+
+        self._resume = dict(meta, rng=rng, entries=entries[:n])
+        if meta['batch'] is not None:
+            self._resume['costs'] = list(rest[0][1])
+            self._resume['xtras'] = [list(x) for x in zip(*(v for _, v in rest[1:]))]
+
+
+    def fit_epoch(self, X, t, aug=None, batchsize=None, shuf=False, ckpt=None, ckpt_every=None, **kwargs):
         """
         Trains the model for one full epoch by iterating through minibatches.
 
@@ -103,6 +662,7 @@ class StreaMiniOptimizer(object):
             The first dimension of an input should be the datapoints,
             i.e. X.shape[0] == ndata,
             and any remaining dimensions should fit the model's expected input shape(s).
+            For sparse inputs, use `scipy.sparse` CSR matrices instead.
         - `t`: The target values where the first dimension should be the
                datapoints, just like for `X`.
         - `aug`: An optional data augmentation pipeline that can transform each
@@ -110,14 +670,34 @@ class StreaMiniOptimizer(object):
         - `batchsize`: Optionally override the batchsize given at construction.
         - `shuf`: If not False, go through `X` and `t` in lockstep-random order.
                   Use `shuf` as rng or seed for the shuffling.
+        - `ckpt`: Path to a file to `checkpoint` to every `ckpt_every`
+                  minibatches during the epoch.
 
         Any remaining arguments will be passed on to the optimization function;
         this can be used to pass values such as learning-rate, momentum etc.
+
+        When accumulating gradients, the update is applied after every
+        `accumulate` minibatches and once more at the end of the epoch for
+        any left-over minibatches, so that no gradient leaks into the next
+        epoch.
         """
+        # When resuming from a checkpoint, the shuffling needs to continue
+        # from the checkpointed state of the random number generator, and
+        # when that checkpoint was taken mid-epoch, so does the epoch.
+        tm = self.timer
+        if tm is not None:
+            tm.start()
+
+        resume, self._resume = self._resume, None
+        skip = 0 if resume is None or resume['batch'] is None else resume['batch']
+
+        if resume is not None and resume['rng'] is not None and isinstance(shuf, _np.random.RandomState):
+            shuf.set_state(resume['rng'].get_state())
+
         self.model.pre_epoch()
 
-        costs = []
-        xtras = []
+        costs = resume['costs'] if skip else []
+        xtras = resume['xtras'] if skip else []
 
         # Sanitize inputs for more flexibility.
         Xs = _u.tuplize(X)
@@ -131,30 +711,74 @@ class StreaMiniOptimizer(object):
         # Keyword arguments for `batched`, for conciseness.
         if shuf is False:
             bxkw = btkw = {}
+            common_seed = None
         else:
-            common_seed = _u.check_random_state(shuf).randint(2**31)
+            common_seed = resume['seed'] if skip else _u.check_random_state(shuf).randint(2**31)
             bxkw = dict(shuf=_np.random.RandomState(common_seed))
             btkw = dict(shuf=_np.random.RandomState(common_seed))
 
+        self._progress = dict(
+            seed=common_seed, batch=len(costs), costs=costs, xtras=xtras,
+            rng=shuf if isinstance(shuf, _np.random.RandomState) else None,
+        )
+
+        if skip:
+            # Layers may count minibatches in their hooks, so replay them
+            # before restoring the state they had at the checkpoint.
+            for _ in range(skip):
+                self.model.pre_minibatch()
+                self.model.post_minibatch()
+            _ckpt.restore(self.model.states() + self._state_vars(), resume['entries'])
+
+        # Blocks of sparse minibatches can't be stacked.
+        if self.nsteps > 1 and not any(_sp.issparse(X) for X in Xs):
+            skip = self._fit_multi(Xs, ts, common_seed, skip, bs, aug, ckpt, ckpt_every, kwargs)
+
         # Go through the training in minibatches. Note that the last batch
         # may be smaller than the batchsize.
-        for bxs, bts in zip(_u.batched(bs, *Xs, **bxkw), _u.batched(bs, *ts, **btkw)):
+        batches = zip(_u.batched(bs, *Xs, **bxkw), _u.batched(bs, *ts, **btkw))
+        if tm is not None:
+            tm.lap('setup')
+
+        for bxs, bts in _it.islice(batches, skip, None):
             # Possibly need to re-tuplize them because `batched` tries to be
             # smart and not return a tuple if batching a single array.
             bxs = _u.tuplize(bxs)
             bts = _u.tuplize(bts)
 
+            if tm is not None:
+                tm.lap('gather')
+
             # Potentially generate a new augmentation on-the-fly.
             if aug is not None:
                 assert len(bxs) == 1, "Augmentation with multiple inputs not implemented yet. Please open an issue describing the use-case!"
                 bx, bts = aug.augbatch_train(bxs[0], *bts)
                 bxs = (bx,)
 
+                if tm is not None:
+                    tm.lap('augment')
+
+            # E.g. hashing IDs, see `Layer.prepare`.
+            bxs = _u.tuplize(self.model.prepare(*bxs))
+
             self.model.pre_minibatch()
 
-            # Uploads to the GPU, does the forward pass,
-            # the backward pass *and* the weight updates!
-            cost, *xtra = self.fn_train(*bxs+bts, **kwargs)
+            if tm is not None:
+                tm.lap('pre_minibatch')
+
+            if self.accumulate == 1:
+                # Uploads to the GPU, does the forward pass,
+                # the backward pass *and* the weight updates!
+                cost, *xtra = self.fn_train(*bxs+bts, **kwargs)
+            else:
+                # Only the forward and backward passes, the weight updates
+                # happen once enough gradients have been accumulated.
+                cost, *xtra = self.fn_accum(*bxs+bts)
+                if len(costs) % self.accumulate == self.accumulate - 1:
+                    self.fn_apply(**kwargs)
+
+            if tm is not None:
+                tm.lap('fn_train')
 
             # Collect stats over the batches, so we can aggregate.
             costs.append(cost)
@@ -162,13 +786,108 @@ class StreaMiniOptimizer(object):
 
             self.model.post_minibatch()
 
+            if tm is not None:
+                tm.lap('post_minibatch')
+
+            self._progress['batch'] = len(costs)
+            if ckpt_every is not None and len(costs) % ckpt_every == 0:
+                self.checkpoint(ckpt)
+
+                if tm is not None:
+                    tm.lap('checkpoint')
+
+        # Don't forget the gradients of the left-over minibatches.
+        if self.accumulate > 1 and len(costs) % self.accumulate != 0:
+            self.fn_apply(**kwargs)
+
         self.model.post_epoch()
 
+        self._progress = dict(self._progress, seed=None, batch=None, costs=[], xtras=[])
+
+        if tm is not None:
+            tm.lap('post_epoch')
+
         # Average the stats over the batches.
-        return _u.maybetuple((self.cost.aggregate_batches(costs),)
-                        + tuple(x.aggregate_batches(b) for x, b in zip(self.xtras, zip(*xtras))))
+        res = _u.maybetuple((self.cost.aggregate_batches(costs),)
+                       + tuple(x.aggregate_batches(b) for x, b in zip(self.xtras, zip(*xtras))))
         # The above zip transposes from minibatches of extras to extras of minibatches.
 
+        if tm is not None:
+            tm.lap('aggregate')
+            tm.stop('fit_epoch', N)
+
+        return res
+
+
+    def _fit_multi(self, Xs, ts, seed, start, bs, aug, ckpt, ckpt_every, kwargs):
+        """
+        Goes through as many blocks of `nsteps` full minibatches as possible,
+        starting at minibatch `start`, using one call of `fn_train_multi` each.
+        Returns the index of the first minibatch left to be done.
+
+        Layers' minibatch hooks are called `nsteps` times before and after
+        each block, since there's no way to call them in-between steps.
+        """
+        N = Xs[0].shape[0]
+        K = self.nsteps
+        costs = self._progress['costs']
+        xtras = self._progress['xtras']
+        tm = self.timer
+
+        # The exact same order as `batched` would go through.
+        indices = _np.arange(N)
+        if seed is not None:
+            _np.random.RandomState(seed).shuffle(indices)
+
+        i = start
+        while i + K <= N // bs:
+            idx = indices[i*bs:(i+K)*bs]
+            bxs = tuple(X[idx] for X in Xs)
+            bts = tuple(t[idx] for t in ts)
+
+            if tm is not None:
+                tm.lap('gather')
+
+            if aug is not None:
+                assert len(bxs) == 1, "Augmentation with multiple inputs not implemented yet. Please open an issue describing the use-case!"
+                bx, bts = aug.augbatch_train(bxs[0], *bts)
+                bxs = (bx,)
+
+                if tm is not None:
+                    tm.lap('augment')
+
+            bxs = _u.tuplize(self.model.prepare(*bxs))
+
+            for _ in range(K):
+                self.model.pre_minibatch()
+
+            if tm is not None:
+                tm.lap('pre_minibatch')
+
+            bcosts, *bxtras = self.fn_train_multi(*(x.reshape((K, bs) + x.shape[1:]) for x in bxs+bts), **kwargs)
+
+            if tm is not None:
+                tm.lap('fn_train')
+
+            for _ in range(K):
+                self.model.post_minibatch()
+
+            costs.extend(bcosts)
+            xtras.extend([x[k] for x in bxtras] for k in range(K))
+            i += K
+
+            if tm is not None:
+                tm.lap('post_minibatch')
+
+            self._progress['batch'] = len(costs)
+            if ckpt_every is not None and len(costs) // ckpt_every > (len(costs) - K) // ckpt_every:
+                self.checkpoint(ckpt)
+
+                if tm is not None:
+                    tm.lap('checkpoint')
+
+        return i
+
 
     def finalize(self, X, t, batchsize=None, aug=None, fast=False, **kwargs):
         """
@@ -183,23 +902,46 @@ class StreaMiniOptimizer(object):
             return
 
         bs = batchsize or self.batchsize
+        tm = self.timer
+        if tm is not None:
+            tm.start()
 
         # Ignore that one.
         kwargs.pop('shuf', None)
 
         self.model.pre_finalize()
         for bxs, bts in zip(_u.batched(bs, *_u.tuplize(X)), _u.batched(bs, *_u.tuplize(t))):
+            if tm is not None:
+                tm.lap('gather')
+
             if aug is not None:
                 for bxs_aug in aug.augbatch_pred(*_u.tuplize(bxs), fast=fast):
+                    if tm is not None:
+                        tm.lap('augment')
                     self.model.finalize_pre_minibatch()
-                    self.fn_finalize(*_u.tuplize(bxs_aug)+_u.tuplize(bts), **kwargs)
+                    if tm is not None:
+                        tm.lap('pre_minibatch')
+                    self.fn_finalize(*_u.tuplize(self.model.prepare(*_u.tuplize(bxs_aug)))+_u.tuplize(bts), **kwargs)
+                    if tm is not None:
+                        tm.lap('fn_finalize')
                     self.model.finalize_post_minibatch()
+                    if tm is not None:
+                        tm.lap('post_minibatch')
             else:
                 self.model.finalize_pre_minibatch()
-                self.fn_finalize(*_u.tuplize(bxs)+_u.tuplize(bts), **kwargs)
+                if tm is not None:
+                    tm.lap('pre_minibatch')
+                self.fn_finalize(*_u.tuplize(self.model.prepare(*_u.tuplize(bxs)))+_u.tuplize(bts), **kwargs)
+                if tm is not None:
+                    tm.lap('fn_finalize')
                 self.model.finalize_post_minibatch()
+                if tm is not None:
+                    tm.lap('post_minibatch')
         self.model.post_finalize()
 
+        if tm is not None:
+            tm.stop('finalize', _u.tuplize(X)[0].shape[0])
+
 
 class StreaMiniSGD(StreaMiniOptimizer):
     """
@@ -221,10 +963,14 @@ class StreaMiniSGD(StreaMiniOptimizer):
 
         self.sh_learningrate = _T.scalar('lrate')
 
-        g = _T.grad(cost=self.cost_expr, wrt=self.model.params)
+        g = self._mk_grads()
+
+        updates = []
+        for sh_p, gp, m, rows in zip(self.params, g, self.lr_mults, self.rows):
+            updates += _write_rows(sh_p, rows, _read_rows(sh_p, rows) - _scaled(self.sh_learningrate, m) * gp)
 
         self._mk_train_fn("StreaMiniSGD train",
-            [(p, p - self.sh_learningrate * gp) for p, gp in zip(self.model.params, g)],
+            updates,
             extra_in=self.sh_learningrate)
 
 
@@ -259,6 +1005,8 @@ class StreaMiniMomentum(StreaMiniOptimizer):
     - `momentum`: The momentum, defaulting to the one passed at construction.
     """
 
+    nstates = 1
+
     def __init__(self, batchsize, model, cost, momentum, nesterov=False, *args, **kwargs):
         """
         See `StreaMiniOptimizer` for details on the arguments.
@@ -277,21 +1025,23 @@ class StreaMiniMomentum(StreaMiniOptimizer):
         # For momentum, we need a "mirror" of each parameter, which keeps track
         # of the "velocity" of that parameter during training.
         self.sh_v = [
-            _th.shared(_np.zeros_like(p.get_value()), broadcastable=p.broadcastable, name='v_'+p.name)
-            for p in model.params
+            self._mk_state(p, _np.zeros_like(p.get_value()), name='v_'+p.name)
+            for p in self.params
         ]
 
-        g = _T.grad(cost=self.cost_expr, wrt=self.model.params)
+        g = self._mk_grads()
 
         updates = []
-        for sh_p, gp, sh_v in zip(self.model.params, g, self.sh_v):
-            v = self.sh_momentum * sh_v - self.sh_learningrate * gp
-            updates.append((sh_v, v))
+        for sh_p, gp, sh_v, m, rows in zip(self.params, g, self.sh_v, self.lr_mults, self.rows):
+            lr = _scaled(self.sh_learningrate, m)
+            v = self.sh_momentum * _read_rows(sh_v, rows) - lr * gp
+            updates += _write_rows(sh_v, rows, v)
 
+            p = _read_rows(sh_p, rows)
             if not nesterov:
-                updates.append((sh_p, sh_p + v))
+                updates += _write_rows(sh_p, rows, p + v)
             else:
-                updates.append((sh_p, sh_p + self.sh_momentum * v - self.sh_learningrate * gp))
+                updates += _write_rows(sh_p, rows, p + self.sh_momentum * v - lr * gp)
 
         self._mk_train_fn("StreaMiniMomentum train",
             updates,
@@ -300,6 +1050,7 @@ class StreaMiniMomentum(StreaMiniOptimizer):
 
 
     def reinit(self):
+        super(StreaMiniMomentum, self).reinit()
         for sh_v in self.sh_v:
             sh_v.set_value(_np.zeros_like(sh_v.get_value()))
 
@@ -328,6 +1079,8 @@ class StreaMiniAdaGrad(StreaMiniOptimizer):
     - `lrate`: The learning-rate.
     """
 
+    nstates = 1
+
     def __init__(self, batchsize, model, cost, eps=1e-5, *args, **kwargs):
         """
         See `StreaMiniOptimizer` for details on the arguments.
@@ -346,17 +1099,17 @@ class StreaMiniAdaGrad(StreaMiniOptimizer):
         # Edit: Matt Zeiler seems to agree cf. AdaDelta.
         self.eps = eps
         self.sh_g2 = [
-            _th.shared(_np.full_like(p.get_value(), eps), broadcastable=p.broadcastable, name='g2_'+p.name)
-            for p in model.params
+            self._mk_state(p, _np.full_like(p.get_value(), eps), name='g2_'+p.name, nonneg=True, floor=eps)
+            for p in self.params
         ]
 
-        g = _T.grad(cost=self.cost_expr, wrt=self.model.params)
+        g = self._mk_grads()
 
         updates = []
-        for sh_p, gp, sh_g2 in zip(self.model.params, g, self.sh_g2):
-            g2 = sh_g2 + gp*gp
-            updates.append((sh_g2, g2))
-            updates.append((sh_p, sh_p - self.sh_learningrate/_T.sqrt(g2) * gp))
+        for sh_p, gp, sh_g2, m, rows in zip(self.params, g, self.sh_g2, self.lr_mults, self.rows):
+            g2 = _read_rows(sh_g2, rows) + gp*gp
+            updates += _write_rows(sh_g2, rows, g2)
+            updates += _write_rows(sh_p, rows, _read_rows(sh_p, rows) - _scaled(self.sh_learningrate, m)/_T.sqrt(g2) * gp)
             # Instead of adding eps inside the square-root like most
             # implementations do, I just initialize `g2` to eps, that should
             # have the same effect, but cheaper.
@@ -368,6 +1121,7 @@ class StreaMiniAdaGrad(StreaMiniOptimizer):
 
 
     def reinit(self):
+        super(StreaMiniAdaGrad, self).reinit()
         for sh_g2 in self.sh_g2:
             sh_g2.set_value(_np.full_like(sh_g2.get_value(), self.eps))
 
@@ -394,6 +1148,8 @@ class StreaMiniRMSProp(StreaMiniOptimizer):
         one passed at construction.
     """
 
+    nstates = 1
+
     def __init__(self, batchsize, model, cost, rho=0.95, eps=1e-5, *args, **kwargs):
         """
         See `StreaMiniOptimizer` for details on the arguments.
@@ -409,17 +1165,17 @@ class StreaMiniRMSProp(StreaMiniOptimizer):
 
         # This too needs to accumulate the square gradient of each parameter.
         self.sh_g2 = [
-            _th.shared(_np.zeros_like(p.get_value()), broadcastable=p.broadcastable, name='g2_'+p.name)
-            for p in model.params
+            self._mk_state(p, _np.zeros_like(p.get_value()), name='g2_'+p.name, nonneg=True)
+            for p in self.params
         ]
 
-        g = _T.grad(cost=self.cost_expr, wrt=self.model.params)
+        g = self._mk_grads()
 
         updates = []
-        for sh_p, gp, sh_g2 in zip(self.model.params, g, self.sh_g2):
-            g2 = self.sh_rho*sh_g2 + (1-self.sh_rho)*gp*gp
-            updates.append((sh_g2, g2))
-            updates.append((sh_p, sh_p - self.sh_learningrate/_T.sqrt(eps+g2) * gp))
+        for sh_p, gp, sh_g2, m, rows in zip(self.params, g, self.sh_g2, self.lr_mults, self.rows):
+            g2 = self.sh_rho*_read_rows(sh_g2, rows) + (1-self.sh_rho)*gp*gp
+            updates += _write_rows(sh_g2, rows, g2)
+            updates += _write_rows(sh_p, rows, _read_rows(sh_p, rows) - _scaled(self.sh_learningrate, m)/_T.sqrt(eps+g2) * gp)
 
         self._mk_train_fn("StreaMiniRMSProp train",
             updates,
@@ -428,6 +1184,7 @@ class StreaMiniRMSProp(StreaMiniOptimizer):
 
 
     def reinit(self):
+        super(StreaMiniRMSProp, self).reinit()
         for sh_g2 in self.sh_g2:
             sh_g2.set_value(_np.zeros_like(sh_g2.get_value()))
 
@@ -453,8 +1210,13 @@ class StreaMiniAdaDelta(StreaMiniOptimizer):
     It turns out that the effective learning-rate will converge to 1 as the
     gradients decrease (and thus learning grinds to a halt). This could be used
     to check for convergence by a specialized trainer.
+
+    As there is no learning-rate, parameters' learning-rate factors (see
+    `Layer.trainable_params`) scale their updates instead.
     """
 
+    nstates = 2
+
     def __init__(self, batchsize, model, cost, rho=0.95, eps=1e-5, *args, **kwargs):
         """
         See `StreaMiniOptimizer` for details on the arguments.
@@ -474,27 +1236,28 @@ class StreaMiniAdaDelta(StreaMiniOptimizer):
         # each parameter, it just exponentially decays the old value,
         # effectively only summing over a recent window.
         self.sh_g2 = [
-            _th.shared(_np.zeros_like(p.get_value()), broadcastable=p.broadcastable, name='g2_'+p.name)
-            for p in model.params
+            self._mk_state(p, _np.zeros_like(p.get_value()), name='g2_'+p.name, nonneg=True)
+            for p in self.params
         ]
 
         # Similarly to momentum, AdaDelta accumulates previous update values.
         # This also happens in a decaying fashion, so as to cover a window.
         self.sh_delta2 = [
-            _th.shared(_np.zeros_like(p.get_value()), broadcastable=p.broadcastable, name='d2_'+p.name)
-            for p in model.params
+            self._mk_state(p, _np.zeros_like(p.get_value()), name='d2_'+p.name, nonneg=True)
+            for p in self.params
         ]
 
-        g = _T.grad(cost=self.cost_expr, wrt=self.model.params)
+        g = self._mk_grads()
 
         updates = []
-        for sh_p, gp, sh_g2, sh_d2 in zip(self.model.params, g, self.sh_g2, self.sh_delta2):
-            g2 = self.sh_rho*sh_g2 + (1-self.sh_rho)*gp*gp
-            up = _T.sqrt((sh_d2+eps) / (g2+eps)) * gp
-            d2 = self.sh_rho*sh_d2 + (1-self.sh_rho)*up*up
-            updates.append((sh_g2, g2))
-            updates.append((sh_p, sh_p - up))
-            updates.append((sh_d2, d2))
+        for sh_p, gp, sh_g2, sh_d2, m, rows in zip(self.params, g, self.sh_g2, self.sh_delta2, self.lr_mults, self.rows):
+            d2_prev = _read_rows(sh_d2, rows)
+            g2 = self.sh_rho*_read_rows(sh_g2, rows) + (1-self.sh_rho)*gp*gp
+            up = _T.sqrt((d2_prev+eps) / (g2+eps)) * gp
+            d2 = self.sh_rho*d2_prev + (1-self.sh_rho)*up*up
+            updates += _write_rows(sh_g2, rows, g2)
+            updates += _write_rows(sh_p, rows, _read_rows(sh_p, rows) - _scaled(up, m))
+            updates += _write_rows(sh_d2, rows, d2)
 
         self._mk_train_fn("StreaMiniAdaDelta train",
             updates,
@@ -503,6 +1266,7 @@ class StreaMiniAdaDelta(StreaMiniOptimizer):
 
 
     def reinit(self):
+        super(StreaMiniAdaDelta, self).reinit()
         for sh_g2 in self.sh_g2:
             sh_g2.set_value(_np.zeros_like(sh_g2.get_value()))
         for sh_delta2 in self.sh_delta2:
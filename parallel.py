@@ -0,0 +1,892 @@
+#!/usr/bin/env python3
+
+import DeepFried.util as _u
+
+import multiprocessing as _mp
+import threading as _thr
+import socket as _socket
+import socketserver as _socketserver
+import struct as _struct
+import json as _json
+import time as _time
+import os as _os
+import numpy as _np
+import theano as _th
+
+
+def _flat_views(buf, params, offset=0):
+    """
+    Returns a list of numpy arrays, one for each of the `params` and of
+    matching shape, which are views into the flat shared memory `buf`,
+    starting at element `offset`.
+    """
+    flat = _np.frombuffer(buf, dtype=_th.config.floatX)
+    views = []
+    for p in params:
+        shape = p.get_value(borrow=True).shape
+        n = int(_np.prod(shape))
+        views.append(flat[offset:offset+n].reshape(shape))
+        offset += n
+    return views
+
+
+class DataParallel(object):
+    """
+    Trains a model using any of the `StreaMiniOptimizer`s in multiple worker
+    processes on a single host, each one working on a part of every minibatch.
+
+    The optimizer is compiled once in this process, and workers are forked
+    at the start of each epoch, inheriting the compiled functions as well as
+    the data, which is thus never copied. Parameters and gradients are
+    exchanged through flat buffers in shared memory. Only the parameters
+    which the optimizer learns are exchanged, frozen ones never change.
+
+    There are three modes of operation:
+
+    - `'grads'`: Synchronous gradient averaging. Each worker computes the
+        gradient of its shard of the minibatch, these are averaged and the
+        optimizer's update rule is applied once, exactly as if the whole
+        minibatch had been processed by a single process.
+    - `'params'`: Synchronous parameter averaging. Each worker does a full
+        update step on its shard, after which the resulting parameters are
+        averaged, weighted by the size of the shards. Note that the optimizer state (e.g. momentum) is local to
+        each worker and lost at the end of the epoch.
+    - `'hogwild'`: Asynchronous, lock-free updates as in "Hogwild!". Each
+        worker does full update steps on its shards as fast as it can and adds
+        the change in parameters into the shared ones without any locking.
+        The same remark about optimizer state applies.
+
+    Layers' additional forward updates, such as batch-normalization's
+    statistics when not using `post`, happen within the workers and are
+    averaged across workers at the end of each epoch. Layers' minibatch hooks
+    are called in every worker, as well as in this process, around each
+    minibatch.
+
+    Gradient accumulation (the optimizer's `accumulate`) is not supported.
+    """
+
+
+    def __init__(self, nworkers, cls, batchsize, model, cost, *args, mode='grads', **kwargs):
+        """
+        Creates an optimizer of type `cls` using all of `batchsize`, `model`,
+        `cost`, `args` and `kwargs` and prepares it for data-parallel training
+        using `nworkers` processes.
+
+        - `nworkers`: The number of worker processes to use.
+        - `cls`: The `StreaMiniOptimizer` subclass to use.
+        - `batchsize`: The number of samples in a minibatch, i.e. the sum of
+            all workers' shards.
+        - `mode`: One of `'grads'`, `'params'` or `'hogwild'`, see above.
+        """
+        assert mode in ('grads', 'params', 'hogwild'), "Unknown data-parallel mode: " + repr(mode)
+        assert nworkers >= 1, "Need at least one worker."
+
+        self.nworkers = nworkers
+        self.mode = mode
+        self.model = model
+        self.batchsize = batchsize
+
+        assert kwargs.get('accumulate', 1) == 1, "Gradient accumulation can't be combined with data-parallel training (yet)."
+
+        # Any value above one makes the optimizer compile the separate
+        # accumulation and update functions, the actual count of gradients
+        # to average over is set by ourselves.
+        if mode == 'grads':
+            kwargs['accumulate'] = max(2, nworkers)
+
+        self.opt = cls(batchsize, model, cost, *args, **kwargs)
+
+        # The state which layers update on their own during training.
+        self._states = [v for v, _ in self.opt.fwd_updates]
+
+        self._ctx = _mp.get_context('fork')
+
+        n = sum(p.get_value(borrow=True).size for p in self.opt.params)
+        itemsize = _np.dtype(_th.config.floatX).itemsize
+
+        # One buffer with the current parameters, and one slot per worker for
+        # either their gradients or their parameters.
+        self._pbuf = self._ctx.RawArray('b', n*itemsize)
+        self._wbuf = self._ctx.RawArray('b', nworkers*n*itemsize)
+        self._pviews = _flat_views(self._pbuf, self.opt.params)
+        self._wviews = [_flat_views(self._wbuf, self.opt.params, w*n) for w in range(nworkers)]
+
+        # How many samples each worker processed in the last step.
+        self._counts = _np.frombuffer(self._ctx.RawArray('i', nworkers), dtype=_np.int32)
+
+        self.epoch_time = None
+        self.samples_per_sec = None
+
+
+    def reinit(self):
+        """ See `StreaMiniOptimizer.reinit`. """
+        self.opt.reinit()
+
+
+    def finalize(self, *args, **kwargs):
+        """ See `StreaMiniOptimizer.finalize`, this is not parallelized. """
+        return self.opt.finalize(*args, **kwargs)
+
+
+    def _put_params(self):
+        for v, p in zip(self._pviews, self.opt.params):
+            v[...] = p.get_value(borrow=True)
+
+
+    def _get_params(self, views):
+        for v, p in zip(views, self.opt.params):
+            p.set_value(v.copy())
+
+
+    def fit_epoch(self, X, t, aug=None, batchsize=None, shuf=False, **kwargs):
+        """
+        Trains the model for one full epoch, see `StreaMiniOptimizer.fit_epoch`
+        for the meaning of all arguments.
+
+        Each minibatch is split into `nworkers` contiguous shards, one per
+        worker. The wall-clock time and throughput of the epoch are stored
+        in `epoch_time` and `samples_per_sec`.
+        """
+        Xs = _u.tuplize(X)
+        ts = _u.tuplize(t)
+        bs = batchsize or self.batchsize
+        N = Xs[0].shape[0]
+
+        assert all(X.shape[0] == N for X in Xs), "All inputs to fit_epoch should contain the same amount of datapoints."
+        assert all(t.shape[0] == N for t in ts), "All targets to fit_epoch should contain the same amount of datapoints."
+
+        indices = _np.arange(N)
+        if shuf is not False:
+            _u.check_random_state(shuf).shuffle(indices)
+        batches = [indices[i:i+bs] for i in range(0, N, bs)]
+
+        # Forked workers all inherit the same random state, which would make
+        # their augmentations identical, so each one gets its own seed.
+        seed = _np.random.randint(2**31)
+
+        self.model.pre_epoch()
+        self._put_params()
+
+        sync = self.mode != 'hogwild'
+        barrier = self._ctx.Barrier(self.nworkers + 1) if sync else None
+        results = self._ctx.Queue()
+
+        procs = [
+            self._ctx.Process(target=self._work, args=(w, batches, Xs, ts, aug, seed + w, barrier, results, kwargs))
+            for w in range(self.nworkers)
+        ]
+
+        t0 = _time.time()
+        for p in procs:
+            p.start()
+
+        try:
+            for _ in batches:
+                self.model.pre_minibatch()
+                if sync:
+                    # Let the workers go on the current parameters and
+                    # wait for all of them to be done with their shard.
+                    barrier.wait()
+                    barrier.wait()
+                    self._reduce(**kwargs)
+                self.model.post_minibatch()
+
+            outs = dict(results.get() for _ in procs)
+            if any(o is None for o in outs.values()):
+                raise RuntimeError("A data-parallel worker failed, see its traceback above.")
+        except _thr.BrokenBarrierError:
+            for p in procs:
+                p.terminate()
+            raise RuntimeError("A data-parallel worker failed, see its traceback above.")
+        finally:
+            for p in procs:
+                p.join()
+
+        self.epoch_time = _time.time() - t0
+        self.samples_per_sec = N / self.epoch_time
+
+        if self.mode == 'hogwild':
+            self._get_params(self._pviews)
+
+        # Average the layers' states over the workers.
+        for i, v in enumerate(self._states):
+            v.set_value(sum(outs[w][1][i] for w in outs) / len(outs))
+
+        self.model.post_epoch()
+
+        # Aggregate the stats over all shards of all minibatches.
+        stats = [s for w in sorted(outs) for s in outs[w][0]]
+        costs = [s[0] for s in stats]
+        xtras = [s[1:] for s in stats]
+        return _u.maybetuple((self.opt.cost.aggregate_batches(costs),)
+                        + tuple(x.aggregate_batches(b) for x, b in zip(self.opt.xtras, zip(*xtras))))
+
+
+    def _reduce(self, **kwargs):
+        """
+        Executed in the master process once all workers are done with the
+        current minibatch, combining their results into new parameters.
+        """
+        busy = [w for w in range(self.nworkers) if self._counts[w] > 0]
+
+        # Shards differ in size when the minibatch doesn't split evenly, so
+        # each worker's mean counts as much as the samples it's over.
+        counts = {w: int(self._counts[w]) for w in busy}
+        total = sum(counts.values())
+
+        if self.mode == 'grads':
+            for i, sh_a in enumerate(self.opt.sh_gacc):
+                sh_a.set_value(sum(counts[w]*self._wviews[w][i] for w in busy))
+            self.opt.sh_nacc.set_value(_np.asarray(total, dtype=_th.config.floatX))
+            self.opt.fn_apply(**kwargs)
+        else:
+            for i, p in enumerate(self.opt.params):
+                p.set_value(sum(counts[w]*self._wviews[w][i] for w in busy) / total)
+
+        self._put_params()
+
+
+    def _work(self, w, batches, Xs, ts, aug, seed, barrier, results, kwargs):
+        """
+        The main loop of worker `w`, executed in the forked process.
+        """
+        _np.random.seed(seed % 2**32)
+
+        stats = []
+        try:
+            for b in batches:
+                shard = _np.array_split(b, self.nworkers)[w]
+
+                if barrier is not None:
+                    barrier.wait()
+
+                self._get_params(self._pviews)
+                self._counts[w] = len(shard)
+
+                # The workers' copies of the layers see every minibatch, too.
+                self.model.pre_minibatch()
+
+                if len(shard):
+                    bxs = tuple(X[shard] for X in Xs)
+                    bts = tuple(t[shard] for t in ts)
+
+                    if aug is not None:
+                        assert len(bxs) == 1, "Augmentation with multiple inputs not implemented yet. Please open an issue describing the use-case!"
+                        bx, bts = aug.augbatch_train(bxs[0], *bts)
+                        bxs = (bx,)
+
+                    stats.append(self._step(w, bxs, bts, kwargs))
+
+                self.model.post_minibatch()
+
+                if barrier is not None:
+                    barrier.wait()
+        except BaseException:
+            # Make sure the master doesn't wait for us forever.
+            if barrier is not None:
+                barrier.abort()
+            results.put((w, None))
+            raise
+
+        results.put((w, (stats, [v.get_value() for v in self._states])))
+
+
+    def _step(self, w, bxs, bts, kwargs):
+        """
+        Processes one shard of a minibatch in worker `w` and publishes the
+        result according to the mode.
+        """
+        bxs = _u.tuplize(self.model.prepare(*bxs))
+        if self.mode == 'grads':
+            cost, *xtra = self.opt.fn_accum(*bxs+bts)
+            for v, sh_a in zip(self._wviews[w], self.opt.sh_gacc):
+                v[...] = sh_a.get_value(borrow=True)
+                sh_a.set_value(_np.zeros_like(v))
+            self.opt.sh_nacc.set_value(_np.asarray(0, dtype=_th.config.floatX))
+        elif self.mode == 'params':
+            cost, *xtra = self.opt.fn_train(*bxs+bts, **kwargs)
+            for v, p in zip(self._wviews[w], self.opt.params):
+                v[...] = p.get_value(borrow=True)
+        else:
+            old = [p.get_value() for p in self.opt.params]
+            cost, *xtra = self.opt.fn_train(*bxs+bts, **kwargs)
+            # Lock-free, racy on purpose.
+            for v, p, o in zip(self._pviews, self.opt.params, old):
+                v += p.get_value(borrow=True) - o
+
+        return (cost,) + tuple(xtra)
+
+
+def scaling_efficiency(mktrainer, X, t, nworkers=(1, 2, 4), nepochs=1, **kwargs):
+    """
+    Measures how well data-parallel training scales with the number of worker
+    processes, by training for `nepochs` epochs with each count in `nworkers`.
+
+    - `mktrainer(n)`: A function returning a fresh `DataParallel` trainer
+        using `n` workers.
+    - `X`, `t` and `kwargs` are passed on to its `fit_epoch`.
+
+    Returns a list with one dict per worker count, containing the measured
+    `samples_per_sec`, the `speedup` over the first count and the
+    `efficiency`, i.e. the speedup divided by the increase in workers.
+    `ncores` is the number of cores of this machine, for reference.
+    """
+    report = []
+    for n in nworkers:
+        trainer = mktrainer(n)
+        sps = []
+        for _ in range(nepochs):
+            trainer.fit_epoch(X, t, **kwargs)
+            sps.append(trainer.samples_per_sec)
+        report.append(dict(nworkers=n, ncores=_os.cpu_count(), samples_per_sec=_np.mean(sps)))
+
+    for r in report:
+        r['speedup'] = r['samples_per_sec'] / report[0]['samples_per_sec']
+        r['efficiency'] = r['speedup'] / (r['nworkers'] / report[0]['nworkers'])
+
+    return report
+
+
+class ParallelPredictor(object):
+    """
+    Predicts a dataset with a `StreaMiniPredictor` in multiple worker
+    processes on a single host, each one working on a contiguous range of
+    the minibatches.
+
+    Just like for `DataParallel`, workers are forked for each call and
+    inherit the compiled function as well as the data, which is thus never
+    copied. Predictions which have one entry per sample are written by the
+    workers straight into an output array in shared memory, anything else is
+    sent back; all of them then go through the model's batch aggregators in
+    order, as in `StreaMiniPredictor.pred_epoch`.
+    """
+
+
+    def __init__(self, nworkers, predictor):
+        """
+        - `nworkers`: The number of worker processes to use.
+        - `predictor`: The `StreaMiniPredictor` to use.
+        """
+        assert nworkers >= 1, "Need at least one worker."
+
+        self.nworkers = nworkers
+        self.predictor = predictor
+        self.batchsize = predictor.batchsize
+        self._ctx = _mp.get_context('fork')
+
+        self.pred_time = None
+        self.samples_per_sec = None
+
+
+    def _pred_batch(self, bxs, aug, fast, kwargs):
+        """
+        Returns the (possibly ensembled) predictions for the batch `bxs`.
+        """
+        prepare = self.predictor.model.prepare
+        if aug is None:
+            return list(self.predictor.fn_pred(*_u.tuplize(prepare(*bxs)), **kwargs))
+
+        augpreds = [[] for _ in self.predictor.ensemblers]
+        for bxs_aug in aug.augbatch_pred(*bxs, fast=fast):
+            for p, o in zip(augpreds, self.predictor.fn_pred(*_u.tuplize(prepare(*_u.tuplize(bxs_aug))), **kwargs)):
+                p.append(o)
+        return [ens(ap) for ens, ap in zip(self.predictor.ensemblers, augpreds)]
+
+
+    def pred_epoch(self, X, aug=None, fast=False, batchsize=None, **kwargs):
+        """
+        Predicts the model's output for a full dataset `X`, see
+        `StreaMiniPredictor.pred_epoch` for the meaning of all arguments.
+
+        The wall-clock time and throughput are stored in `pred_time` and
+        `samples_per_sec`.
+        """
+        Xs = _u.tuplize(X)
+        bs = batchsize or self.batchsize
+        N = Xs[0].shape[0]
+
+        assert all(X.shape[0] == N for X in Xs), "All inputs to pred_epoch should contain the same amount of datapoints."
+
+        t0 = _time.time()
+
+        # An empty dataset is predicted as one empty batch in this process,
+        # for the outputs to still have the right shapes.
+        batches = [(i, min(i + bs, N)) for i in range(0, N, bs)] or [(0, 0)]
+
+        # The first batch tells which outputs have one entry per sample, and
+        # their shape, for allocating the shared outputs.
+        first = self._pred_batch(tuple(X[:batches[0][1]] for X in Xs), aug, fast, kwargs)
+        shared = {}
+        for i, o in enumerate(first):
+            if o.ndim > 0 and o.shape[0] == batches[0][1]:
+                buf = self._ctx.RawArray('b', N*o[:1].nbytes)
+                shared[i] = _np.frombuffer(buf, dtype=o.dtype).reshape((N,) + o.shape[1:])
+                shared[i][:len(o)] = o
+
+        # Contiguous ranges of the remaining batches for each worker.
+        ranges = [r for r in _np.array_split(_np.arange(1, len(batches)), self.nworkers) if len(r)]
+        results = self._ctx.Queue()
+        procs = [
+            self._ctx.Process(target=self._work, args=(w, [batches[b] for b in r], Xs, aug, fast, shared, results, kwargs))
+            for w, r in enumerate(ranges)
+        ]
+
+        for p in procs:
+            p.start()
+        try:
+            outs = dict(results.get() for _ in procs)
+            if any(o is None for o in outs.values()):
+                raise RuntimeError("A prediction worker failed, see its traceback above.")
+        finally:
+            for p in procs:
+                p.join()
+
+        # All the others' outputs in order, after the first batch's.
+        rest = [[first[i]] for i in range(len(first))]
+        for w in sorted(outs):
+            for i, o in enumerate(outs[w]):
+                rest[i].extend(o)
+
+        preds = []
+        for i, agg in enumerate(self.predictor.batch_aggs):
+            if i in shared:
+                preds.append(agg([shared[i][a:b] for a, b in batches]))
+            else:
+                preds.append(agg(rest[i]))
+
+        self.pred_time = _time.time() - t0
+        self.samples_per_sec = N / self.pred_time
+        return _u.maybetuple(preds)
+
+
+    def _work(self, w, batches, Xs, aug, fast, shared, results, kwargs):
+        """
+        The main loop of worker `w`, executed in the forked process.
+        """
+        rest = [[] for _ in self.predictor.batch_aggs]
+        try:
+            for a, b in batches:
+                for i, o in enumerate(self._pred_batch(tuple(X[a:b] for X in Xs), aug, fast, kwargs)):
+                    if i in shared:
+                        shared[i][a:b] = o
+                    else:
+                        rest[i].append(o)
+        except BaseException:
+            results.put((w, None))
+            raise
+
+        results.put((w, rest))
+
+
+def prediction_speedup(mkpredictor, X, nworkers=(1, 2, 4), repeat=1, **kwargs):
+    """
+    Measures how well parallel prediction scales with the number of worker
+    processes, by predicting `X` `repeat` times with each count in
+    `nworkers`.
+
+    - `mkpredictor(n)`: A function returning a fresh `ParallelPredictor`
+        using `n` workers.
+    - `kwargs` are passed on to its `pred_epoch`.
+
+    Returns a list with one dict per worker count just like
+    `scaling_efficiency` does.
+    """
+    report = []
+    for n in nworkers:
+        pred = mkpredictor(n)
+        sps = []
+        for _ in range(repeat):
+            pred.pred_epoch(X, **kwargs)
+            sps.append(pred.samples_per_sec)
+        report.append(dict(nworkers=n, ncores=_os.cpu_count(), samples_per_sec=_np.mean(sps)))
+
+    for r in report:
+        r['speedup'] = r['samples_per_sec'] / report[0]['samples_per_sec']
+        r['efficiency'] = r['speedup'] / (r['nworkers'] / report[0]['nworkers'])
+
+    return report
+
+
+# Each message on the wire is a one-byte opcode, the length of the payload as
+# unsigned 64bit integer, and the payload itself. Requests the server can't
+# handle are answered with an `E` message holding the reason.
+_HEADER = _struct.Struct('!cQ')
+_VERSION = _struct.Struct('!Q')
+
+# The most bytes of JSON-encoded keyword arguments a push may carry.
+_MAX_KWARGS = 2**16
+
+
+def _send(sock, op, *payload):
+    n = sum(len(p) for p in payload)
+    sock.sendall(_HEADER.pack(op, n))
+    for p in payload:
+        sock.sendall(p)
+
+
+def _recv(sock, maxlen=None):
+    """
+    Returns the opcode and payload of the next message on `sock`, or `None`
+    if the other side closed the connection. Raises a `ValueError` if the
+    payload is longer than `maxlen` bytes, without reading it.
+    """
+    head = _recvall(sock, _HEADER.size)
+    if head is None:
+        return None
+    op, n = _HEADER.unpack(head)
+    if maxlen is not None and n > maxlen:
+        raise ValueError("Message of {} bytes exceeds the limit of {}.".format(n, maxlen))
+    return op, _recvall(sock, n)
+
+
+def _recvall(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    while len(view):
+        got = sock.recv_into(view)
+        if got == 0:
+            return None
+        view = view[got:]
+    return buf
+
+
+def _flatten(arrays):
+    return _np.concatenate([_np.asarray(a, dtype=_th.config.floatX).ravel() for a in arrays])
+
+
+class ParameterServer(object):
+    """
+    Holds the parameters of a model and the state of its optimizer, and
+    updates them upon receiving gradients from any number of `PSWorker`s,
+    possibly running on other machines, over TCP.
+
+    Gradients are applied in the order they arrive, no matter on how old
+    parameters they were computed; how old these may be is controlled by the
+    workers' `staleness`.
+    """
+
+
+    def __init__(self, cls, batchsize, model, cost, *args, **kwargs):
+        """
+        Creates an optimizer of type `cls` using all of `batchsize`, `model`,
+        `cost`, `args` and `kwargs`, whose update rule is applied to the
+        gradients pushed by the workers.
+
+        The current values of the `model`'s parameters are the ones which will
+        be served to the workers.
+        """
+        self.model = model
+
+        # Any value above one makes the optimizer compile the separate update
+        # function which works on the gradients in its accumulators.
+        kwargs['accumulate'] = 2
+        self.opt = cls(batchsize, model, cost, *args, **kwargs)
+
+        # What pushes may contain: the update function's keyword arguments
+        # and the gradients of all parameters which are learned.
+        self._kwnames = set(i.name for i in self.opt.fn_apply.maker.inputs if not i.implicit)
+        self._gradbytes = sum(p.get_value(borrow=True).size for p in self.opt.params) * _np.dtype(_th.config.floatX).itemsize
+
+        self.version = 0
+        self._lock = _thr.Lock()
+        self._srv = None
+        self._proc = None
+
+
+    def _pull(self):
+        with self._lock:
+            return _VERSION.pack(self.version), _flatten(p.get_value(borrow=True) for p in self.model.params).tobytes()
+
+
+    def _push(self, payload):
+        """
+        The payload is the length of the JSON-encoded keyword arguments for
+        the update function, those arguments, and the flat gradients. Raises
+        a `ValueError` for anything else.
+        """
+        if len(payload) < _VERSION.size:
+            raise ValueError("Truncated gradient push.")
+        n = _VERSION.unpack_from(payload)[0]
+        if n > _MAX_KWARGS or len(payload) != _VERSION.size + n + self._gradbytes:
+            raise ValueError("Gradient push of {} bytes doesn't match the model's {} bytes of gradients.".format(len(payload), self._gradbytes))
+
+        kwargs = _json.loads(payload[_VERSION.size:_VERSION.size+n].decode('utf-8'))
+        if not isinstance(kwargs, dict) or not set(kwargs) <= self._kwnames or not all(type(v) in (int, float) for v in kwargs.values()):
+            raise ValueError("The update function only takes numbers for {}.".format(sorted(self._kwnames)))
+
+        grads = _flat_views(memoryview(payload)[_VERSION.size+n:], self.opt.params)
+
+        with self._lock:
+            for sh_a, g in zip(self.opt.sh_gacc, grads):
+                sh_a.set_value(g.copy())
+            self.opt.sh_nacc.set_value(_np.asarray(1, dtype=_th.config.floatX))
+            self.opt.fn_apply(**kwargs)
+            self.version += 1
+            return _VERSION.pack(self.version)
+
+
+    def _mk_server(self, address):
+        ps = self
+        maxlen = _VERSION.size + _MAX_KWARGS + self._gradbytes
+
+        class Handler(_socketserver.BaseRequestHandler):
+            def handle(self):
+                self.request.setsockopt(_socket.IPPROTO_TCP, _socket.TCP_NODELAY, 1)
+                while True:
+                    try:
+                        msg = _recv(self.request, maxlen)
+                    except ValueError as e:
+                        # The rest of the stream can't be made sense of.
+                        _send(self.request, b'E', str(e).encode('utf-8'))
+                        return
+                    if msg is None:
+                        return
+                    op, payload = msg
+
+                    # Bad requests are answered, not fatal to the server.
+                    try:
+                        if op == b'p':
+                            reply = (b'P',) + ps._pull()
+                        elif op == b'g':
+                            reply = (b'V', ps._push(payload))
+                        else:
+                            raise ValueError("Unknown parameter-server request: " + repr(op))
+                    except Exception as e:
+                        reply = (b'E', str(e).encode('utf-8'))
+                    _send(self.request, *reply)
+
+        srv = _socketserver.ThreadingTCPServer(address, Handler, bind_and_activate=False)
+        srv.daemon_threads = True
+        srv.allow_reuse_address = True
+        srv.server_bind()
+        srv.server_activate()
+        return srv
+
+
+    def serve_forever(self, address=('127.0.0.1', 4242)):
+        """
+        Serves the parameters on `address` in this process, until interrupted.
+        Pass `('', port)` for serving other machines on all interfaces; there
+        is no authentication whatsoever, so only do so on trusted networks.
+        """
+        self._srv = self._mk_server(address)
+        self._srv.serve_forever()
+
+
+    def start(self, address=('127.0.0.1', 0)):
+        """
+        Serves the parameters on `address` in a forked server process and
+        returns the actual address being listened on, which is useful when
+        letting the OS pick a free port by passing port 0.
+
+        Note that from then on, the parameters in this process are not updated
+        anymore; use a `PSWorker` to `pull` them.
+        """
+        self._srv = self._mk_server(address)
+        self._proc = _mp.get_context('fork').Process(target=self._srv.serve_forever, daemon=True)
+        self._proc.start()
+
+        # Only the server process should be listening from now on.
+        self._srv.server_close()
+        return self._srv.server_address
+
+
+    def stop(self):
+        """ Stops the server process created by `start`. """
+        if self._proc is not None:
+            self._proc.terminate()
+            self._proc.join()
+            self._proc = None
+
+
+class PSWorker(object):
+    """
+    Trains a model on its own data using a `ParameterServer`, by pushing the
+    gradients it computes to it and pulling the resulting parameters.
+    """
+
+
+    def __init__(self, address, cls, batchsize, model, cost, *args, staleness=0, **kwargs):
+        """
+        Creates an optimizer of type `cls` using all of `batchsize`, `model`,
+        `cost`, `args` and `kwargs`, which is only used for computing
+        gradients, and connects to the parameter server at `address`.
+
+        - `address`: A `(host, port)` pair of the server.
+        - `staleness`: How many updates the local parameters may lag behind
+            the server's before being pulled again. This counts the worker's
+            own pushes too, as their updates are only applied on the server,
+            so with the default of 0, parameters are pulled after every push,
+            and with `n`, at least every `n+1` pushes.
+        """
+        self.model = model
+        self.batchsize = batchsize
+        self.staleness = staleness
+
+        # Any value above one makes the optimizer compile the separate
+        # gradient computation function.
+        kwargs['accumulate'] = 2
+        self.opt = cls(batchsize, model, cost, *args, **kwargs)
+
+        self.sock = _socket.create_connection(address)
+        self.sock.setsockopt(_socket.IPPROTO_TCP, _socket.TCP_NODELAY, 1)
+
+        self.version = None
+        self.npulls = 0
+        self.npushes = 0
+
+
+    def close(self):
+        self.sock.close()
+
+
+    def _reply(self, expected):
+        """ Returns the payload of the server's reply with opcode `expected`. """
+        msg = _recv(self.sock)
+        if msg is None:
+            raise RuntimeError("The parameter server closed the connection.")
+        op, payload = msg
+        if op == b'E':
+            raise RuntimeError("The parameter server rejected the request: " + payload.decode('utf-8'))
+        assert op == expected, "This should never happen, please file an issue."
+        return payload
+
+
+    def pull(self):
+        """
+        Fetches the current parameters from the server into the model.
+        """
+        _send(self.sock, b'p')
+        payload = self._reply(b'P')
+
+        self.version = _VERSION.unpack_from(payload)[0]
+        for v, p in zip(_flat_views(memoryview(payload)[_VERSION.size:], self.model.params), self.model.params):
+            p.set_value(v.copy())
+        self.npulls += 1
+
+
+    def push(self, **kwargs):
+        """
+        Sends the average of the gradients accumulated so far to the server,
+        along with the keyword arguments for its update function, and pulls
+        new parameters if ours got too stale.
+        """
+        nacc = self.opt.sh_nacc.get_value()
+        grads = _flatten(sh_a.get_value(borrow=True) / nacc for sh_a in self.opt.sh_gacc)
+
+        for sh_a in self.opt.sh_gacc:
+            sh_a.set_value(_np.zeros_like(sh_a.get_value(borrow=True)))
+        self.opt.sh_nacc.set_value(_np.asarray(0, dtype=_th.config.floatX))
+
+        kw = _json.dumps({k: float(v) for k, v in kwargs.items()}).encode('utf-8')
+        _send(self.sock, b'g', _VERSION.pack(len(kw)), kw, grads.tobytes())
+        payload = self._reply(b'V')
+        self.npushes += 1
+
+        if _VERSION.unpack(payload)[0] - self.version > self.staleness:
+            self.pull()
+
+
+    def fit_epoch(self, X, t, aug=None, batchsize=None, shuf=False, push_every=1, **kwargs):
+        """
+        Trains the model for one full epoch on this worker's data, see
+        `StreaMiniOptimizer.fit_epoch` for the meaning of all arguments.
+
+        - `push_every`: The number of minibatches whose gradients are
+            accumulated locally before being pushed to the server.
+        """
+        if self.version is None:
+            self.pull()
+
+        self.model.pre_epoch()
+
+        costs = []
+        xtras = []
+
+        Xs = _u.tuplize(X)
+        ts = _u.tuplize(t)
+        bs = batchsize or self.batchsize
+
+        if shuf is False:
+            bxkw = btkw = {}
+        else:
+            common_seed = _u.check_random_state(shuf).randint(2**31)
+            bxkw = dict(shuf=_np.random.RandomState(common_seed))
+            btkw = dict(shuf=_np.random.RandomState(common_seed))
+
+        for bxs, bts in zip(_u.batched(bs, *Xs, **bxkw), _u.batched(bs, *ts, **btkw)):
+            bxs = _u.tuplize(bxs)
+            bts = _u.tuplize(bts)
+
+            if aug is not None:
+                assert len(bxs) == 1, "Augmentation with multiple inputs not implemented yet. Please open an issue describing the use-case!"
+                bx, bts = aug.augbatch_train(bxs[0], *bts)
+                bxs = (bx,)
+
+            bxs = _u.tuplize(self.model.prepare(*bxs))
+            self.model.pre_minibatch()
+
+            cost, *xtra = self.opt.fn_accum(*bxs+bts)
+            if len(costs) % push_every == push_every - 1:
+                self.push(**kwargs)
+
+            costs.append(cost)
+            xtras.append(xtra)
+
+            self.model.post_minibatch()
+
+        if len(costs) % push_every != 0:
+            self.push(**kwargs)
+
+        self.model.post_epoch()
+
+        return _u.maybetuple((self.opt.cost.aggregate_batches(costs),)
+                        + tuple(x.aggregate_batches(b) for x, b in zip(self.opt.xtras, zip(*xtras))))
+
+
+def ps_throughput(address, mkworker, X, t, nworkers=(1, 2, 4), nepochs=1, **kwargs):
+    """
+    Measures the training throughput of a parameter server at `address` when
+    being used by a varying number of worker processes on this host.
+
+    - `mkworker(address)`: A function returning a fresh `PSWorker`.
+    - `X`, `t`: The data, each worker trains on its own interleaved shard.
+    - `kwargs` are passed on to the workers' `fit_epoch`.
+
+    Returns a list with one dict per worker count, containing the measured
+    `samples_per_sec` summed over all workers and the `speedup` over the
+    first count.
+    """
+    ctx = _mp.get_context('fork')
+    Xs = _u.tuplize(X)
+    ts = _u.tuplize(t)
+
+    def work(w, n, barrier, results):
+        worker = mkworker(address)
+        barrier.wait()
+        for _ in range(nepochs):
+            worker.fit_epoch(_u.maybetuple(X[w::n] for X in Xs), _u.maybetuple(t[w::n] for t in ts), **kwargs)
+        worker.close()
+        results.put(nepochs*Xs[0][w::n].shape[0])
+
+    report = []
+    for n in nworkers:
+        barrier = ctx.Barrier(n + 1)
+        results = ctx.Queue()
+        procs = [ctx.Process(target=work, args=(w, n, barrier, results)) for w in range(n)]
+        for p in procs:
+            p.start()
+
+        # Don't measure the compilation within the workers.
+        barrier.wait()
+        t0 = _time.time()
+        nsamples = sum(results.get() for _ in procs)
+        report.append(dict(nworkers=n, samples_per_sec=nsamples / (_time.time() - t0)))
+
+        for p in procs:
+            p.join()
+
+    for r in report:
+        r['speedup'] = r['samples_per_sec'] / report[0]['samples_per_sec']
+
+    return report
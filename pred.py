@@ -1,10 +1,32 @@
 #!/usr/bin/env python3
 
 import DeepFried.util as _u
+import DeepFried.containers as _c
+import DeepFried.profiling as _prof
 
+import concurrent.futures as _fut
+from functools import partial as _partial
+import os as _os
+import numpy as _np
+import scipy.sparse as _sp
 import theano as _th
 
 
+def _as_input(X, v):
+    """
+    Converts the minibatch `X` into exactly what the function input `v`
+    takes, which is needed when not checking inputs: a CSR matrix for sparse
+    inputs, a C-contiguous array otherwise, of `v`'s dtype. Raises a
+    `TypeError` for arrays which don't fit `v`'s dimensions.
+    """
+    if _sp.issparse(X):
+        return _sp.csr_matrix(X, dtype=v.dtype)
+    X = _np.ascontiguousarray(X, dtype=v.dtype)
+    if X.ndim != v.ndim or any(b and n != 1 for b, n in zip(v.broadcastable, X.shape)):
+        raise TypeError("Input {} takes a minibatch of broadcastable pattern {}, not of shape {}.".format(v.name, v.broadcastable, X.shape))
+    return X
+
+
 class StreaMiniPredictor(object):
     """
     This is a predictor that works through minibatches of the dataset, each
@@ -13,7 +35,7 @@ class StreaMiniPredictor(object):
     """
 
 
-    def __init__(self, batchsize, model, Xnames=[]):
+    def __init__(self, batchsize, model, Xnames=[], profile=False, fncache=None, branch_threads=None, taps=None):
         """
         - `batchsize`: The number of samples in a minibatch.
         - `model`: The model. This should be an object with at least:
@@ -30,28 +52,79 @@ class StreaMiniPredictor(object):
             - `pred_exprs(X)`: a method which returns a list of symbolic
                 outputs (the "predictions") of a model for a symbolic input
                 minibatch `X`. Typical models just have a single prediction.
+        - `profile`: If true, profile the prediction function per layer of
+            the model into `self.profiler`, see `DeepFried.profiling`.
+        - `fncache`: An optional `DeepFried.fncache.FunctionCache` to load
+            the compiled functions from, see `StreaMiniOptimizer`.
+        - `branch_threads`: For models which are a `Parallel`, or a `Sequence`
+            ending in one, compile one function per branch instead of a
+            single one and evaluate the branches concurrently on a pool of
+            this many threads, see `ConcurrentBranches`.
+        - `taps`: For `Sequence` models, a list of layers whose outputs to
+            predict in the same pass along with the model's final outputs,
+            which come first. Each is given as anything `Sequence.tap_path`
+            understands, e.g. an index into the sequence.
         """
         self.model = model
         self.batchsize = batchsize
+        self.taps = list(taps or [])
+
+        assert not self.taps or isinstance(self.model, _c.Sequence), "Only layers of a Sequence can be tapped."
+        assert not self.taps or branch_threads is None, "Tapping layers can't be combined with concurrent branches (yet)."
 
         self.Xs = _u.tuplize(self.model.make_inputs(*Xnames))
 
-        outs = _u.tuplize(self.model.pred_expr(*self.Xs))
-        self.batch_aggs = _u.tuplize(self.model.batch_agg())
-        self.ensemblers = _u.tuplize(self.model.ensembler())
+        self.profiler = _prof.LayerProfile() if profile else None
+        self.fncache = fncache
+        if self.profiler is None:
+            outs = self._pred_expr(*self.Xs)
+        else:
+            outs = self.profiler.trace(self.model, self._pred_expr, *self.Xs)
+
+        tapped = [self.model.layer_at(t) for t in self.taps]
+        self.batch_aggs = _u.tuplize(self.model.batch_agg()) + _u.collect(l.batch_agg() for l in tapped)
+        self.ensemblers = _u.tuplize(self.model.ensembler()) + _u.collect(l.ensembler() for l in tapped)
 
         # A few sanity checks before compiling the function.
         assert len(outs) == len(self.batch_aggs), "The amount of outputs ({}) differs from the amount of batch aggregators ({}). You probably hit a bug, please file an issue".format(len(outs), len(self.batch_aggs))
         assert len(outs) == len(self.ensemblers), "The amount of outputs ({}) differs from the amount of ensemblers ({}). You probably hit a bug, please file an issue".format(len(outs), len(self.ensemblers))
 
-        self.fn_pred = _th.function(
-            inputs=self.Xs,
-            outputs=outs,
-            name="StreaMiniPredictor pred"
-        )
+        if branch_threads is None:
+            self.fn_pred = self._function()(
+                inputs=self.Xs,
+                outputs=outs,
+                name="StreaMiniPredictor pred"
+            )
+        else:
+            assert self.profiler is None, "Concurrent branches can't be profiled per layer (yet)."
+            self.fn_pred = ConcurrentBranches(self.model, self.Xs, branch_threads, self._function())
 
+        # Set this to a `DeepFried.timing.PhaseTimer` to time epochs.
+        self.timer = None
 
-    def pred_epoch(self, X, aug=None, fast=False, batchsize=None, **kwargs):
+        # The function behind `predict_batch`, compiled on first use.
+        self.outs = outs
+        self.fn_fast = None
+
+
+    def _pred_expr(self, *Xs):
+        """ The model's prediction expressions followed by the tapped ones. """
+        if not self.taps:
+            return _u.tuplize(self.model.pred_expr(*Xs))
+        outs, tapped = self.model.pred_taps(self.taps, *Xs)
+        return _u.tuplize(outs) + _u.collect(tapped)
+
+
+    def _function(self):
+        """ Returns what to compile functions with, `theano.function`-alike. """
+        if self.profiler is not None:
+            return self.profiler.function
+        if self.fncache is not None:
+            return _partial(self.fncache.function, model=self.model)
+        return _th.function
+
+
+    def pred_epoch(self, X, aug=None, fast=False, batchsize=None, out=None, **kwargs):
         """
         Predicts the model's output for a full dataset `X` by iterating
         through minibatches if necessary.
@@ -59,15 +132,25 @@ class StreaMiniPredictor(object):
         - `X`: A numpy array containing the data. The first dimension should be
                the datapoints, i.e. X.shape[0] == ndata, and any remaining
                dimensions should fit the model's expected input shape.
+               For sparse inputs, this is a `scipy.sparse` CSR matrix instead.
         - `aug`: An optional data augmentation pipeline that can transform each
                  sample in the minibatch individually.
         - `fast`: A flag passed on to `aug` which chooses how many
             augmentations should be used. `False` is slower but usually results
             in much better predictions.
         - `batchsize`: Optionally override the batchsize given at construction.
+        - `out`: Optionally, preallocated arrays (one per output, e.g.
+            `np.memmap`s) to write each minibatch's predictions into as soon
+            as they are computed, instead of aggregating them at the end.
+            This only works for outputs with one entry per sample; `out` is
+            returned.
 
         Any remaining arguments will be passed on to the prediction function.
         """
+        tm = self.timer
+        if tm is not None:
+            tm.start()
+
         nout = len(self.batch_aggs)
 
         # A list where each entry corresponds to an output and contains
@@ -80,6 +163,10 @@ class StreaMiniPredictor(object):
 
         assert all(X.shape[0] == Xs[0].shape[0] for X in Xs), "All inputs to pred_epoch should contain the same amount of datapoints."
 
+        outbufs = _u.tuplize(out)
+        assert out is None or len(outbufs) == nout, "Need one output array for each of the {} outputs.".format(nout)
+        start = 0
+
         # Go through the training in minibatches. Note that the last batch
         # may be smaller than the batchsize.
         for bxs in _u.batched(bs, *Xs):
@@ -87,6 +174,9 @@ class StreaMiniPredictor(object):
             # smart and not return a tuple if batching a single array.
             bxs = _u.tuplize(bxs)
 
+            if tm is not None:
+                tm.lap('gather')
+
             # For prediction, augmentation makes a big difference:
             if aug is not None:
                 # With augmentation, the model will be evaluated on potentially
@@ -100,8 +190,13 @@ class StreaMiniPredictor(object):
                 # augmentation in the case of multiple inputs is domain-
                 # specific knowledge.
                 for bxs_aug in aug.augbatch_pred(*bxs, fast=fast):
-                    bxs_aug = _u.tuplize(bxs_aug)
+                    # E.g. hashing IDs, see `Layer.prepare`.
+                    bxs_aug = _u.tuplize(self.model.prepare(*_u.tuplize(bxs_aug)))
+                    if tm is not None:
+                        tm.lap('augment')
                     outs = self.fn_pred(*bxs_aug, **kwargs)
+                    if tm is not None:
+                        tm.lap('fn_pred')
                     for p, o in zip(augpreds, outs):
                         p.append(o)
                 # Now ensemble each of the predictions from the augmented
@@ -110,13 +205,169 @@ class StreaMiniPredictor(object):
                 for p, ens, ap in zip(preds, self.ensemblers, augpreds):
                     p.append(ens(ap))
 
+                if tm is not None:
+                    tm.lap('ensemble')
+
             else:
                 # While without augmentation, it's pretty straightforward.
-                outs = self.fn_pred(*bxs, **kwargs)
+                outs = self.fn_pred(*_u.tuplize(self.model.prepare(*bxs)), **kwargs)
+                if tm is not None:
+                    tm.lap('fn_pred')
                 for p, o in zip(preds, outs):
                     p.append(o)
 
+            if out is not None:
+                # Stream this minibatch's predictions out right away.
+                n = bxs[0].shape[0]
+                for p, buf in zip(preds, outbufs):
+                    buf[start:start+n] = p.pop()
+                start += n
+
         # Now collect all predictions over the minibatches.
         # Predictions may be collected differently, e.g. errors are summed
         # while scores (e.g. neg-log-likelihood) are usually averaged.
-        return _u.maybetuple(agg(p) for p, agg in zip(preds, self.batch_aggs))
+        if out is None:
+            res = _u.maybetuple(agg(p) for p, agg in zip(preds, self.batch_aggs))
+        else:
+            res = out
+
+        if tm is not None:
+            tm.lap('aggregate')
+            tm.stop('pred_epoch', Xs[0].shape[0])
+
+        return res
+
+
+    def _mk_fast_fn(self):
+        # Theano's input validation and the allocation of fresh outputs are a
+        # good part of the cost of calling a small model on a single sample.
+        # This function skips the former and lets the latter be reused, which
+        # is why `predict_batch` casts its inputs and copies its outputs.
+        function = _th.function if self.fncache is None else _partial(self.fncache.function, model=self.model)
+        self.fn_fast = function(
+            inputs=self.Xs,
+            outputs=[_th.Out(o, borrow=True) for o in self.outs],
+            name="StreaMiniPredictor fast"
+        )
+        self.fn_fast.trust_input = True
+        return self.fn_fast
+
+
+    def predict_batch(self, *Xs, out=None):
+        """
+        Predicts the model's raw outputs for a single minibatch `Xs`, one
+        array per model input, with as little overhead as possible. Unlike
+        `pred_epoch`, there's no batching, augmentation or aggregation, so
+        the minibatch must already have the shape the model expects.
+
+        - `out`: Optionally, preallocated arrays (one per output) of the
+            right shape to write the outputs into instead of allocating new
+            ones, which are returned.
+        """
+        fn = self.fn_fast or self._mk_fast_fn()
+        Xs = _u.tuplize(self.model.prepare(*Xs), lists=False)
+        outs = fn(*(_as_input(X, v) for X, v in zip(Xs, self.Xs)))
+
+        if out is None:
+            return _u.maybetuple(o.copy() for o in outs)
+
+        for buf, o in zip(_u.tuplize(out), outs):
+            _np.copyto(buf, o)
+        return out
+
+
+    def predict_one(self, *xs, out=None):
+        """
+        Like `predict_batch`, but for a single sample `xs`, one array per
+        model input without the minibatch dimension. Samples of sparse
+        inputs are given as a single row of a sparse matrix instead.
+        """
+        Xs = tuple(x if _sp.issparse(x) else _np.asarray(x)[None] for x in xs)
+        if out is None:
+            return _u.maybetuple(o[0] for o in _u.tuplize(self.predict_batch(*Xs)))
+
+        self.predict_batch(*Xs, out=tuple(buf[None] for buf in _u.tuplize(out)))
+        return out
+
+
+    def warmup(self, *Xs, repeat=3):
+        """
+        Calls `predict_batch` on the example minibatch `Xs` `repeat` times,
+        which compiles its function and lets Theano allocate its buffers
+        ahead of the first real request.
+        """
+        for _ in range(repeat):
+            self.predict_batch(*Xs)
+
+
+class ConcurrentBranches(object):
+    """
+    Stands in for the compiled prediction function of a model whose
+    (trailing) `Parallel` has heavy, independent branches, such as multiple
+    convolutional towers or multi-task heads. Instead of one function which
+    evaluates the branches one after another, one function is compiled for
+    the layers before the `Parallel`, if any, and one per branch; the
+    branches are then evaluated concurrently on a thread pool. This makes
+    use of otherwise idle cores since Theano's C and BLAS ops release the
+    GIL.
+    """
+
+
+    def __init__(self, model, Xs, nthreads, function=_th.function):
+        """
+        - `model`: A `Parallel`, or a `Sequence` whose last layer is one.
+        - `Xs`: The model's symbolic inputs.
+        - `nthreads`: The number of threads to use.
+        - `function`: What to compile with, `theano.function`-alike.
+        """
+        if isinstance(model, _c.Parallel):
+            trunk, par = [], model
+        elif isinstance(model, _c.Sequence) and isinstance(model.layers[-1], _c.Parallel):
+            trunk, par = model.layers[:-1], model.layers[-1]
+        else:
+            raise ValueError("Concurrent branches need a model which is a Parallel or ends in one, not {}.".format(type(model).__name__))
+
+        self.nthreads = nthreads
+        self.fn_trunk = None
+        Hs = Xs
+        if trunk:
+            for l in trunk:
+                Hs = _u.tuplize(l.pred_expr(*Hs))
+            self.fn_trunk = function(inputs=Xs, outputs=Hs, name="StreaMiniPredictor trunk")
+            Hs = tuple(h.type(h.name) for h in Hs)
+
+        self.fn_branches = [
+            function(inputs=Hs, outputs=_u.tuplize(l.pred_expr(*Hs)), name="StreaMiniPredictor branch {}".format(i))
+            for i, l in enumerate(par.layers)
+        ]
+
+        self._pool = None
+        self._pid = None
+
+
+    def __call__(self, *Xs, **kwargs):
+        # A pool inherited through fork has no threads, so make a new one.
+        if self._pid != _os.getpid():
+            self._pool = _fut.ThreadPoolExecutor(self.nthreads, thread_name_prefix="DeepFried branch")
+            self._pid = _os.getpid()
+
+        if self.fn_trunk is not None:
+            Xs, kwargs = self.fn_trunk(*Xs, **kwargs), {}
+
+        futs = [self._pool.submit(fn, *Xs, **kwargs) for fn in self.fn_branches]
+        return [o for f in futs for o in f.result()]
+
+
+    def close(self):
+        """
+        Shuts the thread pool down, without waiting for running branches. It
+        is started anew if called again afterwards.
+        """
+        if self._pool is not None and self._pid == _os.getpid():
+            self._pool.shutdown(wait=False)
+        self._pool = None
+        self._pid = None
+
+
+    def __del__(self):
+        self.close()
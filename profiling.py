@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Per-layer profiling of the compiled functions of optimizers and predictors.
+
+Theano's profiler reports the time spent in each op of the optimized graph,
+but we think in layers. When profiling, the variables created by each layer
+of the model are labelled with that layer while building the expressions,
+and the gradients are built layer by layer so that the backward pass can be
+labelled too. The labels are carried along through Theano's graph
+optimizations, which allows to roll up the profiler's time per op, as well
+as the memory of the ops' outputs, into forward and backward time per layer:
+
+    opt = StreaMiniMomentum(128, model, cost, momentum=0.9, profile=True)
+    opt.fit_epoch(X, t, lrate=0.01)
+    print(opt.profiler.report())
+
+Since profiling needs a Python-driven VM and times each op individually,
+profiled functions run slower; only use this for finding the slow layers.
+"""
+
+import DeepFried.util as _u
+
+from collections import OrderedDict as _OrderedDict
+import theano as _th
+import theano.tensor as _T
+from theano.gof.toolbox import Feature as _Feature
+
+
+# Labels of the parts of the graph which don't belong to any layer.
+COST = 'cost'
+OPTIMIZER = 'optimizer'
+OTHER = '(other)'
+
+
+def _label_of(v):
+    return getattr(v.tag, 'df_layer', None)
+
+
+def _label(outputs, label, stop=()):
+    """
+    Labels all not yet labelled variables computing `outputs` with `label`,
+    without going beyond the `stop` variables.
+    """
+    stop = set(stop)
+    todo = [v for v in outputs if v is not None]
+    while todo:
+        v = todo.pop()
+        if v in stop or v.owner is None or _label_of(v) is not None:
+            continue
+        for o in v.owner.outputs:
+            if _label_of(o) is None:
+                o.tag.df_layer = label
+        todo.extend(v.owner.inputs)
+
+
+def leaves(model, path=''):
+    """
+    Returns a list of `(name, layer)` for all non-container layers in
+    `model`, where the name is the layer's position in the (nested)
+    containers followed by its type, e.g. `'2.1 Conv2D'`.
+    """
+    if not hasattr(model, 'layers'):
+        return [((path + ' ' if path else '') + type(model).__name__, model)]
+    return sum((leaves(l, path + ('.' if path else '') + str(i)) for i, l in enumerate(model.layers)), [])
+
+
+def _containers(model):
+    """ Returns all containers in `model`, including itself if it is one. """
+    if not hasattr(model, 'layers'):
+        return []
+    return [model] + sum((_containers(l) for l in model.layers), [])
+
+
+class _Labeller(_Feature):
+    """
+    A feature which, whenever a graph optimization replaces a labelled
+    variable, passes its label on to the new variables it's replaced with.
+    """
+
+    def on_change_input(self, fgraph, node, i, r, new_r, reason=None):
+        label = _label_of(r)
+        if label is not None:
+            _label([new_r], label)
+
+
+class _LabellingOptimizer(_th.gof.Optimizer):
+    """
+    Wraps the actual graph optimizer, attaching a `_Labeller` beforehand.
+    """
+
+    def __init__(self, optimizer):
+        self.optimizer = optimizer
+
+    def add_requirements(self, fgraph):
+        self.optimizer.add_requirements(fgraph)
+
+    def apply(self, fgraph):
+        fgraph.attach_feature(_Labeller())
+        return self.optimizer.optimize(fgraph)
+
+
+class LayerProfile(object):
+    """
+    Collects the profile of all functions compiled through it, per layer.
+    """
+
+
+    def __init__(self):
+        self.stats = _th.compile.profiling.ProfileStats(atexit_print=False)
+        self.names = []
+        self._records = []
+        self._depth = 0
+
+        # Per label, the bytes of all outputs during the most recent call and
+        # the largest of those over all calls.
+        self._bytes = {}
+        self.peak_bytes = {}
+        self.fns = []
+
+
+    def trace(self, model, fn, *Xs, **kw):
+        """
+        Calls `fn(*Xs, **kw)`, which should be `model.train_expr` or
+        `model.pred_expr`, labelling the variables each layer creates.
+
+        The layers' inputs and outputs are recorded for building the
+        gradients layer by layer in `grads`.
+        """
+        self.names = []
+        self._records = []
+
+        # A layer used in multiple places is profiled under its first name.
+        wrapped = {}
+        for name, layer in leaves(model):
+            if id(layer) in wrapped:
+                continue
+            wrapped[id(layer)] = layer
+            self.names.append(name)
+            for what in ('train_expr', 'pred_expr'):
+                setattr(layer, what, self._wrap(name, layer, getattr(layer, what)))
+
+        # Fused layers would bypass their wrapped expressions.
+        fused = list({id(c): c for c in _containers(model) if getattr(c, 'fuse', False)}.values())
+        for c in fused:
+            c.fuse = False
+        try:
+            return fn(*Xs, **kw)
+        finally:
+            for layer in wrapped.values():
+                del layer.train_expr, layer.pred_expr
+            for c in fused:
+                c.fuse = True
+
+
+    def _wrap(self, name, layer, fn):
+        def traced(*Xs, **kw):
+            # `pred_expr` may call `train_expr`; only the outermost counts.
+            self._depth += 1
+            nupd = {k: len(v) for k, v in kw.items() if isinstance(v, list)}
+            try:
+                outs = fn(*Xs, **kw)
+            finally:
+                self._depth -= 1
+            if self._depth == 0:
+                extra = [u for k, n in nupd.items() for _, u in kw[k][n:]]
+                _label(_u.tuplize(outs) + tuple(extra), (name, 'forward'), stop=Xs)
+                self._records.append((name, Xs, _u.tuplize(outs), layer.params))
+            return outs
+        return traced
+
+
+    def grads(self, cost, params, outputs):
+        """
+        Returns the gradients of `cost` wrt. `params`, just like `theano.grad`
+        does, but built one layer after the other through the recorded
+        layers' `outputs`, such that the backward pass of each layer can be
+        labelled with that layer.
+        """
+        _label([cost], (COST, 'forward'), stop=outputs)
+
+        # Gradients wrt. the model's outputs, and those terms of the cost
+        # which use the parameters directly, such as weight-decay.
+        known = _OrderedDict()
+        for o, g in zip(outputs, _T.grad(cost, outputs, disconnected_inputs='ignore', return_disconnected='None')):
+            if g is not None:
+                known[o] = g
+        direct = _T.grad(cost, params, consider_constant=list(outputs), disconnected_inputs='ignore', return_disconnected='None')
+        _label(list(known.values()) + direct, (COST, 'backward'), stop=outputs)
+        pgrads = {p: g for p, g in zip(params, direct) if g is not None}
+
+        def add(d, k, g, label):
+            d[k] = g if k not in d else d[k] + g
+            _label([d[k]], label)
+
+        for name, ins, outs, lparams in reversed(self._records):
+            kg = _OrderedDict((o, known[o]) for o in outs if o in known)
+            if not kg:
+                continue
+            wrt = [x for x in ins if x.dtype in _T.float_dtypes] + list(lparams)
+            gs = _T.grad(None, wrt, known_grads=kg, disconnected_inputs='ignore', return_disconnected='None')
+            _label(gs, (name, 'backward'), stop=list(kg.values()))
+            for x, g in zip(wrt, gs):
+                if g is not None:
+                    add(known if x in ins else pgrads, x, g, (name, 'backward'))
+
+        return [pgrads[p] if p in pgrads else _T.zeros_like(p) for p in params]
+
+
+    def function(self, inputs, outputs=None, updates=None, **kw):
+        """
+        Compiles a function just like `theano.function` does, but profiling
+        it into this profile. Anything not labelled yet is labelled as `COST`
+        if it's an output, such as extra outputs, and as `OPTIMIZER` if it's
+        an update, typically the optimizer's update rule.
+        """
+        _label(_u.tuplize(outputs, tuplize_none=True), (COST, 'forward'))
+        _label([u for _, u in updates or []], (OPTIMIZER, 'backward'))
+
+        mode = _th.compile.mode.Mode(
+            linker=_th.gof.vm.VM_Linker(allow_gc=True, use_cloop=False, callback=self._callback),
+            optimizer=_LabellingOptimizer(_th.compile.mode.get_default_mode().optimizer),
+        )
+        fn = _th.function(inputs, outputs, updates=updates, mode=mode, profile=self.stats, **kw)
+        self.fns.append(fn)
+
+        def profiled(*a, **kw):
+            # The per-op timings are only recorded while this flag is set.
+            self._bytes = {}
+            old, _th.config.profile = _th.config.profile, True
+            try:
+                return fn(*a, **kw)
+            finally:
+                _th.config.profile = old
+                for label, n in self._bytes.items():
+                    self.peak_bytes[label] = max(n, self.peak_bytes.get(label, 0))
+        profiled.fn = fn
+        return profiled
+
+
+    def _callback(self, node, thunk, storage_map, compute_map):
+        # Outputs which are views or computed in-place don't need new memory.
+        reused = set(getattr(node.op, 'view_map', {})) | set(getattr(node.op, 'destroy_map', {}))
+        n = sum(getattr(storage_map[o][0], 'nbytes', 0) for i, o in enumerate(node.outputs) if i not in reused)
+        label = self.label(node)
+        self._bytes[label] = self._bytes.get(label, 0) + n
+
+
+    @staticmethod
+    def label(node):
+        """ Returns the `(name, 'forward'|'backward')` label of `node`. """
+        for o in node.outputs:
+            if _label_of(o) is not None:
+                return _label_of(o)
+        return (OTHER, 'forward')
+
+
+    def table(self):
+        """
+        Returns the per-layer profile as a list of dicts, one per layer in
+        the order of the model, followed by the cost, the optimizer and
+        whatever couldn't be attributed, if any.
+
+        Times are in seconds in total over all calls, memory is the largest
+        total size in bytes of all the values computed by the layer's ops in
+        a single call, which is a (pessimistic) estimate of the activation
+        memory it needs.
+        """
+        rows = _OrderedDict((name, dict(layer=name, forward=0.0, backward=0.0, nodes=0, forward_bytes=0, backward_bytes=0))
+                            for name in self.names + [COST, OPTIMIZER, OTHER])
+
+        for node, t in self.stats.apply_time.items():
+            name, kind = self.label(node)
+            row = rows.setdefault(name, dict(layer=name, forward=0.0, backward=0.0, nodes=0, forward_bytes=0, backward_bytes=0))
+            row[kind] += t
+            row['nodes'] += 1
+
+        for (name, kind), n in self.peak_bytes.items():
+            if name in rows:
+                rows[name][kind + '_bytes'] = n
+
+        return [r for r in rows.values() if r['nodes'] or r['layer'] in self.names]
+
+
+    def report(self):
+        """
+        Returns the per-layer profile as a human-readable table.
+        """
+        rows = self.table()
+        total = sum(r['forward'] + r['backward'] for r in rows) or 1.0
+
+        lines = ["{:<28} {:>10} {:>10} {:>7} {:>10} {:>10}".format("layer", "fwd [ms]", "bwd [ms]", "%", "fwd [kB]", "bwd [kB]")]
+        for r in rows:
+            lines.append("{:<28} {:>10.2f} {:>10.2f} {:>6.1f}% {:>10.2f} {:>10.2f}".format(
+                r['layer'][:28], 1e3*r['forward'], 1e3*r['backward'],
+                100*(r['forward'] + r['backward'])/total,
+                r['forward_bytes']/1024, r['backward_bytes']/1024))
+        lines.append("{:<28} {:>10.2f} {:>10.2f}".format(
+            "total", 1e3*sum(r['forward'] for r in rows), 1e3*sum(r['backward'] for r in rows)))
+        return "\n".join(lines)
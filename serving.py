@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+In-process serving of a `StreaMiniPredictor` to requests arriving one sample
+at a time, by merging them into minibatches on a worker thread:
+
+    with MicroBatcher(StreaMiniPredictor(64, model), max_wait=0.002) as mb:
+        y = mb.predict(x)              # From any thread, blocking.
+        fut = mb.submit(x)             # From any thread, a future.
+        y = await mb.predict_async(x)  # From asyncio code.
+"""
+
+import DeepFried.util as _u
+
+import asyncio as _asyncio
+import collections as _coll
+import concurrent.futures as _fut
+import queue as _queue
+import threading as _thr
+import time as _time
+import numpy as _np
+
+
+class MicroBatcher(object):
+    """
+    Collects single-sample requests in a queue, from which a worker thread
+    merges as many as are pending, up to `batchsize`, into one minibatch and
+    computes the predictions for all of them with a single call of the
+    predictor's compiled function. To trade latency for fuller batches, the
+    worker waits up to `max_wait` seconds after the first request of a batch
+    for more to arrive.
+    """
+
+
+    def __init__(self, predictor, batchsize=None, max_wait=0.001, aug=None, fast=False):
+        """
+        - `predictor`: The `StreaMiniPredictor` to use.
+        - `batchsize`: The largest minibatch to merge requests into, defaults
+            to the predictor's.
+        - `max_wait`: How many seconds to wait for more requests to fill the
+            batch once one request came in.
+        - `aug`, `fast`: Optional test-time augmentation, as for `pred_epoch`.
+            With augmentation, the predictor's function is called once per
+            augmentation of the merged minibatch.
+        """
+        self.predictor = predictor
+        self.batchsize = batchsize or predictor.batchsize
+        self.max_wait = max_wait
+        self.aug = aug
+        self.fast = fast
+
+        self._queue = _queue.Queue()
+        self._thread = None
+        self._stop = object()
+
+        # Guards `_thread` and makes enqueueing a request atomic with the
+        # check that the worker runs, so none can land behind `_stop`.
+        self._lock = _thr.Lock()
+
+        self.nrequests = 0
+        self.nbatches = 0
+        self.max_queue_depth = 0
+        self.batch_sizes = _coll.Counter()
+
+
+    def start(self):
+        """ Starts the worker thread, returns `self` for convenience. """
+        with self._lock:
+            assert self._thread is None, "The MicroBatcher is already running."
+            self._thread = _thr.Thread(target=self._work, name="DeepFried MicroBatcher", daemon=True)
+            self._thread.start()
+        return self
+
+
+    def stop(self):
+        """
+        Answers all pending requests, then stops the worker thread. Requests
+        submitted meanwhile wait for it and then fail as not running.
+        """
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(self._stop)
+                self._thread.join()
+                self._thread = None
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *a):
+        self.stop()
+
+
+    def submit(self, *xs):
+        """
+        Requests the prediction for a single sample `xs` (one array per model
+        input, without minibatch dimension) and returns a
+        `concurrent.futures.Future` of it. Can be called from any thread, but
+        only while the worker thread is running.
+        """
+        f = _fut.Future()
+        with self._lock:
+            if self._thread is None:
+                raise RuntimeError("The MicroBatcher is not running, call `start` first.")
+            self._queue.put((xs, f))
+            self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return f
+
+
+    def predict(self, *xs, timeout=None):
+        """ Like `submit`, but blocks until the prediction is there. """
+        return self.submit(*xs).result(timeout)
+
+
+    def predict_async(self, *xs):
+        """ Like `submit`, but returns an awaitable for asyncio code. """
+        return _asyncio.wrap_future(self.submit(*xs))
+
+
+    def stats(self):
+        """
+        Returns a dict with the current `queue_depth`, the largest one seen,
+        the number of `requests` and `batches` so far, the average `fill` of
+        batches relative to `batchsize` and a histogram of `batch_sizes`.
+        """
+        return dict(
+            queue_depth=self._queue.qsize(),
+            max_queue_depth=self.max_queue_depth,
+            requests=self.nrequests,
+            batches=self.nbatches,
+            fill=self.nrequests/(self.nbatches*self.batchsize) if self.nbatches else 0.0,
+            batch_sizes=dict(self.batch_sizes),
+        )
+
+
+    def _work(self):
+        stop = False
+        while not stop:
+            # Block for the first request, then gather more until the batch
+            # is full or the deadline passed.
+            first = self._queue.get()
+            if first is self._stop:
+                break
+
+            reqs = [first]
+            deadline = _time.monotonic() + self.max_wait
+            while len(reqs) < self.batchsize:
+                try:
+                    r = self._queue.get(timeout=max(0, deadline - _time.monotonic()))
+                except _queue.Empty:
+                    break
+                if r is self._stop:
+                    stop = True
+                    break
+                reqs.append(r)
+
+            # Don't compute the ones which have been cancelled meanwhile.
+            reqs = [(xs, f) for xs, f in reqs if f.set_running_or_notify_cancel()]
+            if reqs:
+                self._run(reqs)
+
+
+    def _run(self, reqs):
+        try:
+            bxs = tuple(_np.stack(x) for x in zip(*(xs for xs, _ in reqs)))
+            if self.aug is None:
+                outs = _u.tuplize(self.predictor.predict_batch(*bxs))
+            else:
+                outs = _u.tuplize(self.predictor.pred_epoch(bxs, aug=self.aug, fast=self.fast, batchsize=len(reqs)))
+        except Exception as e:
+            # Don't let one bad request fail all others merged with it.
+            if len(reqs) > 1:
+                for r in reqs:
+                    self._run([r])
+            else:
+                reqs[0][1].set_exception(e)
+            return
+
+        self.nrequests += len(reqs)
+        self.nbatches += 1
+        self.batch_sizes[len(reqs)] += 1
+
+        for i, (_, f) in enumerate(reqs):
+            f.set_result(_u.maybetuple(o[i] for o in outs))
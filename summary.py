@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Static analysis of a model's cost without compiling or running anything:
+
+    print(summary(model, (3, 32, 32), batchsize=128).report())
+
+For each layer, this computes the output shape, the number and memory of
+parameters, the floating-point operations of the forward pass and the memory
+of the activations, from each layer's `analyze` method. The memory which each
+of the optimizers needs for its state is estimated too.
+"""
+
+import DeepFried.containers as _c
+import DeepFried.optim as _o
+
+import numpy as _np
+import theano as _th
+
+
+OPTIMIZERS = (
+    _o.StreaMiniSGD,
+    _o.StreaMiniMomentum,
+    _o.StreaMiniAdaGrad,
+    _o.StreaMiniRMSProp,
+    _o.StreaMiniAdaDelta,
+)
+
+
+def _walk(layer, shapes, path, rows, batchsize, itemsize):
+    """
+    Analyzes `layer` for inputs of the given `shapes`, appending one row per
+    non-container layer to `rows`, and returns the shapes of its outputs.
+    """
+    if isinstance(layer, _c.Sequence):
+        for i, l in enumerate(layer.layers):
+            shapes = _walk(l, shapes, path + ('.' if path else '') + str(i), rows, batchsize, itemsize)
+        return shapes
+
+    if isinstance(layer, _c.Parallel):
+        return sum((_walk(l, shapes, path + ('.' if path else '') + str(i), rows, batchsize, itemsize)
+                    for i, l in enumerate(layer.layers)), [])
+
+    outs, flops_train, flops_pred = [], 0, 0
+    for shape in shapes:
+        out, ft, fp = layer.analyze(shape)
+        outs.append(tuple(int(s) for s in out))
+        flops_train += ft
+        flops_pred += fp
+
+    params = [p.get_value(borrow=True) for p in layer.params]
+    buffers = [s.get_value(borrow=True) for s in layer.states() if s not in layer.params]
+
+    rows.append(dict(
+        layer=(path + ' ' if path else '') + type(layer).__name__,
+        outshape=outs[0] if len(outs) == 1 else tuple(outs),
+        params=sum(p.size for p in params),
+        param_bytes=sum(p.nbytes for p in params),
+        buffer_bytes=sum(b.nbytes for b in buffers if isinstance(b, _np.ndarray)),
+        flops_train=batchsize*int(flops_train),
+        flops_pred=batchsize*int(flops_pred),
+        in_bytes=batchsize*itemsize*sum(int(_np.prod(s)) for s in shapes),
+        out_bytes=batchsize*itemsize*sum(int(_np.prod(s)) for s in outs),
+    ))
+    return outs
+
+
+class Summary(object):
+    """
+    The result of `summary`. All FLOPs and activation memory are for a full
+    minibatch of `batchsize` samples.
+
+    - `layers`: A list with one dict per (non-container) layer, containing
+        the keys `layer`, `outshape`, `params`, `param_bytes`, `buffer_bytes`
+        (non-trainable state, e.g. batch-normalization statistics),
+        `flops_train`, `flops_pred`, `in_bytes` and `out_bytes`.
+    - `params`, `param_bytes`, `buffer_bytes`, `flops_train`, `flops_pred`:
+        The totals over all layers.
+    - `act_train`: The memory of the activations during training, when the
+        outputs of all layers need to be kept for the backward pass.
+    - `act_pred`: The memory of the activations during prediction, where
+        only the input and output of one layer at a time need to be kept.
+    - `optim_state`: The memory each of the optimizers needs for its state.
+    """
+
+
+    def __init__(self, layers, batchsize, optim_state):
+        self.layers = layers
+        self.batchsize = batchsize
+        self.optim_state = optim_state
+
+        for k in ('params', 'param_bytes', 'buffer_bytes', 'flops_train', 'flops_pred'):
+            setattr(self, k, sum(r[k] for r in layers))
+
+        self.act_train = (layers[0]['in_bytes'] if layers else 0) + sum(r['out_bytes'] for r in layers)
+        self.act_pred = max([r['in_bytes'] + r['out_bytes'] for r in layers] or [0])
+
+
+    def report(self):
+        """
+        Returns the summary as a human-readable table.
+        """
+        lines = ["{:<28} {:>18} {:>10} {:>12} {:>12} {:>10}".format(
+            "layer", "output shape", "params", "MFLOP train", "MFLOP pred", "out [kB]")]
+        for r in self.layers:
+            lines.append("{:<28} {:>18} {:>10} {:>12.2f} {:>12.2f} {:>10.1f}".format(
+                r['layer'][:28], str(r['outshape']), r['params'],
+                r['flops_train']/1e6, r['flops_pred']/1e6, r['out_bytes']/1024))
+        lines.append("{:<28} {:>18} {:>10} {:>12.2f} {:>12.2f}".format(
+            "total", "", self.params, self.flops_train/1e6, self.flops_pred/1e6))
+
+        lines.append("")
+        lines.append("batchsize:                {}".format(self.batchsize))
+        lines.append("parameters:               {:.1f} kB".format(self.param_bytes/1024))
+        lines.append("buffers:                  {:.1f} kB".format(self.buffer_bytes/1024))
+        lines.append("activations (training):   {:.1f} kB".format(self.act_train/1024))
+        lines.append("activations (prediction): {:.1f} kB".format(self.act_pred/1024))
+        for name, n in self.optim_state.items():
+            lines.append("{:<25} {:.1f} kB".format(name + " state:", n/1024))
+        return "\n".join(lines)
+
+
+def summary(model, input_shape, batchsize, state_dtype=None, state_blocksize=256):
+    """
+    Statically analyzes `model` for a minibatch of `batchsize` inputs of
+    shape `input_shape` (excluding the minibatch dimension) and returns a
+    `Summary`. Multiple inputs may be given as a list of shapes.
+
+    The optimizers' state memory is computed for the model's trainable
+    parameters, stored as given by `state_dtype` and `state_blocksize`, see
+    `StreaMiniOptimizer`.
+    """
+    shapes = input_shape if isinstance(input_shape, list) else [input_shape]
+    itemsize = _np.dtype(_th.config.floatX).itemsize
+
+    rows = []
+    _walk(model, [tuple(s) for s in shapes], '', rows, batchsize, itemsize)
+
+    pshapes = [p.get_value(borrow=True).shape for p, _ in model.trainable_params()]
+    optim_state = {cls.__name__: cls.state_nbytes_for(pshapes, state_dtype, state_blocksize) for cls in OPTIMIZERS}
+
+    return Summary(rows, batchsize, optim_state)
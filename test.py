@@ -3,10 +3,25 @@
 import numpy as _np
 import theano as _th
 
+import DeepFried.containers as _c
+import DeepFried.layers as _l
 import DeepFried.util as _u
 from DeepFried.layers import Layer
 
 
+def mk_model(seed=42, dropout=None):
+    """
+    Creates the small classifier of 10 inputs into 3 classes which most tests
+    train, with `Dropout` after its hidden layer if `dropout` is given.
+    """
+    layers = [_l.FullyConnected(10, 20), _l.Tanh()]
+    if dropout is not None:
+        layers.append(_l.Dropout(dropout))
+    model = _c.Sequence(*layers, _l.FullyConnected(20, 3), _l.Softmax())
+    model.reinit(seed)
+    return model
+
+
 def mk_train_output_fn(model):
     """
     Creates a theano function that computes the output of a forward pass
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import theano as th
+
+import DeepFried.bench as b
+import DeepFried.pred as p
+
+
+class TestCompare(unittest.TestCase):
+
+
+    def test_regressions(self):
+        old = [
+            dict(model='mlp', optimizer='sgd', augment=False, samples_per_sec=100.0, epoch_seconds=[1.0]),
+            dict(model='mlp', optimizer='sgd', augment=True, samples_per_sec=100.0, epoch_seconds=[1.0]),
+            dict(model='mlp', optimizer='adadelta', augment=False, samples_per_sec=100.0, epoch_seconds=[1.0]),
+        ]
+        new = [
+            dict(model='mlp', optimizer='sgd', augment=False, samples_per_sec=95.0, epoch_seconds=[2.0]),
+            dict(model='mlp', optimizer='sgd', augment=True, samples_per_sec=80.0, epoch_seconds=[2.0]),
+            dict(model='convnet', optimizer='sgd', augment=True, samples_per_sec=1.0, epoch_seconds=[2.0]),
+        ]
+
+        rows = b.compare(old, new, threshold=0.1)
+        self.assertEqual(len(rows), 2)
+        self.assertFalse(rows[0]['regression'])
+        self.assertTrue(rows[1]['regression'])
+        self.assertAlmostEqual(rows[1]['change'], -0.2)
+        self.assertEqual(rows[1]['key'], dict(model='mlp', optimizer='sgd', augment=True))
+
+
+def can_convolve():
+    """ Theano's convolution needs either a C compiler or an old scipy. """
+    try:
+        p.StreaMiniPredictor(1, b.mk_convnet()).pred_epoch(b.mk_images(n=1)[0])
+    except th.gof.utils.MethodNotDefined:
+        return False
+    return True
+
+
+class TestTrain(unittest.TestCase):
+
+
+    def check(self, mname):
+        res = b.train((mname,), optimizers=('sgd',), epochs=1, batchsize=16, n=32)
+        self.assertEqual([(r['model'], r['augment']) for r in res], [(mname, False), (mname, True)])
+        self.assertTrue(all(r['samples_per_sec'] > 0 for r in res))
+
+
+    def test_mlp(self):
+        self.check('mlp')
+
+
+    def test_convnet(self):
+        # The optimizer's gradients are built either way.
+        b.OPTIMIZERS['sgd'][0](16, b.mk_convnet(), b._costs.CategoricalCrossEntropy())
+        if not can_convolve():
+            self.skipTest("Theano can't run convolutions here.")
+        self.check('convnet')
+
+
+class TestLatency(unittest.TestCase):
+
+
+    def test_latency(self):
+        res = b.latency(('mlp',), batchsizes=(1, 4), tta=('none', 'full'), warmup=1, repeat=3)
+        self.assertEqual([(r['tta'], r['batchsize']) for r in res], [('none', 1), ('none', 4), ('full', 1), ('full', 4)])
+        for r in res:
+            self.assertLessEqual(r['p50_ms'], r['p95_ms'])
+            self.assertLessEqual(r['p95_ms'], r['p99_ms'])
+            self.assertGreater(r['samples_per_sec'], 0)
+
+        # Latencies are compared lower-is-better.
+        slower = [dict(r, p99_ms=2*r['p99_ms']) for r in res]
+        self.assertTrue(all(c['regression'] for c in b.compare(res, slower) if c['metric'] == 'p99_ms'))
+
+
+class TestFastpath(unittest.TestCase):
+
+
+    def test_fastpath(self):
+        res = b.fastpath(('mlp',), warmup=1, repeat=3)
+        self.assertEqual([r['call'] for r in res], ['pred_epoch', 'predict_one', 'predict_one_out'])
+        for r in res:
+            self.assertLessEqual(r['p50_ms'], r['p99_ms'])
+            self.assertGreater(r['samples_per_sec'], 0)
+
+
+class TestBranches(unittest.TestCase):
+
+
+    def test_branches(self):
+        res = b.branches(threads=(2,), batchsizes=(4,), ntowers=2, warmup=1, repeat=2)
+        self.assertEqual([r['threads'] for r in res], ['unfused', 'fused', 2])
+        self.assertTrue(all(r['samples_per_sec'] > 0 for r in res))
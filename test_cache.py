@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+import theano as th
+floatX = th.config.floatX
+
+import DeepFried.augmentation as aug
+import DeepFried.cache as c
+import DeepFried.pred as p
+
+from DeepFried.test import mk_model
+
+
+class CountingPredictor(p.StreaMiniPredictor):
+
+    def __init__(self, *a, **kw):
+        super(CountingPredictor, self).__init__(*a, **kw)
+        self.seen = []
+
+    def pred_epoch(self, X, *a, **kw):
+        self.seen.append(len(X[0]) if isinstance(X, tuple) else len(X))
+        return super(CountingPredictor, self).pred_epoch(X, *a, **kw)
+
+
+class TestCachedPredictor(unittest.TestCase):
+
+
+    def setUp(self):
+        self.X = np.random.randn(6, 10).astype(floatX)
+        self.pred = CountingPredictor(4, mk_model())
+        self.expected = self.pred.pred_epoch(self.X)
+        self.pred.seen = []
+
+
+    def test_hits(self):
+        cp = c.CachedPredictor(self.pred)
+        npt.assert_allclose(cp.pred_epoch(self.X[:4]), self.expected[:4], rtol=1e-6)
+
+        # Repeated rows within and across calls are computed only once.
+        X = self.X[[5, 0, 5, 2, 4]]
+        npt.assert_allclose(cp.pred_epoch(X), self.expected[[5, 0, 5, 2, 4]], rtol=1e-6)
+        self.assertEqual(self.pred.seen, [4, 2])
+
+        s = cp.stats()
+        self.assertEqual((s['hits'], s['misses'], s['entries']), (3, 6, 6))
+
+        # A new version of the model misses.
+        cp.version += 1
+        cp.pred_epoch(self.X[:1])
+        self.assertEqual(self.pred.seen, [4, 2, 1])
+
+        # As do different arguments to the prediction function.
+        self.assertNotEqual(cp.keys((self.X,), temperature=1), cp.keys((self.X,), temperature=2))
+
+
+    def test_tta_key(self):
+        pipe = aug.AugmentationPipeline(self.X, None, aug.Flipper([0]))
+        cp = c.CachedPredictor(self.pred)
+        cp.pred_epoch(self.X)
+        npt.assert_allclose(cp.pred_epoch(self.X, aug=pipe), self.pred.pred_epoch(self.X, aug=pipe), rtol=1e-6)
+        cp.pred_epoch(self.X, aug=pipe, fast=True)
+        cp.pred_epoch(self.X, aug=pipe)
+        self.assertEqual(self.pred.seen, [6, 6, 6, 6])
+
+        # Pipelines are told apart by their settings, not their identity.
+        cp.pred_epoch(self.X, aug=aug.AugmentationPipeline(self.X, None, aug.Flipper([0])))
+        self.assertEqual(self.pred.seen, [6, 6, 6, 6])
+        cp.pred_epoch(self.X, aug=aug.AugmentationPipeline(self.X, None, aug.Flipper([0]), aug.Flipper([0])))
+        self.assertEqual(self.pred.seen, [6, 6, 6, 6, 6])
+
+
+    def test_eviction(self):
+        rowbytes = self.expected[0].nbytes
+        cp = c.CachedPredictor(self.pred, maxbytes=3*rowbytes)
+        cp.pred_epoch(self.X[:4])
+        s = cp.stats()
+        self.assertEqual((s['entries'], s['bytes'], s['evictions'], s['evicted_bytes']), (3, 3*rowbytes, 1, rowbytes))
+
+        # Row 0 was the least recently used, touching 1 makes 2 next.
+        cp.pred_epoch(self.X[[1]])
+        cp.pred_epoch(self.X[[4]])
+        self.pred.seen = []
+        cp.pred_epoch(self.X[[1, 3, 4]])
+        self.assertEqual(self.pred.seen, [])
+        cp.pred_epoch(self.X[[2]])
+        self.assertEqual(self.pred.seen, [1])
@@ -163,3 +163,65 @@ class TestContainerCombos(unittest.TestCase):
 
         self.assertTrue(all(np.all(X == self.X) for X in outt))
         self.assertTrue(all(np.all(X == self.X) for X in outp))
+
+
+class TestFusedHeads(unittest.TestCase):
+
+
+    def setUp(self):
+        self.X = np.random.randn(50, 30).astype(floatX)
+        self.t = np.random.randint(3, size=50).astype(np.int32)
+
+
+    def mk_model(self, fuse):
+        model = c.Sequence(
+            l.FullyConnected(30, 20),
+            l.Tanh(),
+            c.Parallel(
+                c.Sequence(l.FullyConnected(20, 3), l.Softmax()),
+                l.FullyConnected(20, (2, 2), bias=False),
+                c.Sequence(l.FullyConnected(20, 5), l.Softmax()),
+                t.Identity(),
+                fuse=fuse,
+            ),
+        )
+        model.reinit(0)
+        return model
+
+
+    def test_same_as_unfused(self):
+        import DeepFried.pred as p
+        fused = p.StreaMiniPredictor(16, self.mk_model(True))
+        unfused = p.StreaMiniPredictor(16, self.mk_model(False))
+        for a, b in zip(fused.pred_epoch(self.X), unfused.pred_epoch(self.X)):
+            npt.assert_allclose(a, b, rtol=1e-5, atol=1e-6)
+
+        # The three heads share a single product.
+        def ndots(fn):
+            return sum('Dot' in type(n.op).__name__ or 'Gemm' in type(n.op).__name__ for n in fn.maker.fgraph.toposort())
+        self.assertEqual(ndots(fused.fn_pred), ndots(unfused.fn_pred) - 2)
+
+
+    def test_training(self):
+        import DeepFried.costs as cost
+        import DeepFried.optim as o
+
+        def train(fuse):
+            model = c.Sequence(
+                l.FullyConnected(30, 20),
+                l.Tanh(),
+                c.Parallel(
+                    c.Sequence(l.FullyConnected(20, 3), l.Softmax()),
+                    c.Sequence(l.FullyConnected(20, 3), l.Softmax()),
+                    fuse=fuse,
+                ),
+            )
+            model.reinit(0)
+            opt = o.StreaMiniMomentum(16, model, cost.MultiCost(cost.CategoricalCrossEntropy(), cost.CategoricalCrossEntropy()), momentum=0.9)
+            for _ in range(3):
+                opt.fit_epoch(self.X, (self.t, self.t[::-1]), lrate=0.1)
+            return model
+
+        m1, m2 = train(True), train(False)
+        for p1, p2 in zip(m1.params, m2.params):
+            npt.assert_allclose(p1.get_value(), p2.get_value(), rtol=1e-4, atol=1e-6)
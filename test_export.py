@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+import theano as th
+floatX = th.config.floatX
+
+import DeepFried.containers as c
+import DeepFried.costs as cost
+import DeepFried.export as e
+import DeepFried.layers as l
+import DeepFried.optim as o
+import DeepFried.pred as p
+
+
+def mk_bn_model(seed=42):
+    model = c.Sequence(
+        l.FullyConnected(10, 20),
+        l.BatchNormalization(20),
+        l.ReLU(leak=0.1),
+        l.Dropout(0.3),
+        l.FullyConnected(20, 3),
+        l.Softmax(),
+    )
+    model.reinit(seed)
+    return model
+
+
+class TestExport(unittest.TestCase):
+
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.X = np.random.randn(30, 10).astype(floatX)
+        self.t = np.random.randint(3, size=30).astype(np.int32)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+    def check(self, model):
+        e.export(model, self.dir)
+        loaded = e.load(self.dir)
+
+        for s in loaded.states():
+            if isinstance(s.get_value(borrow=True), np.ndarray):
+                self.assertIsInstance(s.get_value(borrow=True), np.memmap)
+                self.assertFalse(s.get_value(borrow=True).flags.writeable)
+
+        for a, b in zip(p.StreaMiniPredictor(8, model).pred_epoch(self.X),
+                        p.StreaMiniPredictor(8, loaded).pred_epoch(self.X)):
+            npt.assert_array_equal(a, b)
+
+        with open(os.path.join(self.dir, e.MANIFEST)) as f:
+            return json.load(f)
+
+
+    def test_trained(self):
+        model = mk_bn_model()
+        opt = o.StreaMiniSGD(10, model, cost.CategoricalCrossEntropy())
+        opt.fit_epoch(self.X, self.t, lrate=0.1)
+        opt.finalize(self.X, self.t)
+
+        m = self.check(model)
+        self.assertEqual(m['model']['type'], 'DeepFried.containers:Sequence')
+        self.assertEqual(m['model']['layers'][1]['config'], dict(nfeat=[20], post=True, momentum=False, eps=1e-6))
+        self.assertEqual(len(m['model']['layers'][1]['states']), 6)
+        self.assertEqual(m['model']['layers'][3]['states'], [])
+
+
+    def test_nested(self):
+        model = c.Sequence(
+            l.FullyConnected(10, 20),
+            l.Tanh(),
+            c.Parallel(
+                c.Sequence(l.FullyConnected(20, 3), l.Softmax()),
+                c.Sequence(l.FullyConnected(20, (2, 2), bias=False), l.Sigmoid(alt='hard')),
+            ),
+        )
+        model.reinit(0)
+
+        m = self.check(model)
+        self.assertEqual(m['model']['layers'][2]['config'], dict(fuse=False))
+        self.assertEqual(m['model']['layers'][2]['layers'][1]['layers'][0]['config'], dict(inshape=[20], outshape=[2, 2], bias=False, sparse=False))
+
+
+    def test_uninitialized(self):
+        # Loading doesn't allocate the parameters before binding the files.
+        with l.uninitialized():
+            layer = l.Embedding(10**6, 64)
+        self.assertEqual(layer.W.get_value(borrow=True).size, 0)
+
+        model = c.Sequence(l.Embedding(50, 10, inshape=(3,)), l.FullyConnected((3, 10), 3), l.Softmax())
+        model.reinit(0)
+        e.export(model, self.dir)
+        loaded = e.load(self.dir)
+        self.assertEqual(loaded.layers[0].W.get_value(borrow=True).shape, (50, 10))
+
+        ids = np.random.randint(50, size=(30, 3)).astype(np.int32)
+        for a, b in zip(p.StreaMiniPredictor(8, model).pred_epoch(ids),
+                        p.StreaMiniPredictor(8, loaded).pred_epoch(ids)):
+            npt.assert_array_equal(a, b)
+
+        # Layers constructed outside of it are initialized as usual.
+        self.assertEqual(l.FullyConnected(2, 3).W.get_value().shape, (2, 3))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import numpy.testing as npt
+import theano as th
+floatX = th.config.floatX
+
+import DeepFried.containers as c
+import DeepFried.costs as cost
+import DeepFried.finetune as ft
+import DeepFried.optim as o
+import DeepFried.pred as p
+
+from DeepFried.test import mk_model
+
+
+class TestFrozenPrefix(unittest.TestCase):
+
+
+    def setUp(self):
+        self.X = np.random.randn(40, 10).astype(floatX)
+        self.t = np.random.randint(3, size=40).astype(np.int32)
+        self.dir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+    def test_same_as_full_model(self):
+        # Training the suffix on cached features should do exactly what
+        # training the full model with the prefix's parameters fixed does.
+        model = mk_model(dropout=0.5)
+        frozen = ft.FrozenPrefix(model, 3)
+        feats = frozen.cache(self.X, batchsize=16)
+        self.assertEqual((feats.passes, len(feats)), (1, 40))
+
+        W0 = model.layers[0].W.get_value()
+        opt = frozen.optimizer(o.StreaMiniSGD, 8, cost.CategoricalCrossEntropy())
+        for e in range(2):
+            opt.fit_epoch(feats[e], self.t, lrate=0.1)
+
+        npt.assert_array_equal(W0, model.layers[0].W.get_value())
+
+        # The suffix's layers are the model's, so the full model predicts
+        # with what was just trained.
+        ref = mk_model(dropout=0.5)
+        optref = o.StreaMiniSGD(8, c.Sequence(*ref.layers[3:]), cost.CategoricalCrossEntropy())
+        h = p.StreaMiniPredictor(16, c.Sequence(*ref.layers[:3])).pred_epoch(self.X)
+        for e in range(2):
+            optref.fit_epoch(h, self.t, lrate=0.1)
+        npt.assert_allclose(model.layers[3].W.get_value(), ref.layers[3].W.get_value(), rtol=1e-5)
+
+
+    def test_stochastic_passes(self):
+        model = mk_model(dropout=0.5)
+        frozen = ft.FrozenPrefix(model, 3)
+        path = os.path.join(self.dir, 'feats.npy')
+        feats = frozen.cache(self.X, path, passes=3, batchsize=16)
+
+        self.assertEqual(feats.features.shape, (3, 40, 20))
+        self.assertTrue(np.any(feats[0] != feats[1]))
+        npt.assert_array_equal(feats[4], feats[1])
+
+        # Dropout zeroes about half of the features, scaled in prediction.
+        self.assertTrue(0.3 < np.mean(feats[0] == 0) < 0.7)
+        npt.assert_array_equal(np.load(path, mmap_mode='r'), feats.features)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+import theano as th
+floatX = th.config.floatX
+
+import DeepFried.containers as c
+import DeepFried.costs as cost
+import DeepFried.fncache as fnc
+import DeepFried.layers as l
+import DeepFried.optim as o
+import DeepFried.pred as p
+
+from DeepFried.test import mk_model
+
+
+def mk_dropout_model(seed=42, nhid=20):
+    model = c.Sequence(
+        l.FullyConnected(10, nhid),
+        l.Dropout(0.5),
+        l.FullyConnected(nhid, 3),
+        l.Softmax(),
+    )
+    model.reinit(seed)
+    return model
+
+
+class TestFunctionCache(unittest.TestCase):
+
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.X = np.random.randn(40, 10).astype(floatX)
+        self.t = np.random.randint(3, size=40).astype(np.int32)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+    def fit(self, model, cache, momentum=0.9):
+        opt = o.StreaMiniMomentum(16, model, cost.CategoricalCrossEntropy(), momentum=momentum, fncache=cache)
+        costs = [opt.fit_epoch(self.X, self.t, lrate=0.1) for _ in range(3)]
+        return costs, p.StreaMiniPredictor(16, model, fncache=cache).pred_epoch(self.X)
+
+
+    def test_rebind(self):
+        for mk in (mk_model, mk_dropout_model):
+            cache = fnc.FunctionCache(self.dir)
+            self.fit(mk(seed=1), cache)
+            self.assertFalse(any(r['loaded'] for r in cache.records))
+
+            # Functions loaded for another model train and predict exactly
+            # like freshly compiled ones, on that model's own parameters.
+            cache = fnc.FunctionCache(self.dir)
+            m1, m2 = mk(seed=2), mk(seed=2)
+            costs1, preds1 = self.fit(m1, cache)
+            costs2, preds2 = self.fit(m2, None)
+            self.assertTrue(all(r['loaded'] for r in cache.records))
+            self.assertEqual(costs1, costs2)
+            npt.assert_array_equal(preds1, preds2)
+            for p1, p2 in zip(m1.params, m2.params):
+                npt.assert_array_equal(p1.get_value(), p2.get_value())
+            self.assertIn('StreaMiniMomentum train', cache.report())
+
+
+    def test_key(self):
+        cache = fnc.FunctionCache(self.dir)
+        self.fit(mk_dropout_model(), cache)
+        self.fit(mk_dropout_model(nhid=30), cache)
+        self.fit(mk_dropout_model(), cache)
+        self.assertEqual([r['loaded'] for r in cache.records], [False]*2 + [False]*2 + [True]*2)
+
+        # The files don't contain the parameters.
+        self.assertEqual(len(os.listdir(self.dir)), 4)
+
+
+    def test_key_defaults(self):
+        # The momentum is the default of an input, not part of the graph.
+        cache = fnc.FunctionCache(self.dir)
+        self.fit(mk_model(), cache, momentum=0.9)
+        costs1, _ = self.fit(mk_model(), cache, momentum=0.5)
+        costs2, _ = self.fit(mk_model(), None, momentum=0.5)
+        self.assertFalse(any(r['loaded'] for r in cache.records if 'train' in r['name']))
+        self.assertEqual(costs1, costs2)
+
+
+    def test_describe(self):
+        self.assertEqual(fnc.describe(mk_model()), "Sequence[FullyConnected({0}(10, 20), {0}(20,)), Tanh(), FullyConnected({0}(20, 3), {0}(3,)), Softmax()]".format(floatX))
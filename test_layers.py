@@ -52,6 +52,132 @@ class TestFC(unittest.TestCase):
         npt.assert_allclose((XW    ).reshape(100,5,5), fn2p(X))
 
 
+    def test_sparse(self):
+        import scipy.sparse as sp
+        import DeepFried.costs as cost
+        import DeepFried.optim as o
+        import DeepFried.pred as p
+
+        D = (np.random.randn(40, 50) * (np.random.rand(40, 50) < 0.05)).astype(floatX)
+        S = sp.csr_matrix(D)
+        y = np.random.randint(3, size=40).astype(np.int32)
+
+        def mk(sparse):
+            m = c.Sequence(l.FullyConnected(50, 3, sparse=sparse), l.Softmax())
+            m.reinit(0)
+            return m
+
+        ms, md = mk(True), mk(False)
+        self.assertEqual(ms.make_inputs().type.format, 'csr')
+
+        # The same predictions, also through the fast path.
+        ps, pd = p.StreaMiniPredictor(16, ms), p.StreaMiniPredictor(16, md)
+        npt.assert_allclose(ps.pred_epoch(S), pd.pred_epoch(D), rtol=1e-5)
+        npt.assert_allclose(ps.predict_batch(S[:8]), pd.predict_batch(D[:8]), rtol=1e-5)
+        npt.assert_allclose(ps.predict_one(S[3]), pd.predict_one(D[3]), rtol=1e-5)
+
+        # And the same training, also when shuffling and asking for
+        # multiple steps at once, which sparse inputs are done without.
+        opts = o.StreaMiniMomentum(16, ms, cost.CategoricalCrossEntropy(), momentum=0.9, nsteps=2)
+        optd = o.StreaMiniMomentum(16, md, cost.CategoricalCrossEntropy(), momentum=0.9)
+        for e in range(2):
+            opts.fit_epoch(S, y, lrate=0.1, shuf=e)
+            optd.fit_epoch(D, y, lrate=0.1, shuf=e)
+        for a, b in zip(ms.params, md.params):
+            npt.assert_allclose(a.get_value(), b.get_value(), rtol=1e-4, atol=1e-6)
+
+
+class TestEmbedding(unittest.TestCase):
+
+
+    def test_lookup(self):
+        W = np.random.randn(7, 3).astype(floatX)
+        emb1 = l.Embedding(7, 3, W=W)
+        emb2 = l.Embedding(7, 3, inshape=(2,), W=W)
+
+        ids = np.array([4, 0, 4, 6], dtype=np.int32)
+        npt.assert_array_equal(W[ids], t.mk_train_output_fn(emb1)(ids))
+        npt.assert_array_equal(W[ids.reshape(2, 2)], t.mk_pred_output_fn(emb2)(ids.reshape(2, 2)))
+        self.assertEqual(emb2.analyze((2,))[0], (2, 3))
+
+        # Initialized on its own, never by other layers.
+        emb = c.Sequence(l.Embedding(1000, 16), l.ReLU()).layers[0]
+        self.assertEqual(emb.Ws, [])
+        self.assertAlmostEqual(emb.W.get_value().std(), 0.25, delta=0.02)
+
+
+class TestHashedEmbedding(unittest.TestCase):
+
+
+    def test_hash(self):
+        words = np.array(['apple', 'pear', 'fig', 'apple'])
+        h = l.hash64(words)
+        self.assertEqual(h.dtype, np.uint64)
+        self.assertEqual(h[0], h[3])
+        self.assertEqual(len(set(h)), 3)
+
+        # Independent of the array's string width and type.
+        npt.assert_array_equal(h, l.hash64(words.astype('U20')))
+        npt.assert_array_equal(h, l.hash64(words.astype(object)))
+        self.assertFalse(np.any(h == l.hash64(words, seed=1)))
+
+        ids = np.arange(-5, 5).reshape(2, 5)
+        self.assertEqual(l.hash64(ids).shape, (2, 5))
+        npt.assert_array_equal(l.hash64(ids), l.hash64(ids.astype(np.int16)))
+
+
+    def test_prepare(self):
+        ids = np.random.randint(2**40, size=(1000, 3))
+        b = l.HashedEmbedding(100, 4, inshape=(3,)).prepare(ids)
+        self.assertEqual((b.dtype, b.shape), (np.int32, (1000, 3)))
+        self.assertTrue(0 <= b.min() and b.max() < 100)
+
+        s = l.HashedEmbedding(100, 4, inshape=(3,), signed=True).prepare(ids)
+        npt.assert_array_equal(abs(s) - 1, b)
+        self.assertAlmostEqual(np.mean(s > 0), 0.5, delta=0.05)
+
+
+    def test_signed(self):
+        W = np.random.randn(10, 3).astype(floatX)
+        emb = l.HashedEmbedding(10, 3, signed=True, W=W)
+
+        words = np.array(['a', 'b', 'c', 'd', 'e', 'a'])
+        s = emb.prepare(words)
+        npt.assert_allclose(np.sign(s)[:,None] * W[abs(s)-1], t.mk_train_output_fn(emb)(s))
+
+
+    def test_training(self):
+        import DeepFried.costs as cost
+        import DeepFried.optim as o
+        import DeepFried.pred as p
+
+        words = np.array(['w{}'.format(i) for i in np.random.randint(1000, size=64)])
+        y = np.random.randint(3, size=64).astype(np.int32)
+
+        # Training on words is training on their buckets.
+        def mk(cls, **kw):
+            m = c.Sequence(cls(50, 4, **kw), l.FullyConnected(4, 3), l.Softmax())
+            m.reinit(0)
+            m.layers[1].W.set_value(np.random.RandomState(0).randn(4, 3).astype(floatX))
+            return m
+
+        mh, me = mk(l.HashedEmbedding, seed=3), mk(l.Embedding)
+        buckets = mh.prepare(words)
+        opth = o.StreaMiniAdaGrad(16, mh, cost.CategoricalCrossEntropy())
+        opte = o.StreaMiniAdaGrad(16, me, cost.CategoricalCrossEntropy())
+        self.assertIsNotNone(opth.rows[0])
+        for e in range(2):
+            opth.fit_epoch(words, y, lrate=0.1, shuf=e)
+            opte.fit_epoch(buckets, y, lrate=0.1, shuf=e)
+
+        for a, b in zip(mh.params, me.params):
+            npt.assert_allclose(a.get_value(), b.get_value(), rtol=1e-5)
+
+        ph = p.StreaMiniPredictor(16, mh)
+        npt.assert_allclose(ph.pred_epoch(words), p.StreaMiniPredictor(16, me).pred_epoch(buckets), rtol=1e-5)
+        npt.assert_allclose(ph.predict_batch(words[:5]), ph.pred_epoch(words[:5]), rtol=1e-5)
+
+
 class TestSoftmax(unittest.TestCase):
 
 
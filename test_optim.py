@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+import tempfile
+
+import numpy as np
+import numpy.testing as npt
+import theano as th
+floatX = th.config.floatX
+
+import DeepFried.augmentation as aug
+import DeepFried.containers as c
+import DeepFried.costs as cost
+import DeepFried.layers as l
+import DeepFried.optim as o
+
+from DeepFried.test import mk_model
+
+
+class TestAccumulate(unittest.TestCase):
+
+
+    def setUp(self):
+        self.X = np.random.randn(96, 10).astype(floatX)
+        self.t = np.random.randint(3, size=96).astype(np.int32)
+
+
+    def _check_same_as_large_batch(self, cls, **kw):
+        m1, m2 = mk_model(), mk_model()
+
+        # Accumulating the gradients of 4 minibatches of 8 should be just the
+        # same as computing the gradient of one minibatch of 32.
+        opt1 = cls(32, m1, cost.CategoricalCrossEntropy(), **kw)
+        opt2 = cls(8, m2, cost.CategoricalCrossEntropy(), accumulate=4, **kw)
+
+        for _ in range(2):
+            opt1.fit_epoch(self.X, self.t, **self.fitkw)
+            opt2.fit_epoch(self.X, self.t, **self.fitkw)
+
+        for p1, p2 in zip(m1.params, m2.params):
+            npt.assert_allclose(p1.get_value(), p2.get_value(), rtol=1e-4, atol=1e-6)
+
+
+    def test_sgd(self):
+        self.fitkw = dict(lrate=0.1)
+        self._check_same_as_large_batch(o.StreaMiniSGD)
+
+
+    def test_momentum(self):
+        self.fitkw = dict(lrate=0.1)
+        self._check_same_as_large_batch(o.StreaMiniMomentum, momentum=0.9, nesterov=True)
+
+
+    def test_adagrad(self):
+        self.fitkw = dict(lrate=0.1)
+        self._check_same_as_large_batch(o.StreaMiniAdaGrad)
+
+
+    def test_rmsprop(self):
+        self.fitkw = dict(lrate=0.01)
+        self._check_same_as_large_batch(o.StreaMiniRMSProp)
+
+
+    def test_adadelta(self):
+        self.fitkw = {}
+        self._check_same_as_large_batch(o.StreaMiniAdaDelta)
+
+
+    def test_leftover(self):
+        m1, m2 = mk_model(), mk_model()
+
+        # With 88 samples, the last of the three updates of the accumulating
+        # optimizer only averages over the three left-over minibatches.
+        X, t = self.X[:88], self.t[:88]
+        opt1 = o.StreaMiniSGD(32, m1, cost.CategoricalCrossEntropy())
+        opt2 = o.StreaMiniSGD(8, m2, cost.CategoricalCrossEntropy(), accumulate=4)
+
+        opt1.fit_epoch(X, t, lrate=0.1)
+        cost2 = opt2.fit_epoch(X, t, lrate=0.1)
+
+        for p1, p2 in zip(m1.params, m2.params):
+            npt.assert_allclose(p1.get_value(), p2.get_value(), rtol=1e-4, atol=1e-6)
+
+        # And nothing should be left in the accumulators.
+        self.assertEqual(opt2.sh_nacc.get_value(), 0)
+        self.assertTrue(all(np.all(a.get_value() == 0) for a in opt2.sh_gacc))
+        self.assertTrue(np.isfinite(cost2))
+
+
+class TestMultiStep(unittest.TestCase):
+
+
+    def test_same_as_single_steps(self):
+        X = np.random.randn(100, 10).astype(floatX)
+        t = np.random.randint(3, size=100).astype(np.int32)
+
+        for cls, kw, fitkw in [
+            (o.StreaMiniSGD, {}, dict(lrate=0.1)),
+            (o.StreaMiniMomentum, dict(momentum=0.9, nesterov=True), dict(lrate=0.1)),
+            (o.StreaMiniAdaDelta, {}, {}),
+        ]:
+            m1, m2 = mk_model(), mk_model()
+            opt1 = cls(8, m1, cost.CategoricalCrossEntropy(), **kw)
+            opt2 = cls(8, m2, cost.CategoricalCrossEntropy(), nsteps=5, **kw)
+
+            # 13 minibatches: two blocks of 5, then three single steps
+            # of which the last one is smaller.
+            for e in range(2):
+                c1 = opt1.fit_epoch(X, t, shuf=e, **fitkw)
+                c2 = opt2.fit_epoch(X, t, shuf=e, **fitkw)
+                npt.assert_allclose(c1, c2, rtol=1e-4)
+
+            for p1, p2 in zip(m1.params, m2.params):
+                npt.assert_allclose(p1.get_value(), p2.get_value(), rtol=1e-4, atol=1e-6)
+
+
+    def test_python_loop(self):
+        # What's used where scan's C implementation can't be built.
+        old, o._scan_c_error = o._scan_c_error, RuntimeError("Just testing.")
+        try:
+            self.test_same_as_single_steps()
+        finally:
+            o._scan_c_error = old
+
+
+class TestStateDtype(unittest.TestCase):
+
+
+    def setUp(self):
+        self.X = np.random.randn(96, 10).astype(floatX)
+        self.t = np.random.randint(3, size=96).astype(np.int32)
+
+
+    def test_quantized_roundtrip(self):
+        val = np.random.randn(30, 20).astype(floatX)
+        q = o._QuantizedState(val, 'q', blocksize=64)
+        npt.assert_allclose(q.get_value(), val, atol=np.abs(val).max()/127)
+        self.assertLess(q.nbytes, val.nbytes/2)
+
+        val = np.abs(val)
+        q = o._QuantizedState(val, 'q', nonneg=True, blocksize=64)
+        npt.assert_allclose(np.sqrt(q.get_value()), np.sqrt(val), atol=np.sqrt(val.max())/255)
+        self.assertTrue(np.all(q.get_value() >= 0))
+
+
+    def test_training(self):
+        for cls, kw, fitkw in [
+            (o.StreaMiniMomentum, dict(momentum=0.9), dict(lrate=0.1)),
+            (o.StreaMiniAdaGrad, {}, dict(lrate=0.1)),
+            (o.StreaMiniRMSProp, {}, dict(lrate=0.01)),
+            (o.StreaMiniAdaDelta, {}, {}),
+        ]:
+            nbytes = {}
+            for dtype in (None, 'float16', 'int8'):
+                m = mk_model()
+                opt = cls(16, m, cost.CategoricalCrossEntropy(), state_dtype=dtype, state_blocksize=32, **kw)
+                costs = [opt.fit_epoch(self.X, self.t, **fitkw) for _ in range(5)]
+                self.assertTrue(all(np.isfinite(costs)), (cls, dtype, costs))
+                self.assertLess(costs[-1], costs[0], (cls, dtype, costs))
+                nbytes[dtype] = opt.state_nbytes()
+
+                opt.reinit()
+
+            self.assertEqual(nbytes['float16']*np.dtype(floatX).itemsize, nbytes[None]*2)
+            self.assertLess(nbytes['int8'], nbytes['float16'])
+
+
+class TestCheckpoint(unittest.TestCase):
+
+
+    def setUp(self):
+        self.X = np.random.randn(96, 10).astype(floatX)
+        self.t = np.random.randint(3, size=96).astype(np.int32)
+        self.aug = aug.AugmentationPipeline(self.X, self.t, aug.Flipper([0]))
+        self.path = os.path.join(tempfile.mkdtemp(), 'ckpt')
+
+
+    def tearDown(self):
+        os.remove(self.path)
+
+
+    def mk(self, seed):
+        model = c.Sequence(
+            l.FullyConnected(10, 20),
+            l.BatchNormalization(20, post=False),
+            l.ReLU(),
+            l.Dropout(),
+            l.FullyConnected(20, 3),
+            l.Softmax(),
+        )
+        model.reinit(seed)
+        opt = o.StreaMiniMomentum(8, model, cost.CategoricalCrossEntropy(), momentum=0.9, accumulate=3, state_dtype='int8')
+        return model, opt
+
+
+    def test_resume_mid_epoch(self):
+        m1, opt1 = self.mk(42)
+        rng1 = np.random.RandomState(1)
+        np.random.seed(5)
+
+        opt1.fit_epoch(self.X, self.t, aug=self.aug, shuf=rng1, lrate=0.1)
+        # The last checkpoint is taken after the 10th of 12 minibatches.
+        c2 = opt1.fit_epoch(self.X, self.t, aug=self.aug, shuf=rng1, ckpt=self.path, ckpt_every=5, lrate=0.1)
+        c3 = opt1.fit_epoch(self.X, self.t, aug=self.aug, shuf=rng1, lrate=0.1)
+        opt1.ckpt_thread.join()
+
+        # Everything is different in the new process, ...
+        m2, opt2 = self.mk(0)
+        rng2 = np.random.RandomState(2)
+        np.random.seed(6)
+
+        # ... until we resume.
+        opt2.resume(self.path)
+        c2b = opt2.fit_epoch(self.X, self.t, aug=self.aug, shuf=rng2, lrate=0.1)
+        c3b = opt2.fit_epoch(self.X, self.t, aug=self.aug, shuf=rng2, lrate=0.1)
+
+        self.assertEqual(c2, c2b)
+        self.assertEqual(c3, c3b)
+        for p1, p2 in zip(m1.states(), m2.states()):
+            if isinstance(p1.get_value(), np.random.RandomState):
+                npt.assert_array_equal(p1.get_value().get_state()[1], p2.get_value().get_state()[1])
+            else:
+                npt.assert_array_equal(p1.get_value(), p2.get_value())
+        for s1, s2 in zip(opt1.states, opt2.states):
+            npt.assert_array_equal(s1.get_value(), s2.get_value())
+
+
+    def test_model(self):
+        m1, opt1 = self.mk(42)
+        opt1.fit_epoch(self.X, self.t, lrate=0.1)
+        m1.checkpoint(self.path)
+
+        m2, _ = self.mk(0)
+        m2.resume(self.path)
+
+        self.assertEqual(len(m1.states()), len(m2.states()))
+        for p1, p2 in zip(m1.params + m1.layers[1].states(), m2.params + m2.layers[1].states()):
+            npt.assert_array_equal(p1.get_value(), p2.get_value())
+
+        # Resuming into a different model should fail loudly.
+        with self.assertRaises(ValueError):
+            c.Sequence(l.FullyConnected(10, 3)).resume(self.path)
+
+
+class TestTrainable(unittest.TestCase):
+
+
+    def setUp(self):
+        self.X = np.random.randn(32, 10).astype(floatX)
+        self.t = np.random.randint(3, size=32).astype(np.int32)
+
+
+    def test_frozen_layer(self):
+        model = mk_model()
+        model.layers[0].freeze()
+        before = [p.get_value() for p in model.params]
+
+        opt = o.StreaMiniMomentum(8, model, cost.CategoricalCrossEntropy(), momentum=0.9)
+        opt.fit_epoch(self.X, self.t, lrate=0.1)
+
+        # Neither updates nor state for the frozen layer's parameters.
+        self.assertEqual(opt.params, model.layers[2].params)
+        self.assertEqual(len(opt.sh_v), 2)
+        for p, b in zip(model.layers[0].params, before):
+            npt.assert_array_equal(p.get_value(), b)
+        self.assertFalse(np.array_equal(model.layers[2].W.get_value(), before[2]))
+
+        # So the backward pass doesn't need to go below the second layer.
+        topo = opt.fn_train.maker.fgraph.toposort()
+        self.assertFalse(any(model.layers[0].W in n.inputs for n in topo))
+
+
+    def test_frozen_param(self):
+        model = mk_model()
+        model.freeze(model.layers[2].b)
+        b = model.layers[2].b.get_value()
+
+        opt = o.StreaMiniSGD(8, model, cost.CategoricalCrossEntropy())
+        opt.fit_epoch(self.X, self.t, lrate=0.1)
+
+        self.assertEqual(len(opt.params), 3)
+        npt.assert_array_equal(model.layers[2].b.get_value(), b)
+
+        model.unfreeze(model.layers[2].b)
+        self.assertEqual(len(model.trainable_params()), 4)
+
+
+    def test_lr_mult(self):
+        m1, m2 = mk_model(), mk_model()
+        m2.lr_mult = 2
+        m2.layers[0].lr_mult = 0.5
+        m2.layers[2].b._df_lr_mult = 0.25
+
+        opt1 = o.StreaMiniSGD(8, m1, cost.CategoricalCrossEntropy())
+        opt2 = o.StreaMiniSGD(8, m2, cost.CategoricalCrossEntropy())
+        self.assertEqual(opt2.lr_mults, [1, 1, 2, 0.5])
+
+        # A single step, which can thus be compared parameter-wise.
+        opt1.fit_epoch(self.X[:8], self.t[:8], lrate=0.1)
+        opt2.fit_epoch(self.X[:8], self.t[:8], lrate=0.1)
+
+        p0 = mk_model().params
+        for p1, p2, q, m in zip(m1.params, m2.params, p0, opt2.lr_mults):
+            npt.assert_allclose(p2.get_value() - q.get_value(), m*(p1.get_value() - q.get_value()), rtol=1e-4, atol=1e-7)
+
+
+class TestSparseRows(unittest.TestCase):
+
+
+    def setUp(self):
+        # Lots of repeated IDs, and many never looked up.
+        self.ids = np.random.randint(20, size=32).astype(np.int32)
+        self.t = np.random.randint(3, size=32).astype(np.int32)
+
+
+    def mk(self):
+        emb = c.Sequence(l.Embedding(50, 4), l.FullyConnected(4, 3), l.Softmax())
+        emb.reinit(0)
+        # Softmax initializes to zeros, which wouldn't propagate gradients.
+        emb.layers[1].W.set_value(np.random.randn(4, 3).astype(floatX))
+        onehot = c.Sequence(l.FullyConnected(50, 4, bias=False), l.FullyConnected(4, 3), l.Softmax())
+        for p, q in zip(onehot.params, emb.params):
+            p.set_value(q.get_value())
+        return emb, onehot
+
+
+    def _check_same_as_onehot(self, cls, **kw):
+        emb, onehot = self.mk()
+        opt1 = cls(8, emb, cost.CategoricalCrossEntropy(), **kw)
+        opt2 = cls(8, onehot, cost.CategoricalCrossEntropy(), **kw)
+        self.assertIsNotNone(opt1.rows[0])
+        self.assertIsNone(opt2.rows[0])
+
+        # The table and its state are written row-wise, in-place.
+        names = [opt1.params[0].name] + [s.name for s in opt1.states[:opt1.nstates]]
+        rowwise = [n for n in opt1.fn_train.maker.fgraph.toposort()
+                   if isinstance(n.op, th.tensor.subtensor.AdvancedIncSubtensor1) and n.op.inplace and n.inputs[0].name in names]
+        self.assertEqual(len(rowwise), len(names))
+
+        X = np.eye(50, dtype=floatX)[self.ids]
+        for _ in range(2):
+            opt1.fit_epoch(self.ids, self.t, lrate=0.1)
+            opt2.fit_epoch(X, self.t, lrate=0.1)
+
+        for p1, p2 in zip(emb.params, onehot.params):
+            npt.assert_allclose(p1.get_value(), p2.get_value(), rtol=1e-4, atol=1e-6)
+        return emb
+
+
+    def test_sgd(self):
+        self._check_same_as_onehot(o.StreaMiniSGD)
+
+
+    def test_adagrad(self):
+        self._check_same_as_onehot(o.StreaMiniAdaGrad)
+
+
+    def test_lazy_momentum(self):
+        emb, _ = self.mk()
+        opt = o.StreaMiniMomentum(32, emb, cost.CategoricalCrossEntropy(), momentum=0.9)
+        opt.fit_epoch(self.ids, self.t, lrate=0.1)
+        W = emb.layers[0].W.get_value()
+
+        # Rows which aren't looked up keep both their value and momentum.
+        ids = np.where(self.ids < 10, self.ids, 0).astype(np.int32)
+        opt.fit_epoch(ids, self.t, lrate=0.1)
+        W2 = emb.layers[0].W.get_value()
+        untouched = np.setdiff1d(np.arange(50), ids)
+        npt.assert_array_equal(W2[untouched], W[untouched])
+        self.assertFalse(np.allclose(W2[ids], W[ids]))
+        self.assertTrue(np.any(opt.sh_v[0].get_value()[np.setdiff1d(self.ids, ids)] != 0))
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+import theano as th
+floatX = th.config.floatX
+
+import DeepFried.augmentation as aug
+import DeepFried.costs as cost
+import DeepFried.optim as o
+import DeepFried.parallel as par
+import DeepFried.pred as p
+
+from DeepFried.test import mk_model
+
+
+class TestDataParallel(unittest.TestCase):
+
+
+    def setUp(self):
+        self.X = np.random.randn(96, 10).astype(floatX)
+        self.t = np.random.randint(3, size=96).astype(np.int32)
+
+
+    def test_grads_same_as_single(self):
+        m1, m2 = mk_model(), mk_model()
+
+        opt = o.StreaMiniMomentum(32, m1, cost.CategoricalCrossEntropy(), momentum=0.9)
+        dp = par.DataParallel(2, o.StreaMiniMomentum, 32, m2, cost.CategoricalCrossEntropy(), momentum=0.9, mode='grads')
+
+        for _ in range(2):
+            c1 = opt.fit_epoch(self.X, self.t, lrate=0.1)
+            c2 = dp.fit_epoch(self.X, self.t, lrate=0.1)
+
+        npt.assert_allclose(c1, c2, rtol=1e-4)
+        for p1, p2 in zip(m1.params, m2.params):
+            npt.assert_allclose(p1.get_value(), p2.get_value(), rtol=1e-4, atol=1e-6)
+
+
+    def test_uneven_shards(self):
+        # Minibatches of 10 split into shards of 4, 3 and 3, and the last
+        # one of 6 into 2 each.
+        for mode, cls in (('grads', o.StreaMiniMomentum), ('params', o.StreaMiniSGD)):
+            m1, m2 = mk_model(), mk_model()
+            kw = dict(momentum=0.9) if cls is o.StreaMiniMomentum else {}
+            opt = cls(10, m1, cost.CategoricalCrossEntropy(), **kw)
+            dp = par.DataParallel(3, cls, 10, m2, cost.CategoricalCrossEntropy(), mode=mode, **kw)
+
+            opt.fit_epoch(self.X, self.t, lrate=0.1)
+            dp.fit_epoch(self.X, self.t, lrate=0.1)
+
+            for p1, p2 in zip(m1.params, m2.params):
+                npt.assert_allclose(p1.get_value(), p2.get_value(), rtol=1e-4, atol=1e-6, err_msg=mode)
+
+
+    def test_params(self):
+        m1, m2 = mk_model(), mk_model()
+
+        # For SGD, averaging the parameters after a step is the same as
+        # averaging the gradients.
+        opt = o.StreaMiniSGD(32, m1, cost.CategoricalCrossEntropy())
+        dp = par.DataParallel(2, o.StreaMiniSGD, 32, m2, cost.CategoricalCrossEntropy(), mode='params')
+
+        opt.fit_epoch(self.X, self.t, lrate=0.1)
+        dp.fit_epoch(self.X, self.t, lrate=0.1)
+
+        for p1, p2 in zip(m1.params, m2.params):
+            npt.assert_allclose(p1.get_value(), p2.get_value(), rtol=1e-4, atol=1e-6)
+
+
+    def test_hogwild(self):
+        m = mk_model()
+        before = [p.get_value() for p in m.params]
+
+        dp = par.DataParallel(2, o.StreaMiniSGD, 32, m, cost.CategoricalCrossEntropy(), mode='hogwild')
+        c = dp.fit_epoch(self.X, self.t, shuf=0, lrate=0.1)
+
+        self.assertTrue(np.isfinite(c))
+        self.assertTrue(any(np.any(b != p.get_value()) for b, p in zip(before, m.params)))
+        self.assertGreater(dp.samples_per_sec, 0)
+
+
+    def test_accumulate(self):
+        # Would silently be replaced by the number of workers otherwise.
+        with self.assertRaises(AssertionError):
+            par.DataParallel(2, o.StreaMiniSGD, 32, mk_model(), cost.CategoricalCrossEntropy(), accumulate=4)
+
+
+class TestParallelPredictor(unittest.TestCase):
+
+
+    def setUp(self):
+        self.X = np.random.randn(100, 10).astype(floatX)
+        self.pred = p.StreaMiniPredictor(16, mk_model())
+
+
+    def test_same_as_single(self):
+        pp = par.ParallelPredictor(3, self.pred)
+        npt.assert_array_equal(pp.pred_epoch(self.X), self.pred.pred_epoch(self.X))
+        npt.assert_array_equal(pp.pred_epoch(self.X, batchsize=7), self.pred.pred_epoch(self.X, batchsize=7))
+        self.assertEqual(pp.pred_epoch(self.X[:0]).shape, (0, 3))
+        npt.assert_array_equal(pp.pred_epoch(self.X[:5]), self.pred.pred_epoch(self.X[:5]))
+
+        pipe = aug.AugmentationPipeline(self.X, None, aug.Flipper([0]))
+        npt.assert_allclose(pp.pred_epoch(self.X, aug=pipe), self.pred.pred_epoch(self.X, aug=pipe), rtol=1e-6)
+
+
+    def test_batch_agg(self):
+        # One that doesn't concatenate, and outputs which aren't per-sample.
+        self.pred.batch_aggs = (lambda outs: np.stack([o.sum(axis=0) for o in outs]),)
+        pp = par.ParallelPredictor(2, self.pred)
+        npt.assert_allclose(pp.pred_epoch(self.X), self.pred.pred_epoch(self.X), rtol=1e-5)
+
+        fn = self.pred.fn_pred
+        self.pred.fn_pred = lambda *a: [fn(*a)[0].mean(axis=0)]
+        npt.assert_allclose(pp.pred_epoch(self.X), self.pred.pred_epoch(self.X), rtol=1e-5)
+
+
+    def test_speedup(self):
+        report = par.prediction_speedup(lambda n: par.ParallelPredictor(n, self.pred), self.X, nworkers=(1, 2))
+        self.assertEqual([r['nworkers'] for r in report], [1, 2])
+        self.assertEqual(report[0]['speedup'], 1)
+        self.assertTrue(all(r['samples_per_sec'] > 0 for r in report))
+
+
+class TestParameterServer(unittest.TestCase):
+
+
+    def setUp(self):
+        self.X = np.random.randn(96, 10).astype(floatX)
+        self.t = np.random.randint(3, size=96).astype(np.int32)
+
+
+    def test_single_worker_same_as_local(self):
+        m1, m2, m3 = mk_model(), mk_model(), mk_model(0)
+
+        opt = o.StreaMiniMomentum(16, m1, cost.CategoricalCrossEntropy(), momentum=0.9)
+        ps = par.ParameterServer(o.StreaMiniMomentum, 16, m2, cost.CategoricalCrossEntropy(), momentum=0.9)
+        addr = ps.start()
+
+        try:
+            w = par.PSWorker(addr, o.StreaMiniMomentum, 16, m3, cost.CategoricalCrossEntropy(), momentum=0.9)
+            for _ in range(2):
+                c1 = opt.fit_epoch(self.X, self.t, lrate=0.1)
+                c2 = w.fit_epoch(self.X, self.t, lrate=0.1)
+            w.pull()
+            w.close()
+        finally:
+            ps.stop()
+
+        npt.assert_allclose(c1, c2, rtol=1e-4)
+        for p1, p3 in zip(m1.params, m3.params):
+            npt.assert_allclose(p1.get_value(), p3.get_value(), rtol=1e-4, atol=1e-6)
+        self.assertEqual(w.version, 2*6)
+
+
+    def test_staleness(self):
+        ps = par.ParameterServer(o.StreaMiniSGD, 16, mk_model(), cost.CategoricalCrossEntropy())
+        addr = ps.start()
+
+        try:
+            # The worker's own updates are only on the server, so they count.
+            w = par.PSWorker(addr, o.StreaMiniSGD, 16, mk_model(0), cost.CategoricalCrossEntropy(), staleness=1)
+            w.fit_epoch(self.X, self.t, lrate=0.1)
+            w.close()
+        finally:
+            ps.stop()
+
+        self.assertEqual(w.npushes, 6)
+        self.assertEqual(w.npulls, 1 + 3)
+        self.assertEqual(w.version, 6)
+
+
+    def test_bad_requests(self):
+        ps = par.ParameterServer(o.StreaMiniSGD, 16, mk_model(), cost.CategoricalCrossEntropy())
+        addr = ps.start()
+
+        try:
+            w = par.PSWorker(addr, o.StreaMiniSGD, 16, mk_model(0), cost.CategoricalCrossEntropy())
+            w.pull()
+
+            # Unknown arguments of the update function, and truncated
+            # gradients, are rejected without killing the connection.
+            with self.assertRaisesRegex(RuntimeError, 'lrate'):
+                w.push(lrate=0.1, rm_rf=1)
+            par._send(w.sock, b'g', par._VERSION.pack(2), b'{}', b'\0'*8)
+            with self.assertRaisesRegex(RuntimeError, 'bytes'):
+                w._reply(b'V')
+            w.push(lrate=0.1)
+            self.assertEqual(w.version, 1)
+
+            # Nor are huge messages read, those do end the connection.
+            w.sock.sendall(par._HEADER.pack(b'g', 2**40))
+            with self.assertRaisesRegex(RuntimeError, 'limit'):
+                w._reply(b'V')
+            w.close()
+        finally:
+            ps.stop()
+
+
+    def test_throughput(self):
+        ps = par.ParameterServer(o.StreaMiniSGD, 16, mk_model(), cost.CategoricalCrossEntropy())
+        addr = ps.start()
+
+        def mkworker(addr):
+            return par.PSWorker(addr, o.StreaMiniSGD, 16, mk_model(), cost.CategoricalCrossEntropy(), staleness=2)
+
+        try:
+            report = par.ps_throughput(addr, mkworker, self.X, self.t, nworkers=(1, 2), lrate=0.1)
+        finally:
+            ps.stop()
+
+        self.assertEqual([r['nworkers'] for r in report], [1, 2])
+        self.assertTrue(all(r['samples_per_sec'] > 0 for r in report))
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+import theano as th
+floatX = th.config.floatX
+
+import DeepFried.containers as c
+import DeepFried.layers as l
+import DeepFried.pred as p
+import DeepFried.profiling as prof
+
+from DeepFried.test import mk_model
+
+
+class TestFastPath(unittest.TestCase):
+
+
+    def setUp(self):
+        self.X = np.random.randn(5, 10).astype(floatX)
+        self.pred = p.StreaMiniPredictor(16, mk_model())
+        self.expected = self.pred.pred_epoch(self.X)
+
+
+    def test_predict_batch(self):
+        self.assertIsNone(self.pred.fn_fast)
+        self.pred.warmup(self.X[:2])
+        self.assertIsNotNone(self.pred.fn_fast)
+
+        a = self.pred.predict_batch(self.X)
+        b = self.pred.predict_batch(self.X[:2])
+        npt.assert_allclose(a, self.expected, rtol=1e-6)
+        npt.assert_allclose(b, self.expected[:2], rtol=1e-6)
+
+        # Inputs are cast to the expected dtype.
+        npt.assert_allclose(self.pred.predict_batch(self.X.astype(np.float64).tolist()), self.expected, rtol=1e-6)
+
+        # And made contiguous, but not reshaped.
+        npt.assert_allclose(self.pred.predict_batch(np.asfortranarray(self.X)), self.expected, rtol=1e-6)
+        npt.assert_allclose(self.pred.predict_batch(np.repeat(self.X, 2, axis=0)[::2]), self.expected, rtol=1e-6)
+        with self.assertRaises(TypeError):
+            self.pred.predict_batch(self.X[0])
+
+
+    def test_out(self):
+        out = np.zeros_like(self.expected)
+        self.assertIs(self.pred.predict_batch(self.X, out=out), out)
+        npt.assert_allclose(out, self.expected, rtol=1e-6)
+
+        # Results don't alias Theano's internal buffers.
+        a = self.pred.predict_batch(self.X)
+        self.pred.predict_batch(self.X[::-1])
+        npt.assert_allclose(a, self.expected, rtol=1e-6)
+
+
+    def test_predict_one(self):
+        for i, x in enumerate(self.X):
+            npt.assert_allclose(self.pred.predict_one(x), self.expected[i], rtol=1e-6)
+
+        buf = np.empty_like(self.expected[0])
+        self.assertIs(self.pred.predict_one(self.X[3], out=buf), buf)
+        npt.assert_allclose(buf, self.expected[3], rtol=1e-6)
+
+
+class TestConcurrentBranches(unittest.TestCase):
+
+
+    def mk_towers(self, trunk):
+        towers = c.Parallel(*[
+            c.Sequence(l.FullyConnected(10, 8), l.Tanh(), l.FullyConnected(8, 3), l.Softmax())
+            for _ in range(3)
+        ])
+        model = c.Sequence(l.FullyConnected(10, 10), l.ReLU(), towers) if trunk else towers
+        model.reinit(0)
+        return model
+
+
+    def test_same_as_fused(self):
+        X = np.random.randn(20, 10).astype(floatX)
+        for trunk in (False, True):
+            model = self.mk_towers(trunk)
+            fused = p.StreaMiniPredictor(8, model)
+            conc = p.StreaMiniPredictor(8, model, branch_threads=3)
+            self.assertEqual(len(conc.fn_pred.fn_branches), 3)
+            self.assertEqual(conc.fn_pred.fn_trunk is not None, trunk)
+            for a, b in zip(fused.pred_epoch(X), conc.pred_epoch(X)):
+                npt.assert_array_equal(a, b)
+
+            # The threads are let go of, and come back when needed.
+            pool = conc.fn_pred._pool
+            conc.fn_pred.close()
+            self.assertTrue(pool._shutdown)
+            for a, b in zip(fused.pred_epoch(X), conc.pred_epoch(X)):
+                npt.assert_array_equal(a, b)
+
+
+    def test_not_parallel(self):
+        self.assertRaises(ValueError, p.StreaMiniPredictor, 8, mk_model(), branch_threads=2)
+
+
+class TestTaps(unittest.TestCase):
+
+
+    def setUp(self):
+        self.X = np.random.randn(20, 10).astype(floatX)
+        self.model = c.Sequence(
+            l.FullyConnected(10, 8),
+            c.Sequence(l.Tanh(), l.FullyConnected(8, 6), l.ReLU()),
+            l.FullyConnected(6, 3),
+            l.Softmax(),
+        )
+        self.model.reinit(0)
+
+
+    def test_taps(self):
+        inner = self.model.layers[1].layers[1]
+        pred = p.StreaMiniPredictor(8, self.model, taps=[0, '1.1', -2, inner])
+        final, t0, t11, tm2, tinner = pred.pred_epoch(self.X)
+
+        npt.assert_array_equal(final, p.StreaMiniPredictor(8, self.model).pred_epoch(self.X))
+        npt.assert_allclose(t0, p.StreaMiniPredictor(8, c.Sequence(self.model.layers[0])).pred_epoch(self.X), rtol=1e-6)
+        npt.assert_allclose(t11, np.dot(np.tanh(t0), inner.W.get_value()) + inner.b.get_value(), rtol=1e-5, atol=1e-6)
+        npt.assert_array_equal(t11, tinner)
+        self.assertEqual(tm2.shape, (20, 3))
+
+        self.assertEqual(self.model.tap_path(inner), (1, 1))
+        self.assertIs(self.model.layer_at('1.1'), inner)
+
+        # As named by the profiler, with the type checked.
+        names = dict((l, n) for n, l in prof.leaves(self.model))
+        self.assertEqual(names[inner], '1.1 FullyConnected')
+        self.assertIs(self.model.layer_at(names[inner]), inner)
+        self.assertRaises(ValueError, self.model.tap_path, '1.1 ReLU')
+
+
+    def test_out(self):
+        pred = p.StreaMiniPredictor(8, self.model, taps=['1.2'])
+        expected = pred.pred_epoch(self.X)
+        out = (np.zeros((20, 3), floatX), np.zeros((20, 6), floatX))
+        self.assertIs(pred.pred_epoch(self.X, out=out), out)
+        for a, b in zip(expected, out):
+            npt.assert_array_equal(a, b)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+import theano as th
+floatX = th.config.floatX
+
+import DeepFried.containers as c
+import DeepFried.costs as cost
+import DeepFried.layers as l
+import DeepFried.optim as o
+import DeepFried.pred as p
+import DeepFried.profiling as prof
+
+
+def mk_nested_model(seed=42):
+    model = c.Sequence(
+        l.FullyConnected(10, 20),
+        l.BatchNormalization(20),
+        l.ReLU(),
+        c.Parallel(
+            c.Sequence(l.FullyConnected(20, 3), l.Softmax()),
+        ),
+    )
+    model.reinit(seed)
+    return model
+
+
+class TestLayerProfile(unittest.TestCase):
+
+
+    def setUp(self):
+        self.X = np.random.randn(50, 10).astype(floatX)
+        self.t = np.random.randint(3, size=50).astype(np.int32)
+
+
+    def test_leaves(self):
+        names = [n for n, _ in prof.leaves(mk_nested_model())]
+        self.assertEqual(names, ['0 FullyConnected', '1 BatchNormalization', '2 ReLU', '3.0.0 FullyConnected', '3.0.1 Softmax'])
+
+
+    def test_optimizer(self):
+        m1, m2 = mk_nested_model(), mk_nested_model()
+        opt1 = o.StreaMiniMomentum(16, m1, cost.CategoricalCrossEntropy(), momentum=0.9)
+        opt2 = o.StreaMiniMomentum(16, m2, cost.CategoricalCrossEntropy(), momentum=0.9, profile=True)
+
+        # The layer-by-layer gradients are the same as the usual ones.
+        self.assertEqual(opt1.fit_epoch(self.X, self.t, lrate=0.1), opt2.fit_epoch(self.X, self.t, lrate=0.1))
+        for p1, p2 in zip(m1.params, m2.params):
+            npt.assert_allclose(p1.get_value(), p2.get_value(), rtol=1e-5)
+
+        rows = {r['layer']: r for r in opt2.profiler.table()}
+        self.assertNotIn(prof.OTHER, rows)
+        for name in ('0 FullyConnected', '3.0.0 FullyConnected'):
+            self.assertGreater(rows[name]['forward'], 0)
+            self.assertGreater(rows[name]['backward'], 0)
+            self.assertGreaterEqual(rows[name]['forward_bytes'], 16*20*np.dtype(floatX).itemsize if name[0] == '0' else 16*3*np.dtype(floatX).itemsize)
+        self.assertGreater(rows[prof.OPTIMIZER]['backward'], 0)
+        self.assertIn('BatchNormalization', opt2.profiler.report())
+
+
+    def test_shared_layer(self):
+        tanh = l.Tanh()
+        m = c.Sequence(l.FullyConnected(10, 20), tanh, l.FullyConnected(20, 20), tanh, l.FullyConnected(20, 3), l.Softmax())
+        m.reinit(42)
+
+        pred = p.StreaMiniPredictor(16, m, profile=True)
+        npt.assert_array_equal(pred.pred_epoch(self.X), p.StreaMiniPredictor(16, m).pred_epoch(self.X))
+        self.assertEqual(pred.profiler.names, ['0 FullyConnected', '1 Tanh', '2 FullyConnected', '4 FullyConnected', '5 Softmax'])
+        self.assertNotIn('train_expr', vars(tanh))
+
+
+    def test_predictor(self):
+        m = mk_nested_model()
+        pred = p.StreaMiniPredictor(16, m, profile=True)
+        npt.assert_array_equal(pred.pred_epoch(self.X), p.StreaMiniPredictor(16, m).pred_epoch(self.X))
+
+        rows = pred.profiler.table()
+        self.assertEqual([r['layer'] for r in rows], [n for n, _ in prof.leaves(m)])
+        self.assertTrue(all(r['backward'] == 0 for r in rows))
+        self.assertGreater(rows[0]['forward'], 0)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import unittest
+import asyncio
+import threading
+
+import numpy as np
+import numpy.testing as npt
+import theano as th
+floatX = th.config.floatX
+
+import DeepFried.augmentation as aug
+import DeepFried.pred as p
+import DeepFried.serving as s
+
+from DeepFried.test import mk_model
+
+
+class TestMicroBatcher(unittest.TestCase):
+
+
+    def setUp(self):
+        self.X = np.random.randn(60, 10).astype(floatX)
+        self.pred = p.StreaMiniPredictor(16, mk_model())
+        self.expected = self.pred.pred_epoch(self.X)
+
+
+    def test_threads(self):
+        res = [None]*len(self.X)
+
+        # A long wait makes sure requests get merged.
+        with s.MicroBatcher(self.pred, max_wait=0.05) as mb:
+            def client(idx):
+                for i in idx:
+                    res[i] = mb.predict(self.X[i])
+            ths = [threading.Thread(target=client, args=(range(k, 60, 4),)) for k in range(4)]
+            for t in ths:
+                t.start()
+            for t in ths:
+                t.join()
+
+        npt.assert_allclose(np.array(res), self.expected, rtol=1e-5)
+
+        st = mb.stats()
+        self.assertEqual(st['requests'], 60)
+        self.assertEqual(st['queue_depth'], 0)
+        self.assertLess(st['batches'], 60)
+        self.assertEqual(sum(n*c for n, c in st['batch_sizes'].items()), 60)
+        self.assertLessEqual(max(st['batch_sizes']), 16)
+
+
+    def test_stop_while_submitting(self):
+        # Every request is either answered or refused, none is left hanging.
+        mb = s.MicroBatcher(self.pred).start()
+        futs, refused = [], []
+
+        def client():
+            for x in self.X:
+                try:
+                    futs.append(mb.submit(x))
+                except RuntimeError:
+                    refused.append(x)
+
+        ths = [threading.Thread(target=client) for _ in range(4)]
+        for t in ths:
+            t.start()
+        mb.stop()
+        for t in ths:
+            t.join()
+
+        self.assertEqual(len(futs) + len(refused), 4*len(self.X))
+        for f in futs:
+            self.assertEqual(f.result(timeout=10).shape, (3,))
+
+
+    def test_asyncio(self):
+        async def main(mb):
+            return await asyncio.gather(*(mb.predict_async(x) for x in self.X))
+
+        with s.MicroBatcher(self.pred) as mb:
+            res = asyncio.run(main(mb))
+        npt.assert_allclose(np.array(res), self.expected, rtol=1e-5)
+        self.assertGreaterEqual(mb.stats()['max_queue_depth'], 1)
+
+
+    def test_aug_and_errors(self):
+        pipe = aug.AugmentationPipeline(self.X, None, aug.Flipper([0]))
+        with s.MicroBatcher(self.pred, aug=pipe) as mb:
+            futs = [mb.submit(x) for x in self.X[:20]]
+            bad = mb.submit(np.zeros(3, floatX))
+            res = [f.result() for f in futs]
+            with self.assertRaises(Exception):
+                bad.result()
+
+        npt.assert_allclose(np.array(res), self.pred.pred_epoch(self.X[:20], aug=pipe), rtol=1e-5)
+
+        # Nothing would answer requests outside of the `with`.
+        with self.assertRaises(RuntimeError):
+            mb.submit(self.X[0])
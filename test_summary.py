@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import numpy as np
+import theano as th
+floatX = th.config.floatX
+
+import DeepFried.containers as c
+import DeepFried.costs as cost
+import DeepFried.layers as l
+import DeepFried.summary as s
+
+
+class TestSummary(unittest.TestCase):
+
+
+    def mk_convnet(self, border_mode='valid', stride=(1,1)):
+        model = c.Sequence(
+            l.Conv2D(4, (3,3), 2, border_mode=border_mode, stride=stride),
+            l.BatchNormalization(4),
+            l.ReLU(),
+        )
+        model.reinit(0)
+        return model
+
+
+    def test_shapes(self):
+        for bm in ('valid', 'full'):
+            for stride in ((1,1), (2,3)):
+                summ = s.summary(self.mk_convnet(bm, stride), (2, 9, 10), batchsize=5)
+                outshape = th.tensor.nnet.conv.ConvOp.getOutputShape((9, 10), (3, 3), stride, bm)
+                self.assertEqual(summ.layers[0]['outshape'], (4,) + tuple(outshape))
+                self.assertEqual(summ.layers[-1]['outshape'], summ.layers[0]['outshape'])
+
+        # Just like the layer, also take 1-channel images without channel.
+        model = c.Sequence(l.Conv2D(4, 3, 1, border_mode='full'))
+        self.assertEqual(s.summary(model, (9, 10), batchsize=5).layers[0]['outshape'], (4, 11, 12))
+        model = c.Sequence(l.Conv2D(4, 3, 2, imshape=(9, 10)))
+        self.assertEqual(s.summary(model, (180,), batchsize=5).layers[0]['outshape'], (4, 7, 8))
+
+
+    def test_pool(self):
+        self.assertEqual(l.SpatialMaxPool((2,3)).analyze((4, 9, 10))[0], (4, 5, 4))
+        self.assertEqual(l.SpatialMaxPool((2,3), ignore_border=True).analyze((4, 9, 10))[0], (4, 4, 3))
+
+
+    def test_mlp(self):
+        model = c.Sequence(
+            l.FullyConnected(10, 20),
+            l.Tanh(),
+            c.Parallel(
+                l.FullyConnected(20, 3),
+                l.FullyConnected(20, 5, bias=False),
+            ),
+        )
+        summ = s.summary(model, (10,), batchsize=4)
+
+        self.assertEqual([r['layer'] for r in summ.layers], ['0 FullyConnected', '1 Tanh', '2.0 FullyConnected', '2.1 FullyConnected'])
+        self.assertEqual([r['outshape'] for r in summ.layers], [(20,), (20,), (3,), (5,)])
+        self.assertEqual(summ.params, 10*20+20 + 20*3+3 + 20*5)
+        self.assertEqual(summ.layers[0]['flops_pred'], 4*(2*10*20 + 20))
+        self.assertEqual(summ.layers[3]['flops_pred'], 4*2*20*5)
+
+        itemsize = np.dtype(floatX).itemsize
+        self.assertEqual(summ.param_bytes, summ.params*itemsize)
+        self.assertEqual(summ.act_train, 4*itemsize*(10 + 20 + 20 + 3 + 5))
+        self.assertEqual(summ.act_pred, 4*itemsize*(20 + 20))
+        self.assertIn('2.1 FullyConnected', summ.report())
+
+
+    def test_optim_state(self):
+        model = self.mk_convnet()
+        for dtype in (None, 'float16', 'int8'):
+            summ = s.summary(model, (2, 9, 10), batchsize=5, state_dtype=dtype, state_blocksize=32)
+            for cls in s.OPTIMIZERS:
+                kw = dict(momentum=0.9) if cls.__name__ == 'StreaMiniMomentum' else {}
+                opt = cls(5, c.Sequence(model, l.FullyConnected((4,7,8), 2), l.Softmax()), cost.CategoricalCrossEntropy(), state_dtype=dtype, state_blocksize=32, **kw)
+                own = opt.state_nbytes() - cls.state_nbytes_for([(224, 2), (2,)], dtype, 32)
+                self.assertEqual(summ.optim_state[cls.__name__], own, (cls, dtype))
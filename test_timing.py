@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+import theano as th
+floatX = th.config.floatX
+
+import DeepFried.augmentation as aug
+import DeepFried.costs as cost
+import DeepFried.optim as o
+import DeepFried.pred as p
+import DeepFried.timing as timing
+
+from DeepFried.test import mk_model
+
+
+class TestPhaseTimer(unittest.TestCase):
+
+
+    def test_laps(self):
+        now = [0.0]
+        recs = []
+        tm = timing.PhaseTimer(callback=recs.append, clock=lambda: now[0])
+
+        tm.start()
+        for dt in (1.0, 2.0):
+            now[0] += dt
+            tm.lap('a')
+            now[0] += 0.5
+            tm.lap('b')
+        rec = tm.stop('test', 30)
+
+        self.assertEqual(rec['phases'], dict(a=3.0, b=1.0))
+        self.assertEqual(rec['seconds'], 4.0)
+        self.assertEqual(rec['samples_per_sec'], 7.5)
+        self.assertEqual(tm.counts, dict(a=2, b=2))
+        self.assertEqual(recs, [rec])
+        self.assertIn('a', tm.report())
+
+
+    def test_epochs(self):
+        X = np.random.randn(50, 10).astype(floatX)
+        t = np.random.randint(3, size=50).astype(np.int32)
+        pipe = aug.AugmentationPipeline(X, t, aug.Flipper([0]))
+
+        m1, m2 = mk_model(), mk_model()
+        opt1 = o.StreaMiniSGD(16, m1, cost.CategoricalCrossEntropy())
+        opt2 = o.StreaMiniSGD(16, m2, cost.CategoricalCrossEntropy())
+        opt2.timer = timing.PhaseTimer()
+
+        # Timing doesn't change anything.
+        np.random.seed(0)
+        c1 = opt1.fit_epoch(X, t, aug=pipe, lrate=0.1)
+        np.random.seed(0)
+        c2 = opt2.fit_epoch(X, t, aug=pipe, lrate=0.1)
+        self.assertEqual(c1, c2)
+
+        rec = opt2.timer.epochs[-1]
+        self.assertEqual(rec['what'], 'fit_epoch')
+        self.assertEqual(rec['samples'], 50)
+        self.assertGreater(rec['samples_per_sec'], 0)
+        for phase in ('gather', 'augment', 'pre_minibatch', 'fn_train', 'post_minibatch', 'aggregate'):
+            self.assertIn(phase, rec['phases'])
+        self.assertEqual(opt2.timer.counts['fn_train'], 4)
+        self.assertLessEqual(sum(rec['phases'].values()), rec['seconds'] + 1e-9)
+
+        pred = p.StreaMiniPredictor(16, m2)
+        pred.timer = timing.PhaseTimer()
+        npt.assert_array_equal(pred.pred_epoch(X), p.StreaMiniPredictor(16, m1).pred_epoch(X))
+        self.assertEqual(pred.timer.epochs[-1]['what'], 'pred_epoch')
+        self.assertEqual(pred.timer.counts['fn_pred'], 4)
@@ -177,3 +177,18 @@ class TestUtilFunctions(unittest.TestCase):
         l1, l2 = zip(*l)
         npt.assert_array_equal(sorted(np.concatenate([i.flatten() for i in l1])), a7.flatten())
         npt.assert_array_equal(sorted(np.concatenate([i.flatten() for i in l2])), a7.flatten())
+
+
+    def test_batched_sparse(self):
+        import scipy.sparse as sp
+        D = np.random.randn(7, 5) * (np.random.rand(7, 5) < 0.3)
+        S = sp.csr_matrix(D)
+
+        for shuf in (False, 42):
+            ls = list(u.batched(3, S, np.arange(7), shuf=shuf))
+            ld = list(u.batched(3, D, shuf=shuf))
+            self.assertEqual(len(ls), 3)
+            for (s, i), d in zip(ls, ld):
+                self.assertTrue(sp.isspmatrix_csr(s))
+                npt.assert_array_equal(s.toarray(), d)
+                npt.assert_array_equal(s.toarray(), D[i])
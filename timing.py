@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Low-overhead wall-clock timing of the phases of an epoch, such as gathering
+minibatches, augmentation, the layers' hooks and the compiled function call.
+
+Optimizers and predictors have a `timer` attribute which is `None` by
+default, in which case nothing is timed at all. Set it to a `PhaseTimer` to
+start recording:
+
+    opt.timer = PhaseTimer(callback=print)
+    opt.fit_epoch(X, t, lrate=0.1)
+    opt.timer.epochs[-1]['samples_per_sec']
+"""
+
+import time as _time
+
+
+class PhaseTimer(object):
+    """
+    Accumulates the time spent in named phases, with one record per epoch
+    and running totals over all epochs.
+
+    Timing works by laps: `start` marks the beginning of an epoch, and each
+    call to `lap(phase)` attributes all the time since the previous lap (or
+    the start) to `phase`.
+    """
+
+
+    def __init__(self, callback=None, clock=_time.perf_counter):
+        """
+        - `callback`: An optional function which is called with each epoch's
+            record as soon as that epoch is done, e.g. to export it to a
+            monitoring system.
+        - `clock`: The function returning the current time in seconds.
+        """
+        self.callback = callback
+        self.clock = clock
+        self.reset()
+
+
+    def reset(self):
+        """ Forgets everything recorded so far. """
+        self.epochs = []
+        self.totals = {}
+        self.counts = {}
+        self._phases = {}
+        self._start = self._last = None
+
+
+    def start(self):
+        """ Marks the beginning of an epoch. """
+        self._phases = {}
+        self._start = self._last = self.clock()
+
+
+    def lap(self, phase):
+        """ Attributes the time since the last lap to `phase`. """
+        now = self.clock()
+        self._phases[phase] = self._phases.get(phase, 0.0) + now - self._last
+        self.counts[phase] = self.counts.get(phase, 0) + 1
+        self._last = now
+
+
+    def stop(self, what, nsamples):
+        """
+        Marks the end of an epoch of `what` (e.g. `'fit_epoch'`) which went
+        through `nsamples` samples, and returns its record.
+        """
+        secs = self.clock() - self._start
+        rec = dict(
+            what=what,
+            seconds=secs,
+            samples=nsamples,
+            samples_per_sec=nsamples/secs if secs > 0 else float('inf'),
+            phases=self._phases,
+        )
+        self.epochs.append(rec)
+        for phase, t in self._phases.items():
+            self.totals[phase] = self.totals.get(phase, 0.0) + t
+
+        if self.callback is not None:
+            self.callback(rec)
+        return rec
+
+
+    def report(self):
+        """
+        Returns a human-readable table of the total time spent in each phase.
+        """
+        total = sum(self.totals.values()) or 1.0
+        lines = ["{:<16} {:>10} {:>7} {:>10}".format("phase", "seconds", "%", "calls")]
+        for phase, t in sorted(self.totals.items(), key=lambda kv: -kv[1]):
+            lines.append("{:<16} {:>10.4f} {:>6.1f}% {:>10}".format(phase, t, 100*t/total, self.counts[phase]))
+        return "\n".join(lines)
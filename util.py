@@ -48,6 +48,10 @@ def batched(batchsize, *args, shuf=False, droplast=False):
 
     will yield sub-arrays of the given ones four times, the fourth one only
     containing a single value.
+
+    Any of `args` may also be a `scipy.sparse` matrix which supports row
+    indexing, such as a CSR matrix. Without shuffling, batches are sliced
+    rather than gathered, which is cheaper, especially for sparse matrices.
     """
 
     assert(len(args) > 0)
@@ -57,19 +61,23 @@ def batched(batchsize, *args, shuf=False, droplast=False):
     # Assumption: all args have the same 1st dimension as the first one.
     assert(all(x.shape[0] == n for x in args))
 
-    indices = _np.arange(n)
+    indices = None
     if shuf is not False:
+        indices = _np.arange(n)
         rng = check_random_state(shuf)
         rng.shuffle(indices)
 
+    def rows(x, start, stop):
+        return x[start:stop] if indices is None else x[indices[start:stop]]
+
     # First, go through all full batches.
     for i in range(n // batchsize):
-        yield maybetuple(x[indices[i*batchsize:(i+1)*batchsize]] for x in args)
+        yield maybetuple(rows(x, i*batchsize, (i+1)*batchsize) for x in args)
 
     # And now maybe return the last batch.
     rest = n % batchsize
     if rest != 0 and not droplast:
-        yield maybetuple(x[indices[-rest:]] for x in args)
+        yield maybetuple(rows(x, n-rest, n) for x in args)
 
 
 # Blatantly "inspired" by sklearn, for when that's not available.